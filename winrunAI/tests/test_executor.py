@@ -0,0 +1,40 @@
+import threading
+import time
+
+from winrunai import executor
+from winrunai.executor import ActionScheduler
+
+def plan(wineprefix, argument):
+    return {'wineprefix': wineprefix, 'actions': [{'tool': 'winetricks', 'argument': argument}]}
+
+def test_a_failing_tool_finishes_the_plan_and_keeps_the_prefix_usable(tmp_path, monkeypatch):
+    def run_tool(tool, arguments, wineprefix, callback, details=None):
+        if 'broken' in arguments:
+            raise RuntimeError("hive unreadable")
+        return True
+    monkeypatch.setattr(executor, 'run_tool', run_tool)
+
+    scheduler = ActionScheduler(batch_winetricks=False)
+    messages, results = [], {}
+    done = threading.Event()
+
+    def on_done(action_plan, success):
+        results[action_plan['actions'][0]['argument']] = success
+        if len(results) == 2:
+            done.set()
+
+    scheduler.submit(plan(str(tmp_path), 'broken'), messages.append, on_done)
+    scheduler.submit(plan(str(tmp_path), 'vcrun2019'), messages.append, on_done)
+    assert done.wait(5)
+    assert results == {'broken': False, 'vcrun2019': True}
+    assert any('hive unreadable' in message for message in messages)
+
+    # The worker is gone and a new plan for the prefix still runs.
+    late = threading.Event()
+    scheduler.submit(plan(str(tmp_path), 'dxvk'), messages.append, lambda action_plan, success: late.set())
+    assert late.wait(5)
+    for _ in range(50):
+        if not scheduler.stats()['active_prefixes']:
+            break
+        time.sleep(0.01)
+    assert scheduler.stats() == {'queued_actions': 0, 'active_prefixes': 0, 'coalesced': 0, 'completed': 3}
@@ -0,0 +1,69 @@
+import shutil
+import time
+
+from winrunai.monitor import ProcessScanner
+from winrunai.procevents import (
+    PROC_EVENT_EXEC, PROC_EVENT_EXIT, PROC_EVENT_FORK, FakeEventSocket, NetlinkProcessSource,
+    decode_proc_events, encode_proc_event,
+)
+
+def write_process(proc, pid, comm, start_time=1000, environ=b''):
+    """Writes the /proc/<pid> files ProcessScanner reads."""
+    directory = proc / str(pid)
+    directory.mkdir(exist_ok=True)
+    fields = ' '.join(['S'] + ['0'] * 18 + [str(start_time)])
+    (directory / 'stat').write_text(f"{pid} ({comm}) {fields} 0 0\n")
+    (directory / 'cmdline').write_bytes(comm.encode() + b'\0')
+    (directory / 'environ').write_bytes(environ)
+
+def make_source(tmp_path):
+    proc = tmp_path / 'proc'
+    proc.mkdir()
+    events = FakeEventSocket()
+    source = NetlinkProcessSource(ProcessScanner(str(proc)), sock=events)
+    assert source.poll(0) == ([], [])  # The initial resync scan
+    return proc, events, source
+
+def test_events_round_trip():
+    data = encode_proc_event(PROC_EVENT_FORK, 12, parent_pid=1, parent_tgid=1)
+    data += encode_proc_event(PROC_EVENT_EXIT, 12, exit_code=3 << 8)
+    assert list(decode_proc_events(data)) == [(PROC_EVENT_FORK, 12, 12, None), (PROC_EVENT_EXIT, 12, 12, 3 << 8)]
+
+def test_fork_exec_exit_of_a_wine_process(tmp_path):
+    proc, events, source = make_source(tmp_path)
+    try:
+        # A launcher script forks; it is not Wine yet.
+        write_process(proc, 100, 'bash')
+        events.emit(PROC_EVENT_FORK, 100)
+        assert source.poll(0.05) == ([], [])
+
+        # It execs wine.
+        write_process(proc, 100, 'wine64', environ=b'WINEPREFIX=/games/prefix\0')
+        events.emit(PROC_EVENT_EXEC, 100)
+        added, removed = source.poll(1)
+        assert [(info['pid'], info['wineprefix']) for info in added] == [(100, '/games/prefix')]
+        assert removed == []
+
+        # Thread events are ignored.
+        events.emit(PROC_EVENT_EXIT, 101, tgid=100)
+        assert source.poll(0.05) == ([], [])
+
+        shutil.rmtree(proc / '100')
+        events.emit(PROC_EVENT_EXIT, 100, exit_code=3 << 8)
+        assert source.poll(1) == ([], [100])
+        assert source.exit_codes == {100: 3}
+    finally:
+        source.close()
+
+def test_unrelated_events_do_not_end_the_wait(tmp_path):
+    proc, events, source = make_source(tmp_path)
+    try:
+        write_process(proc, 200, 'make')
+        started = time.monotonic()
+        for _ in range(5):
+            events.emit(PROC_EVENT_FORK, 200)
+            events.emit(PROC_EVENT_EXEC, 200)
+        assert source.poll(0.2) == ([], [])
+        assert time.monotonic() - started >= 0.2
+    finally:
+        source.close()
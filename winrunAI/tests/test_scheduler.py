@@ -0,0 +1,76 @@
+import threading
+
+from winrunai.scheduler import AnalysisScheduler
+
+def blocked_scheduler(**kwargs):
+    """A scheduler whose single worker is held by a task of pid 1 in group 'prefix'."""
+    scheduler = AnalysisScheduler(max_workers=1, **kwargs)
+    started, release = threading.Event(), threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    scheduler.submit(1, 'prefix', block)
+    assert started.wait(5)
+    return scheduler, release
+
+def test_finish_runs_after_the_queued_batches():
+    scheduler, release = blocked_scheduler()
+    done = []
+    scheduler.submit(2, 'prefix', done.append, 'last lines')
+    scheduler.finish(2, 'prefix', done.append, 'exit')
+    release.set()
+    scheduler.shutdown()
+    assert done == ['last lines', 'exit']
+
+def test_finish_is_queued_past_the_bounds():
+    scheduler, release = blocked_scheduler(max_pending=1)
+    done = []
+    assert scheduler.submit(2, 'prefix', done.append, 'lines')
+    assert not scheduler.submit(2, 'prefix', done.append, 'more lines')
+    assert scheduler.finish(2, 'prefix', done.append, 'exit')
+    release.set()
+    scheduler.shutdown()
+    assert done == ['lines', 'exit']
+    assert scheduler.stats()['dropped'] == 1
+
+def test_full_pid_is_merged_without_blocking():
+    scheduler, release = blocked_scheduler(max_pending=8, max_pending_per_pid=2)
+    done = []
+    merge = lambda queued, new: (queued[0] + new[0],)
+    for line in 'abcdef':
+        assert scheduler.submit(2, 'prefix', done.append, [line], merge=merge)
+    assert scheduler.submit(3, 'other', done.append, ['x'])
+    release.set()
+    scheduler.shutdown()
+    assert sorted(done) == [['a'], ['b', 'c', 'd', 'e', 'f'], ['x']]
+
+def test_cancel_discards_queued_tasks_and_empty_groups():
+    scheduler, release = blocked_scheduler()
+    done = []
+    scheduler.submit(2, 'other', done.append, 'lines')
+    scheduler.cancel(2)
+    assert 'other' not in scheduler._groups
+    assert scheduler.stats()['queue_depth'] == 0
+    release.set()
+    scheduler.shutdown()
+    assert done == []
+
+def test_cancel_marks_only_the_running_task():
+    scheduler, release = blocked_scheduler()
+    scheduler.cancel(1)
+    assert scheduler.is_cancelled(1)
+    release.set()
+    scheduler.shutdown()
+    assert not scheduler.is_cancelled(1)
+
+def test_cancel_of_an_idle_pid_does_not_block_its_reuse():
+    scheduler = AnalysisScheduler(max_workers=1)
+    done = []
+    scheduler.cancel(3)
+    scheduler.cancel(3)
+    assert not scheduler.is_cancelled(3)
+    assert scheduler.submit(3, 'prefix', done.append, 'reused')
+    scheduler.shutdown()
+    assert done == ['reused']
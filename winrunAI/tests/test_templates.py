@@ -0,0 +1,28 @@
+import os
+
+from winrunai.templates import CAPTURE_EXCLUDES, clone_tree, tree_size
+
+def make_prefix(root):
+    for directory in ('drive_c/users/user/Saved Games', 'drive_c/Program Files/App',
+                      'drive_c/Program Files (x86)/App', 'drive_c/windows/system32'):
+        os.makedirs(root / directory)
+        (root / directory / 'data').write_text('12345')
+    (root / 'user.reg').write_text('WINE REGISTRY Version 2\n')
+
+def test_capture_excludes_user_data_and_applications(tmp_path):
+    source = tmp_path / 'prefix'
+    make_prefix(source)
+    target = tmp_path / 'template'
+    counts = clone_tree(source, target, 'copy', CAPTURE_EXCLUDES)
+    assert counts['copy'] == 2
+    assert (target / 'drive_c/windows/system32/data').exists()
+    assert not (target / 'drive_c/users').exists()
+    assert not (target / 'drive_c/Program Files').exists()
+    assert tree_size(source, CAPTURE_EXCLUDES) == counts['bytes']
+
+def test_clone_without_excludes_copies_everything(tmp_path):
+    source = tmp_path / 'prefix'
+    make_prefix(source)
+    counts = clone_tree(source, tmp_path / 'clone', 'copy')
+    assert counts['copy'] == 5
+    assert counts['bytes'] == tree_size(source)
@@ -1,23 +1,233 @@
 import os
-import fcntl
 import time
-import psutil
-from .engine import AIEngine
-from .executor import execute_action_plan
-from .config import config
+import threading
+from .engine import AIEngine, describe_actions
+from .correlator import FixCorrelator
+from .executor import ActionScheduler
+from .config import current_config
+from .reactor import LogReactor
+from .scheduler import AnalysisScheduler
+from .database import rule_index
+from .logfilter import DuplicateFilter, LINE_CLASSES, parse_wine_line
+from .metrics import ENGINE_LOOKUP_SECONDS, LINES_READ, SamplingProfiler, profile_path
 
-def make_non_blocking(fd):
-    """Make a file descriptor non-blocking."""
-    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-    fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+# A process whose analysis falls behind has its log batches merged up to this
+# many lines per task; past that, further batches are dropped.
+MAX_MERGED_LINES = 4096
 
-def analyze_process(proc_info: dict, engine: AIEngine, callback):
+def merge_lines(queued_args, args):
+    """Merges two queued handle_lines(pid, lines) tasks, see AnalysisScheduler.submit."""
+    pid, lines = queued_args
+    if len(lines) + len(args[1]) > MAX_MERGED_LINES:
+        return None
+    return (pid, lines + args[1])
+
+def repeat_message(count, sample, source):
+    """The log message for `count` suppressed repeats of a line."""
+    line = parse_wine_line(sample)
+    label = LINE_CLASSES[line.line_class] if line else 'Error'
+    return f"Log {label} ({source}) repeated ×{count}: {sample.strip()}"
+
+class PrefixContext:
     """
-    Analyzes a detected Wine process by attaching to its stderr stream to capture logs.
+    Analysis state shared by all processes running in the same WINEPREFIX,
+    such as the application and its wineserver and winedevice.exe helpers.
+    With a TemplateCache, the prefix is captured as a template after fixes
+    have been applied to it. `started` is when the current run of the prefix
+    began; fixes applied before it are checked against its errors.
+    """
+    def __init__(self, wineprefix: str, templates=None):
+        self.wineprefix = wineprefix
+        self.pids = set()
+        self.templates = templates
+        self.started = time.time()
+
+        # Repeated errors are collapsed before they reach the engine and the log.
+        filter_config = current_config().get('log_filter', {})
+        self.duplicates = DuplicateFilter(
+            window=filter_config.get('window', 60),
+            summary_interval=filter_config.get('summary_interval', 10)
+        )
+
+    def flush_repeats(self, callback, final=False):
+        """
+        Reports the repeat counts that are due, or with `final` (when the
+        prefix's last process is gone) all that are left.
+        """
+        summaries = self.duplicates.drain() if final else self.duplicates.flush()
+        for count, sample in summaries:
+            callback(repeat_message(count, sample, self.wineprefix))
+
+class ProcessAnalysis:
+    """
+    The analysis state for one monitored process.
+
+    Receives batches of log lines from the LogReactor, asks the engine for
+    suggestions on error lines and applies fixes that meet the confidence
+    threshold. Lines of the other enabled debug classes (`log_filter.classes`,
+    e.g. fixme) are only looked at when there are rules for their class and
+    channel, and never sent to the LLM. Error lines and suggestions are recorded with
+    `events(type, pid=..., wineprefix=..., **fields)`, e.g. an EventStore.
+    """
+    def __init__(self, proc_info: dict, engine: AIEngine, callback, context: PrefixContext = None, is_cancelled=None, actions: ActionScheduler = None, events=None):
+        self.pid = proc_info['pid']
+        self.wineprefix = proc_info['wineprefix']
+        self.engine = engine
+        self.callback = callback
+        self.events = events or (lambda type, **fields: None)
+        self.actions = actions or ActionScheduler()
+        self.context = context or PrefixContext(self.wineprefix)
+        self.is_cancelled = is_cancelled or (lambda pid: False)
+        self.auto_apply_threshold = current_config().get('ai_engine', {}).get('auto_apply_confidence_threshold', 0.9)
+
+        # Recent rule matches of this process, so related errors lead to one
+        # ranked plan, and the fixes already suggested for it.
+        self.correlator = FixCorrelator(current_config().get('ai_engine', {}).get('correlation_window', 60))
+        self._suggested = set()
+        self._suggested_lock = threading.Lock()
+
+    def handle_lines(self, pid, lines):
+        """
+        Processes a batch of complete log lines from the process. The errors
+        in the batch are correlated and answered with a single action plan.
+        """
+        duplicates = self.context.duplicates
+        suggestion = None
+        LINES_READ.inc(len(lines))
+
+        # Follow configuration reloads.
+        config = current_config()
+        settings = config.get('ai_engine', {})
+        self.auto_apply_threshold = settings.get('auto_apply_confidence_threshold', 0.9)
+        self.correlator.window = settings.get('correlation_window', 60)
+        classes = config.get('log_filter', {}).get('classes', ('err', 'fixme'))
+        matcher = rule_index.matcher()
+
+        for line in lines:
+            if self.is_cancelled(pid):
+                return
+            parsed = parse_wine_line(line.lstrip())
+            if parsed is not None:
+                line_class = parsed.line_class
+                if line_class not in classes:
+                    continue
+                # Only errors can go to the LLM; other lines need a rule.
+                if line_class != 'err' and not len(matcher.bucket(line_class, parsed.channel)):
+                    continue
+            elif "err:" in line:
+                line_class = 'err'
+            else:
+                continue
+            forward, summary = duplicates.feed(line)
+            if summary:
+                self.report_repeats(*summary)
+            if forward:
+                suggestion = self.handle_error(line, line_class) or suggestion
+
+        for summary in duplicates.flush():
+            self.report_repeats(*summary)
+        self.handle_suggestion(suggestion)
+
+    def report_repeats(self, count, sample):
+        self.callback(repeat_message(count, sample, f"PID {self.pid}"))
+
+    def handle_error(self, line, line_class='err'):
+        """
+        Logs an error (or other enabled debug class) line and feeds it to the engine.
+
+        Returns:
+            The action plan for the fixes in the correlation window, or None.
+        """
+        self.callback(f"Log {LINE_CLASSES[line_class]} (PID {self.pid}): {line.strip()}")
+        self.events('error', pid=self.pid, wineprefix=self.wineprefix, line=line.strip(), line_class=line_class)
+
+        # A fix applied before this run that did not make the error go away
+        # counts against its rules.
+        outcomes = self.engine.outcomes
+        if outcomes.has_pending(self.wineprefix):
+            for tool, argument in outcomes.observe(self.wineprefix, self.engine.find_rules(line), self.context.started):
+                self.callback(f"The error fixed by '{argument.splitlines()[0]}' ({tool}) is back; lowering the confidence of its rules.")
+
+        # A suggestion from the LLM may arrive later, through handle_suggestion.
+        with ENGINE_LOOKUP_SECONDS.time():
+            return self.engine.get_suggestion(line, self.wineprefix, on_late_suggestion=self.handle_suggestion,
+                                              correlator=self.correlator, use_llm=line_class == 'err')
+
+    def handle_suggestion(self, suggestion):
+        """
+        Reports the new fixes of an action plan and applies those that meet
+        the confidence threshold, together.
+        """
+        if not suggestion:
+            return
+        callback = self.callback
+        engine = self.engine
+
+        # The engine remembers fixes per WINEPREFIX, across processes and restarts.
+        with self._suggested_lock:
+            actions = [
+                action for action in suggestion['actions']
+                if (action['tool'], action['argument']) not in self._suggested
+                and not engine.is_fix_applied(self.wineprefix, (action['tool'], action['argument']))
+            ]
+            self._suggested.update((action['tool'], action['argument']) for action in actions)
+        if not actions:
+            return
+
+        callback("AI Suggestion Found!")
+        callback(describe_actions(actions))
+        self.events('suggestion', pid=self.pid, wineprefix=self.wineprefix, source=suggestion.get('source'), actions=[
+            {'tool': action['tool'], 'argument': action['argument'], 'confidence': action['confidence']}
+            for action in actions
+        ])
+
+        automatic = []
+        for action in actions:
+            if action['confidence'] >= self.auto_apply_threshold:
+                if engine.claim_fix(self.wineprefix, (action['tool'], action['argument'])):
+                    automatic.append(action)
+            else:
+                callback(f"Confidence ({action['confidence']:.0%}) for '{action['argument']}' is below threshold. Manual confirmation would be required.")
+
+        if automatic:
+            if len(automatic) == 1:
+                callback(f"Confidence ({automatic[0]['confidence']:.0%}) meets threshold (>{self.auto_apply_threshold:.0%}). Executing automatically...")
+            else:
+                callback(f"{len(automatic)} fixes meet the confidence threshold (>{self.auto_apply_threshold:.0%}). Executing automatically as one plan...")
+            # Installs can take minutes; they run in the background.
+            self.actions.submit({**suggestion, 'actions': automatic, 'pid': self.pid}, callback, on_done=self.fix_done)
+
+    def fix_done(self, action_plan, success):
+        if success:
+            for action in action_plan['actions']:
+                self.engine.record_fix(action_plan['wineprefix'], (action['tool'], action['argument']))
+            if self.context.templates is not None:
+                self.context.templates.capture_later(action_plan['wineprefix'], self.callback)
+
+    def handle_exit(self, pid):
+        self.callback(f"Process {pid} has terminated. Ending analysis.")
+        # A context of its own (the service shares them per prefix and
+        # reports them when the prefix's last process is gone).
+        if not self.context.pids:
+            for summary in self.context.duplicates.drain():
+                self.report_repeats(*summary)
+
+def attach_process(proc_info: dict, engine: AIEngine, reactor: LogReactor, callback, scheduler: AnalysisScheduler = None, context: PrefixContext = None, actions: ActionScheduler = None, events=None):
+    """
+    Attaches to a detected Wine process's stderr stream through the reactor.
+
+    With a scheduler, batches of lines are analyzed on its worker pool, grouped
+    by WINEPREFIX, and the process's exit is handled once its queued batches are.
+    Otherwise they are analyzed directly on the reactor thread. Fixes are
+    handed to `actions`, so analysis never waits for an install, and errors
+    and suggestions are recorded to `events`.
+
+    Returns:
+        The ProcessAnalysis for the process, or None if its logs could not be attached.
     """
     pid = proc_info['pid']
     wineprefix = proc_info['wineprefix']
-    cmdline = ' '.join(proc_info.get('cmdline', ['unknown']))
+    cmdline = ' '.join(proc_info.get('cmdline') or ['unknown'])
 
     callback(f"Starting analysis for running process: PID {pid} ({cmdline})")
     callback(f"Using WINEPREFIX: {wineprefix}")
@@ -28,43 +238,51 @@ def analyze_process(proc_info: dict, engine: AIEngine, callback):
         # Check if we can access the process's stderr
         if not os.access(stderr_path, os.R_OK):
             callback(f"Warning: No permission to read logs from PID {pid}. This can happen with sandboxed apps (Flatpak, Snap) or processes run by another user.")
-            return
+            return None
 
-        with open(stderr_path, 'r', encoding='utf-8', errors='replace') as stderr_stream:
-            make_non_blocking(stderr_stream.fileno())
-            callback(f"Successfully attached to log stream for PID {pid}.")
+        if scheduler is None:
+            analysis = ProcessAnalysis(proc_info, engine, callback, context, actions=actions, events=events)
+            reactor.add(pid, stderr_path, analysis.handle_lines, analysis.handle_exit)
+        else:
+            analysis = ProcessAnalysis(proc_info, engine, callback, context, scheduler.is_cancelled, actions, events)
 
-            already_fixed = set()
-            auto_apply_threshold = config.get('ai_engine', {}).get('auto_apply_confidence_threshold', 0.9)
+            def on_lines(pid, lines):
+                scheduler.submit(pid, wineprefix, analysis.handle_lines, pid, lines, merge=merge_lines)
 
-            # Loop as long as the process is running
-            while psutil.pid_exists(pid):
-                line = stderr_stream.readline()
-                if line and "err:" in line:
-                    callback(f"Log Error (PID {pid}): {line.strip()}")
+            def on_exit(pid):
+                # After the batches still queued: the last lines before an exit are often its cause.
+                scheduler.finish(pid, wineprefix, analysis.handle_exit, pid)
 
-                    suggestion = engine.get_suggestion(line, wineprefix)
+            reactor.add(pid, stderr_path, on_lines, on_exit)
+        callback(f"Successfully attached to log stream for PID {pid}.")
+        return analysis
 
-                    if suggestion:
-                        fix_id = (suggestion['actions'][0]['tool'], suggestion['actions'][0]['argument'])
-
-                        if fix_id not in already_fixed:
-                            callback("AI Suggestion Found!")
-                            callback(suggestion['description'])
-
-                            if suggestion['confidence'] >= auto_apply_threshold:
-                                callback(f"Confidence ({suggestion['confidence']:.0%}) meets threshold (>{auto_apply_threshold:.0%}). Executing automatically...")
-                                execute_action_plan(suggestion, callback)
-                                already_fixed.add(fix_id)
-                            else:
-                                callback(f"Confidence ({suggestion['confidence']:.0%}) is below threshold. Manual confirmation would be required.")
-                else:
-                    # If no line, wait a bit to prevent a busy loop
-                    time.sleep(0.5)
-
-            callback(f"Process {pid} has terminated. Ending analysis.")
-
-    except FileNotFoundError:
+    except (FileNotFoundError, ProcessLookupError):
         callback(f"Process {pid} terminated before logs could be attached.")
     except Exception as e:
         callback(f"An unexpected error occurred during analysis of PID {pid}: {e}")
+    return None
+
+def analyze_process(proc_info: dict, engine: AIEngine, callback):
+    """
+    Analyzes a detected Wine process by attaching to its stderr stream to capture logs.
+
+    Blocks until the process terminates. The service shares one LogReactor
+    between all processes instead; this is for analyzing a single process.
+    With `service.profile` enabled, a sampling profile of the analysis is
+    written when the process exits.
+    """
+    reactor = LogReactor()
+    if attach_process(proc_info, engine, reactor, callback) is None:
+        reactor.close()
+        return
+
+    service_config = current_config().get('service', {})
+    if not service_config.get('profile', False):
+        reactor.run(until_idle=True)
+        return
+    with SamplingProfiler(service_config.get('profile_interval', 0.005)) as profiler:
+        reactor.run(until_idle=True)
+    output = profile_path(f"analyze_{proc_info['pid']}")
+    profiler.dump(output)
+    callback(f"Profile written to {output}")
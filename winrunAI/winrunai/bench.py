@@ -0,0 +1,499 @@
+import os
+import sys
+import json
+import time
+import random
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+
+from .analyzer import PrefixContext, ProcessAnalysis, merge_lines
+from .database import BUILTIN_RULES, find_fix_for_error, rule_index
+from .engine import AIEngine
+from .logfilter import parse_wine_line
+from .matcher import RuleMatcher
+from .logwriter import LogWriter
+from .monitor import find_wine_processes_iter
+from .reactor import LogReactor
+from .scheduler import AnalysisScheduler
+
+# The child process that plays a log back on its stderr. It waits for a byte
+# on stdin, so the reactor is attached before any output is written. With a
+# rate (lines per second), lines are written in 10ms slices, like a live
+# process; otherwise the log is written as fast as it is read.
+PLAYER = (
+    "import sys, time, shutil\n"
+    "rate = float(sys.argv[2])\n"
+    "sys.stdin.buffer.read(1)\n"
+    "with open(sys.argv[1], 'rb') as log:\n"
+    "    if not rate:\n"
+    "        shutil.copyfileobj(log, sys.stderr.buffer, 1 << 16)\n"
+    "        sys.exit()\n"
+    "    per_slice, start, sent = max(int(rate / 100), 1), time.monotonic(), 0\n"
+    "    while True:\n"
+    "        chunk = b''.join(log.readline() for _ in range(per_slice))\n"
+    "        if not chunk:\n"
+    "            break\n"
+    "        sys.stderr.buffer.write(chunk)\n"
+    "        sys.stderr.buffer.flush()\n"
+    "        sent += per_slice\n"
+    "        time.sleep(max(start + sent / rate - time.monotonic(), 0))\n"
+)
+
+NOISE_LINES = [
+    "fixme:heap:RtlSetHeapInformation {handle} 0 {addr} 4 stub",
+    "fixme:ntdll:NtQuerySystemInformation info_class SYSTEM_PERFORMANCE_INFORMATION",
+    "fixme:dxgi:DXGID3D10CreateDevice Ignoring flags {hex}.",
+    "warn:seh:dispatch_exception code={hex} flags=1 addr={addr}",
+    "trace:module:load_dll looking for L\"C:\\\\windows\\\\system32\\\\kernelbase.dll\" in L\"\"",
+    "fixme:wbemprox:client_security_SetBlanket {addr}, {addr}, 10, 0, (null), 3, 3, (nil), {hex}",
+    "fixme:ver:GetCurrentPackageId ({addr} (nil)): stub",
+]
+ERROR_LINES = [
+    "err:module:import_dll Library {dll} (which is needed by L\"C:\\\\Program Files\\\\App\\\\app.exe\") not found",
+    "err:d3d:wined3d_debug_callback {addr}: \"GL_INVALID_OPERATION error generated. Frame {count}.\"",
+    "err:ole:CoGetClassObject class {{{guid}}} not registered",
+    "err:virtual:map_image_into_view failed to set {hex} protection on L\"\\\\??\\\\C:\\\\app\\\\plugin{count}.dll\" section .text",
+    "err:xinput:XInputGetState controller {count} not found",
+    "err:mscoree:LoadLibraryShim error reading registry key for installroot",
+]
+DLLS = ["d3dx9_43.dll", "msvcp140.dll", "vcruntime140.dll", "d3d11.dll", "dxgi.dll", "xaudio2_7.dll", "mfplat.dll", "physxloader.dll"]
+
+def generate_log(path, lines=100000, error_ratio=0.1, seed=0):
+    """
+    Writes a synthetic Wine stderr log: mostly fixme/warn noise with thread
+    ids, addresses and counters that vary, and `error_ratio` err: lines, some
+    of which match the built-in rules.
+    """
+    rng = random.Random(seed)
+    thread_ids = [f"{rng.randrange(0x20, 0x200):04x}" for _ in range(16)]
+    with open(path, 'w', encoding='utf-8') as log:
+        for _ in range(lines):
+            template = rng.choice(ERROR_LINES if rng.random() < error_ratio else NOISE_LINES)
+            text = template.format(
+                handle=f"{rng.randrange(1 << 20, 1 << 24):08X}",
+                addr=f"0x{rng.randrange(1 << 32, 1 << 40):x}",
+                hex=f"0x{rng.randrange(1 << 16):x}",
+                dll=rng.choice(DLLS),
+                count=rng.randrange(100000),
+                guid=f"{rng.randrange(1 << 32):08x}-0000-0000-c000-000000000046",
+            )
+            log.write(f"{rng.choice(thread_ids)}:{text}\n")
+
+class StubActionScheduler:
+    """Stands in for the ActionScheduler: records plans instead of running tools."""
+    def __init__(self):
+        self.plans = []
+
+    def submit(self, action_plan, callback, on_done=None):
+        self.plans.append(action_plan)
+        if on_done:
+            on_done(action_plan, False) # Not applied, so nothing is recorded
+        return True
+
+    def stats(self):
+        return {'submitted': len(self.plans)}
+
+def percentile(sorted_values, fraction):
+    """Returns the value at `fraction` (0..1) of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+def _latency_summary(latencies):
+    latencies.sort()
+    return {
+        'p50_us': round(percentile(latencies, 0.50) * 1e6, 2),
+        'p99_us': round(percentile(latencies, 0.99) * 1e6, 2),
+        'max_us': round(latencies[-1] * 1e6, 2) if latencies else 0.0,
+    }
+
+def thread_count():
+    """The number of OS threads of this process."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('Threads:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return threading.active_count()
+
+def max_rss_kib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def replay(log_path, engine: AIEngine = None, use_scheduler=False, workers=4, rate=0, callback=None, plans=False):
+    """
+    Replays a Wine stderr log through the analysis pipeline.
+
+    A child process writes the log to its stderr, and the log is captured from
+    /proc/<pid>/fd/2 by a LogReactor and analyzed by a ProcessAnalysis, as for
+    a live process (with `use_scheduler`, on an AnalysisScheduler as in the
+    service). Fixes go to a StubActionScheduler. The latency of a line is the
+    time from the reactor reading it to the analysis of its batch finishing.
+    Without a `rate` (lines per second), the log is replayed as fast as
+    possible, which measures throughput; latency is then dominated by the
+    size of the batches read. Batches the scheduler has to merge while the
+    analysis falls behind keep the read time of the first; 'dropped' counts
+    batches it dropped, which the throughput does not cover.
+
+    Returns:
+        dict: Throughput, latency percentiles, memory, threads and counters,
+        and with `plans`, the action plans the analysis submitted.
+    """
+    engine = engine or AIEngine()
+    callback = callback or (lambda message: None)
+    wineprefix = tempfile.mkdtemp(prefix='winrunai-bench-')
+    actions = StubActionScheduler()
+    reactor = LogReactor()
+    scheduler = AnalysisScheduler(max_workers=workers) if use_scheduler else None
+
+    player = subprocess.Popen(
+        [sys.executable, '-c', PLAYER, str(log_path), str(rate)], stdin=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    proc_info = {'pid': player.pid, 'wineprefix': wineprefix, 'cmdline': ['replay', str(log_path)]}
+    analysis = ProcessAnalysis(proc_info, engine, callback, PrefixContext(wineprefix),
+                               scheduler.is_cancelled if scheduler else None, actions)
+
+    latencies = []
+    lines_seen = 0
+    peak_threads = thread_count()
+    lock = threading.Lock()
+
+    def analyze(pid, lines, read_at):
+        nonlocal lines_seen, peak_threads
+        analysis.handle_lines(pid, lines)
+        latency = time.perf_counter() - read_at
+        with lock:
+            latencies.extend([latency] * len(lines))
+            lines_seen += len(lines)
+            peak_threads = max(peak_threads, thread_count())
+
+    def merge(queued_args, args):
+        # As the service merges handle_lines batches; the merged batch was read at the first's time.
+        merged = merge_lines(queued_args[:2], args[:2])
+        return merged and (*merged, queued_args[2])
+
+    def on_lines(pid, lines):
+        if scheduler:
+            scheduler.submit(pid, wineprefix, analyze, pid, lines, time.perf_counter(), merge=merge)
+        else:
+            analyze(pid, lines, time.perf_counter())
+
+    rss_before = max_rss_kib()
+    reactor.add(player.pid, f"/proc/{player.pid}/fd/2", on_lines)
+    started = time.perf_counter()
+    player.stdin.write(b'\n')
+    player.stdin.close()
+    reactor.run(until_idle=True)
+    if scheduler:
+        scheduler.shutdown()
+    elapsed = time.perf_counter() - started
+    player.wait()
+    player.stderr.close()
+    os.rmdir(wineprefix)
+
+    results = {
+        'lines': lines_seen,
+        'seconds': round(elapsed, 4),
+        'lines_per_second': round(lines_seen / elapsed) if elapsed else 0,
+        'latency': _latency_summary(latencies),
+        'max_rss_kib': max_rss_kib(),
+        'rss_growth_kib': max_rss_kib() - rss_before,
+        'peak_threads': peak_threads,
+        'errors_forwarded': analysis.context.duplicates.forwarded,
+        'errors_suppressed': analysis.context.duplicates.suppressed,
+        'plans_submitted': len(actions.plans),
+        'suggestion_cache': engine.cache_stats(),
+        'scheduler': use_scheduler,
+        'dropped': scheduler.stats()['dropped'] if scheduler else 0,
+        'rate': rate,
+    }
+    if plans:
+        results['plans'] = actions.plans
+    return results
+
+def time_calls(fn, arguments, repeat=1):
+    """Calls fn(argument) for every argument, `repeat` times, and summarizes the per-call times."""
+    timings = []
+    for _ in range(repeat):
+        for argument in arguments:
+            start = time.perf_counter()
+            fn(argument)
+            timings.append(time.perf_counter() - start)
+    total = sum(timings)
+    summary = {'calls': len(timings), 'calls_per_second': round(len(timings) / total) if total else 0}
+    summary.update(_latency_summary(timings))
+    return summary
+
+def naive_find_fix(error_string, rules=None):
+    """The original rule lookup: a substring test against every rule in order."""
+    for rule in rules:
+        if rule['pattern'].lower() in error_string.lower():
+            return rule
+    return None
+
+def micro_benchmarks(log_path, sample_size=5000, engine: AIEngine = None, callback=None):
+    """
+    Times the hot functions of the pipeline on lines from a log.
+
+    Returns:
+        dict: One summary per benchmark.
+    """
+    engine = engine or AIEngine()
+    callback = callback or (lambda message: None)
+    with open(log_path, encoding='utf-8', errors='replace') as log:
+        sample = [line for _, line in zip(range(sample_size), log)]
+    rules = rule_index.matcher().rules
+    results = {}
+
+    callback("Benchmarking find_fix_for_error...")
+    results['find_fix_for_error'] = time_calls(find_fix_for_error, sample, repeat=3)
+    results['find_fix_for_error']['rules'] = len(rules)
+
+    # The same lookup without the automaton, as a baseline.
+    callback("Benchmarking the linear rule scan...")
+    results['linear_rule_scan'] = time_calls(lambda line: naive_find_fix(line, rules), sample, repeat=3)
+
+    callback("Benchmarking RuleMatcher.all_matches...")
+    results['all_matches'] = time_calls(rule_index.matcher().all_matches, sample, repeat=3)
+
+    # Every line against one automaton over all rules, as before rules were
+    # bucketed by debug class and channel.
+    callback("Benchmarking parse_wine_line and the unbucketed matcher...")
+    results['parse_wine_line'] = time_calls(parse_wine_line, sample, repeat=3)
+    results['unbucketed_all_matches'] = time_calls(RuleMatcher(rules).all_matches, sample, repeat=3)
+
+    wineprefix = tempfile.mkdtemp(prefix='winrunai-bench-')
+    try:
+        callback("Benchmarking AIEngine.get_suggestion (cold and warm cache)...")
+        engine.suggestion_cache.clear()
+        results['get_suggestion_cold'] = time_calls(lambda line: engine.get_suggestion(line, wineprefix), sample)
+        results['get_suggestion_warm'] = time_calls(lambda line: engine.get_suggestion(line, wineprefix), sample)
+    finally:
+        os.rmdir(wineprefix)
+
+    callback("Benchmarking find_wine_processes_iter...")
+    results['find_wine_processes_iter'] = time_calls(lambda _: list(find_wine_processes_iter()), range(20))
+
+    callback("Benchmarking the log writer...")
+    with tempfile.TemporaryDirectory(prefix='winrunai-bench-') as directory:
+        writer = LogWriter(os.path.join(directory, 'bench.log'), mode='w', max_queue=len(sample) * 20 + 1)
+        start = time.perf_counter()
+        for _ in range(20):
+            for line in sample:
+                writer(line)
+        queued = time.perf_counter() - start
+        writer.close()
+        written = time.perf_counter() - start
+        records = len(sample) * 20
+        results['log_writer'] = {
+            'records': records,
+            'enqueue_per_second': round(records / queued) if queued else 0,
+            'written_per_second': round(records / written) if written else 0,
+            'dropped': writer.dropped,
+        }
+    return results
+
+# Entry paths timed by the startup benchmark, as python arguments.
+STARTUP_PATHS = {
+    'help': ['-m', 'winrunai.main', '--help'],
+    'status': ['-m', 'winrunai.main', 'status'],
+    'service_imports': ['-c', 'import winrunai.service'],
+    'tui_imports': ['-c', 'import winrunai.tui'],
+}
+
+def startup_benchmarks(repeat=5, callback=None):
+    """
+    Times each entry path in a fresh interpreter, and reports which heavy
+    modules it loads.
+
+    Returns:
+        dict: Per path, the median wall time, the median total import time
+        (from -X importtime) and whether Textual and the engine were imported.
+    """
+    callback = callback or (lambda message: None)
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [package_root, os.environ.get('PYTHONPATH')])))
+    results = {}
+    for name, arguments in STARTUP_PATHS.items():
+        callback(f"Timing startup: {name}...")
+        walls, imports, modules = [], [], set()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            process = subprocess.run([sys.executable, '-X', 'importtime', *arguments], env=env,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            walls.append(time.perf_counter() - start)
+            total = 0
+            for line in process.stderr.splitlines():
+                if not line.startswith('import time:'):
+                    continue
+                _, cumulative, module = line[len('import time:'):].split('|')
+                if not module.startswith('  '):
+                    # Top-level import: its cumulative time includes its children.
+                    if cumulative.strip().isdigit():
+                        total += int(cumulative)
+                modules.add(module.strip())
+            imports.append(total / 1e6)
+        walls.sort()
+        imports.sort()
+        results[name] = {
+            'wall_ms': round(walls[len(walls) // 2] * 1000, 1),
+            'import_ms': round(imports[len(imports) // 2] * 1000, 1),
+            'imports_textual': 'textual' in modules,
+            'imports_engine': 'winrunai.engine' in modules,
+        }
+    return results
+
+def _synthetic_prefix(path, files, file_bytes, seed=0):
+    """Writes a directory tree shaped like a WINEPREFIX, with `files` DLLs of `file_bytes` bytes."""
+    rng = random.Random(seed)
+    for directory in ('drive_c/windows/system32', 'drive_c/windows/syswow64', 'dosdevices'):
+        os.makedirs(os.path.join(path, directory), exist_ok=True)
+    os.symlink('../drive_c', os.path.join(path, 'dosdevices', 'c:'))
+    for name in ('system.reg', 'user.reg', 'userdef.reg'):
+        with open(os.path.join(path, name), 'w') as hive:
+            hive.write("WINE REGISTRY Version 2\n")
+    for index in range(files):
+        directory = 'drive_c/windows/system32' if index % 2 else 'drive_c/windows/syswow64'
+        with open(os.path.join(path, directory, f"bench{index}.dll"), 'wb') as dll:
+            dll.write(rng.randbytes(file_bytes))
+
+def template_benchmarks(files=2000, file_bytes=64 * 1024, callback=None):
+    """
+    Times capturing a synthetic prefix as a template and cloning it with
+    each method the filesystem supports, next to how long winetricks runs
+    took on this machine (from the event history), which is what a clone
+    replaces.
+
+    Returns:
+        dict: 'capture_seconds', per clone method its 'seconds' and file
+        counts, and 'installs' (the recorded winetricks runs).
+    """
+    from .templates import TemplateCache
+    from .eventstore import open_event_store
+
+    callback = callback or (lambda message: None)
+    results = {'files': files, 'bytes': files * file_bytes}
+    with tempfile.TemporaryDirectory(prefix='winrunai-bench-') as directory:
+        prefix = os.path.join(directory, 'prefix')
+        callback(f"Writing a synthetic prefix of {results['bytes'] >> 20} MB...")
+        _synthetic_prefix(prefix, files, file_bytes)
+        cache = TemplateCache(os.path.join(directory, 'templates'), max_template_bytes=results['bytes'] * 2)
+        callback("Benchmarking template capture...")
+        template = cache.capture(prefix, [('winetricks', 'bench')], version='bench')
+        results['capture_seconds'] = template['capture_seconds']
+        for method in ('auto', 'hardlink', 'copy'):
+            callback(f"Benchmarking template clone ({method})...")
+            clone = cache.clone(template['key'], os.path.join(directory, f"clone-{method}"), method, record=False)
+            results[f"clone_{method}"] = {'seconds': clone['seconds'], **{
+                name: count for name, count in clone['counts'].items() if name != 'bytes'
+            }}
+
+    # What cloning saves: the installs recorded by the service.
+    installs = {}
+    try:
+        with open_event_store(read_only=True) as store:
+            for event in store.query(types='action_end'):
+                if event.get('tool') == 'winetricks' and event.get('result') == 'success':
+                    installs.setdefault(' '.join(event['arguments']), []).append(event['duration'])
+    except OSError:
+        pass
+    results['installs'] = {
+        verbs: {'runs': len(durations), 'median_seconds': sorted(durations)[len(durations) // 2]}
+        for verbs, durations in installs.items()
+    }
+    return results
+
+def bulk_benchmarks(log_path, callback=None):
+    """
+    Times the offline analyzer on a log with 1, 2, 4, ... worker processes,
+    up to the number of cores.
+
+    Returns:
+        dict: Per worker count, 'seconds', 'lines_per_second' and the
+        'speedup' over one worker.
+    """
+    from .bulk import analyze_logs
+
+    callback = callback or (lambda message: None)
+    counts, workers = [], 1
+    while workers < (os.cpu_count() or 1):
+        counts.append(workers)
+        workers *= 2
+    counts.append(os.cpu_count() or 1)
+    results = {}
+    for workers in counts:
+        callback(f"Benchmarking the bulk analyzer on {workers} processes...")
+        report = analyze_logs([log_path], workers=workers)
+        results[workers] = {
+            'seconds': report['seconds'],
+            'lines_per_second': report['lines_per_second'],
+            'speedup': round(results[1]['seconds'] / report['seconds'], 2) if results else 1.0,
+        }
+    return results
+
+def run(log_path=None, lines=100000, seed=0, use_scheduler=False, rate=0, micro=True, bulk=False, callback=None):
+    """
+    Runs the benchmark suite on a recorded log, or on a synthetic one of
+    `lines` lines. Returns the results as a JSON-serializable dict.
+    """
+    callback = callback or (lambda message: None)
+    temp_log = None
+    if log_path is None:
+        temp_log = tempfile.NamedTemporaryFile(prefix='winrunai-bench-', suffix='.log', delete=False)
+        temp_log.close()
+        log_path = temp_log.name
+        callback(f"Generating a synthetic log of {lines} lines...")
+        generate_log(log_path, lines, seed=seed)
+
+    try:
+        engine = AIEngine()
+        callback("Replaying the log through the analysis pipeline...")
+        results = {
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'log': 'synthetic' if temp_log else str(log_path),
+            'builtin_rules': len(BUILTIN_RULES),
+            'replay': replay(log_path, engine, use_scheduler=use_scheduler, rate=rate),
+        }
+        if micro:
+            results['micro'] = micro_benchmarks(log_path, engine=engine, callback=callback)
+        if bulk:
+            results['bulk'] = bulk_benchmarks(log_path, callback=callback)
+    finally:
+        if temp_log:
+            os.unlink(log_path)
+    return results
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the WinRunAI analysis pipeline.")
+    parser.add_argument('--log', help="A recorded Wine stderr log to replay (default: a synthetic log).")
+    parser.add_argument('--lines', type=int, default=100000, help="Lines in the synthetic log.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic log.")
+    parser.add_argument('--scheduler', action='store_true', help="Analyze on the worker pool, as the service does.")
+    parser.add_argument('--rate', type=float, default=0, help="Replay at this many lines per second (default: as fast as possible).")
+    parser.add_argument('--no-micro', action='store_true', help="Only run the replay.")
+    parser.add_argument('--startup', action='store_true', help="Only time the startup of each entry path.")
+    parser.add_argument('--bulk', action='store_true', help="Also time the offline analyzer per number of processes.")
+    parser.add_argument('--templates', action='store_true', help="Only time capturing and cloning prefix templates.")
+    parser.add_argument('--output', help="Write the JSON results to this file instead of stdout.")
+    args = parser.parse_args()
+
+    callback = lambda message: print(message, file=sys.stderr)
+    if args.startup:
+        results = {'timestamp': time.time(), 'python': platform.python_version(), 'startup': startup_benchmarks(callback=callback)}
+    elif args.templates:
+        results = {'timestamp': time.time(), 'python': platform.python_version(), 'templates': template_benchmarks(callback=callback)}
+    else:
+        results = run(args.log, args.lines, args.seed, args.scheduler, args.rate, not args.no_micro, args.bulk, callback=callback)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
@@ -0,0 +1,174 @@
+import os
+import re
+import mmap
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .config import current_config
+from .database import rule_index
+
+# A Wine debug line of one of the classes, found directly in the mapped file.
+DEBUG_LINE = re.compile(rb'^[ \t]*(?:\d+\.\d+:)?(?:[0-9a-fA-F]{4,8}:){0,2}(err|fixme|warn|trace):([^:\s]*):[^\n]*', re.MULTILINE)
+
+CHUNK_BYTES = 32 * 1024 * 1024
+# Chunks are at least this large, so small files do not become many tiny tasks.
+MIN_CHUNK_BYTES = 1024 * 1024
+COUNT_BLOCK = 1024 * 1024
+
+# The engine of a pool worker, created once per process.
+_engine = None
+
+def _worker_engine():
+    global _engine
+    if _engine is None:
+        from .engine import AIEngine
+        # Rule lookups only: there is no application to wait for an LLM answer.
+        _engine = AIEngine({**current_config().get('ai_engine', {}), 'llm_enabled': False})
+    return _engine
+
+def split_chunks(path, chunk_bytes=CHUNK_BYTES):
+    """
+    Splits a file into (start, end) byte ranges of about `chunk_bytes`, each
+    ending just after a newline (or at the end of the file).
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    chunks = []
+    with open(path, 'rb') as log, mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        start = 0
+        while start < size:
+            end = data.find(b'\n', min(start + chunk_bytes, size) - 1)
+            end = size if end < 0 else end + 1
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+def analyze_chunk(path, start, end, classes=('err', 'fixme')):
+    """
+    Looks up the rules for the Wine debug lines in a byte range of a log, as
+    the service does for a live process: lines of the classes in `classes`,
+    errors always, other classes only when rules exist for their channel.
+
+    Returns:
+        dict: 'lines', 'errors' (lines looked up), 'unmatched' (of those,
+        lines no rule matched) and 'fixes', {(tool, argument): fix} where a
+        fix has 'confidence', 'occurrences', 'first_offset', 'first_line'
+        and 'patterns'.
+    """
+    engine = _worker_engine()
+    matcher = rule_index.matcher()
+    classes = {line_class.encode() for line_class in classes}
+    result = {'lines': 0, 'errors': 0, 'unmatched': 0, 'fixes': {}}
+    fixes = result['fixes']
+    with open(path, 'rb') as log, mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for block in range(start, end, COUNT_BLOCK):
+            result['lines'] += data[block:min(block + COUNT_BLOCK, end)].count(b'\n')
+
+        for match in DEBUG_LINE.finditer(data, start, end):
+            line_class, channel = match.group(1), match.group(2)
+            if line_class not in classes:
+                continue
+            if line_class != b'err' and not matcher.bucket(line_class.decode(), channel.decode('ascii', 'replace')).rules:
+                continue
+            line = match.group(0).decode('utf-8', 'replace')
+            result['errors'] += 1
+            rules = engine.find_rules(line)
+            if not rules:
+                result['unmatched'] += 1
+                continue
+            for rule in rules:
+                fix = fixes.get((rule['type'], rule['argument']))
+                if fix is None:
+                    fix = fixes[(rule['type'], rule['argument'])] = {
+                        'confidence': 0.0, 'occurrences': 0, 'first_offset': match.start(),
+                        'first_line': line.strip(), 'patterns': [],
+                    }
+                fix['confidence'] = max(fix['confidence'], rule['confidence'])
+                fix['occurrences'] += 1
+                if rule['pattern'] not in fix['patterns']:
+                    fix['patterns'].append(rule['pattern'])
+    return result
+
+def _analyze_task(task):
+    path, start, end, classes = task
+    return path, analyze_chunk(path, start, end, classes)
+
+def merge_results(results, paths):
+    """
+    Merges chunk results into one report. A fix's first occurrence is the
+    earliest in the order of `paths`, then by offset.
+    """
+    order = {path: index for index, path in enumerate(paths)}
+    report = {'lines': 0, 'errors': 0, 'unmatched': 0, 'fixes': {}}
+    for path, result in results:
+        for key in ('lines', 'errors', 'unmatched'):
+            report[key] += result[key]
+        for (tool, argument), fix in result['fixes'].items():
+            merged = report['fixes'].get((tool, argument))
+            if merged is None:
+                report['fixes'][(tool, argument)] = {'tool': tool, 'argument': argument, **fix, 'first_file': path}
+                continue
+            merged['confidence'] = max(merged['confidence'], fix['confidence'])
+            merged['occurrences'] += fix['occurrences']
+            merged['patterns'] += [pattern for pattern in fix['patterns'] if pattern not in merged['patterns']]
+            if (order[path], fix['first_offset']) < (order[merged['first_file']], merged['first_offset']):
+                merged.update(first_file=path, first_offset=fix['first_offset'], first_line=fix['first_line'])
+    report['fixes'] = sorted(report['fixes'].values(), key=lambda fix: (-fix['occurrences'], -fix['confidence']))
+    return report
+
+def analyze_logs(paths, workers=None, chunk_bytes=CHUNK_BYTES, classes=None, callback=None):
+    """
+    Analyzes recorded Wine logs offline. The files are memory-mapped and
+    split at line boundaries, and the chunks are analyzed on a pool of
+    `workers` processes (by default one per core). Each worker maps only
+    its own range, so memory use does not grow with the size of the logs.
+
+    Returns:
+        dict: 'files', 'bytes', 'chunks', 'lines', 'errors', 'unmatched',
+        'seconds', 'lines_per_second' and 'fixes', the suggested fixes
+        (with 'tool', 'argument', 'confidence', 'occurrences', 'patterns',
+        and where they were first seen: 'first_file', 'first_offset' and
+        'first_line'), most frequent first.
+    """
+    callback = callback or (lambda message: None)
+    workers = workers or os.cpu_count() or 1
+    if classes is None:
+        classes = current_config().get('log_filter', {}).get('classes', ('err', 'fixme'))
+    started = time.perf_counter()
+
+    total = sum(os.path.getsize(path) for path in paths)
+    # Enough chunks to keep every worker busy, but not so small that task
+    # overhead dominates.
+    chunk_bytes = max(min(chunk_bytes, total // (workers * 4) + 1), MIN_CHUNK_BYTES)
+    tasks = []
+    for path in paths:
+        for start, end in split_chunks(path, chunk_bytes):
+            tasks.append((path, start, end, tuple(classes)))
+    callback(f"Analyzing {total >> 20} MB in {len(tasks)} chunks on {workers} processes...")
+
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_analyze_task, tasks))
+    else:
+        results = [_analyze_task(task) for task in tasks]
+
+    report = merge_results(results, paths)
+    seconds = time.perf_counter() - started
+    report.update({
+        'files': len(paths),
+        'bytes': total,
+        'chunks': len(tasks),
+        'seconds': round(seconds, 3),
+        'lines_per_second': round(report['lines'] / seconds) if seconds else 0,
+    })
+    return report
+
+if __name__ == '__main__':
+    import sys
+
+    # Example usage: python -m winrunai.bulk wine.log
+    report = analyze_logs(sys.argv[1:], callback=print)
+    print(f"{report['lines']} lines, {report['errors']} looked up, {report['unmatched']} without a rule, in {report['seconds']}s")
+    for fix in report['fixes']:
+        print(f"{fix['occurrences']:8d}  {fix['tool']} {fix['argument'].splitlines()[0]}  (first at {fix['first_file']}:{fix['first_offset']})")
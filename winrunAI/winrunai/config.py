@@ -1,3 +1,4 @@
+import threading
 import yaml
 from pathlib import Path
 
@@ -6,12 +7,178 @@ CONFIG_FILE = Path(__file__).parent / "config.yml"
 DEFAULT_CONFIG = {
     'ai_engine': {
         'auto_apply_confidence_threshold': 0.9,
+        'suggestion_cache_size': 4096,
+        'suggestion_cache_policy': 'lru',
+        'llm_enabled': False,
+        'correlation_window': 60,
+        'outcome_half_life_days': 30,
+        'outcome_prior_weight': 20,
     },
     'service': {
         'scan_interval': 5,
+        'analysis_workers': 4,
+        'analysis_queue_size': 1024,
+        'process_events': 'auto',
+        'max_parallel_fixes': 4,
+        'metrics_interval': 2,
+        'profile': False,
+        'config_check_interval': 1.0,
+    },
+    'log_filter': {
+        'window': 60,
+        'summary_interval': 10,
+        'classes': ['err', 'fixme'],
+    },
+    'events': {
+        'segment_bytes': 1024 * 1024,
+        'max_bytes': 64 * 1024 * 1024,
+        'max_age_days': 30,
+        'error_max_age_days': 7,
+    },
+    'templates': {
+        'enabled': False,
+        'max_bytes': 8 * 1024 * 1024 * 1024,
+        'max_template_bytes': 2 * 1024 * 1024 * 1024,
+        'clone_method': 'auto',
+    },
+    'logging': {
+        'max_bytes': 10 * 1024 * 1024,
+        'backup_count': 3,
+        'flush_interval': 0.5,
+        'queue_size': 100000,
+        'overflow': 'drop',
     }
 }
 
+class ConfigError(ValueError):
+    """config.yml cannot be parsed or has invalid settings."""
+
+def _number(low=None, high=None, integer=False):
+    def check(value):
+        if isinstance(value, bool) or not isinstance(value, int if integer else (int, float)):
+            return f"must be {'an integer' if integer else 'a number'}"
+        if (low is not None and value < low) or (high is not None and value > high):
+            return f"must be between {low} and {high}" if high is not None else f"must be at least {low}"
+    return check
+
+def _choice(*choices):
+    def check(value):
+        if value not in choices:
+            return f"must be one of {', '.join(map(str, choices))}"
+    return check
+
+def _subset(*choices):
+    def check(value):
+        if not isinstance(value, list) or any(item not in choices for item in value):
+            return f"must be a list of {', '.join(map(str, choices))}"
+    return check
+
+def _boolean(value):
+    if not isinstance(value, bool):
+        return "must be true or false"
+
+# Checks for the known settings; other keys are accepted as they are.
+SCHEMA = {
+    'ai_engine': {
+        'auto_apply_confidence_threshold': _number(0.0, 1.1),
+        'suggestion_cache_size': _number(1, integer=True),
+        'suggestion_cache_policy': _choice('lru', 'fifo'),
+        'llm_enabled': _boolean,
+        'correlation_window': _number(0),
+        'outcome_half_life_days': _number(0),
+        'outcome_prior_weight': _number(0),
+    },
+    'service': {
+        'scan_interval': _number(0.1),
+        'analysis_workers': _number(1, integer=True),
+        'analysis_queue_size': _number(1, integer=True),
+        'process_events': _choice('auto', 'netlink', 'polling'),
+        'max_parallel_fixes': _number(1, integer=True),
+        'metrics_interval': _number(0.1),
+        'profile': _boolean,
+        'config_check_interval': _number(0.1),
+    },
+    'log_filter': {
+        'window': _number(0),
+        'summary_interval': _number(0),
+        'classes': _subset('err', 'fixme', 'warn', 'trace'),
+    },
+    'events': {
+        'segment_bytes': _number(4096, integer=True),
+        'max_bytes': _number(0, integer=True),
+        'max_age_days': _number(0),
+        'error_max_age_days': _number(0),
+    },
+    'templates': {
+        'enabled': _boolean,
+        'max_bytes': _number(0, integer=True),
+        'max_template_bytes': _number(0, integer=True),
+        'clone_method': _choice('auto', 'reflink', 'hardlink', 'copy'),
+    },
+    'logging': {
+        'max_bytes': _number(0, integer=True),
+        'backup_count': _number(0, integer=True),
+        'flush_interval': _number(0),
+        'queue_size': _number(1, integer=True),
+        'overflow': _choice('drop', 'block'),
+    },
+}
+
+# Settings that take effect as soon as the configuration is reloaded. The
+# others are read once, when the service starts.
+LIVE_SETTINGS = {
+    ('ai_engine', 'auto_apply_confidence_threshold'),
+    ('ai_engine', 'correlation_window'),
+    ('log_filter', 'classes'),
+    ('service', 'scan_interval'),
+    ('service', 'metrics_interval'),
+}
+
+def validate_config(data):
+    """
+    Checks a parsed configuration.
+
+    Returns:
+        dict: The configuration (an empty file gives an empty one).
+
+    Raises:
+        ConfigError: With every problem found, one per line.
+    """
+    if data is None:
+        return {}
+    if not isinstance(data, dict):
+        raise ConfigError("The configuration must be a mapping of sections")
+    problems = []
+    for section, checks in SCHEMA.items():
+        values = data.get(section)
+        if values is None:
+            continue
+        if not isinstance(values, dict):
+            problems.append(f"{section}: must be a mapping")
+            continue
+        for key, check in checks.items():
+            if key in values:
+                problem = check(values[key])
+                if problem:
+                    problems.append(f"{section}.{key}: {problem} (got {values[key]!r})")
+    if problems:
+        raise ConfigError("\n".join(problems))
+    return data
+
+def load_config(path=CONFIG_FILE):
+    """
+    Reads and validates a configuration file.
+
+    Raises:
+        ConfigError: If the file cannot be read, is not valid YAML or has
+                     invalid settings.
+    """
+    try:
+        with open(path, 'r') as f:
+            return validate_config(yaml.safe_load(f))
+    except (yaml.YAMLError, OSError) as e:
+        raise ConfigError(str(e)) from e
+
 def get_config():
     """
     Loads the configuration from config.yml.
@@ -21,10 +188,8 @@ def get_config():
         return DEFAULT_CONFIG
 
     try:
-        with open(CONFIG_FILE, 'r') as f:
-            config = yaml.safe_load(f)
-        return config
-    except (yaml.YAMLError, IOError) as e:
+        return load_config()
+    except ConfigError as e:
         print(f"Warning: Could not load or parse config.yml: {e}")
         print("Using default configuration.")
         return DEFAULT_CONFIG
@@ -32,6 +197,111 @@ def get_config():
 # Load config once at startup
 config = get_config()
 
+# The configuration in effect. reload_config() replaces it with a new dict
+# instead of changing it, so readers need no lock: current_config() always
+# returns a complete snapshot. Treat it as read-only.
+_current = config
+
+def current_config():
+    """Returns the current configuration snapshot."""
+    return _current
+
+def changed_settings(old, new):
+    """Returns the (section, key) pairs whose values differ between two configurations."""
+    changed = set()
+    for section in set(old) | set(new):
+        old_values, new_values = old.get(section), new.get(section)
+        if not isinstance(old_values, dict) or not isinstance(new_values, dict):
+            if old_values != new_values:
+                changed.add((section, None))
+            continue
+        for key in set(old_values) | set(new_values):
+            if old_values.get(key) != new_values.get(key):
+                changed.add((section, key))
+    return changed
+
+def reload_config(path=CONFIG_FILE):
+    """
+    Re-reads the configuration file and, if it is valid, makes it current.
+
+    Returns:
+        set: The (section, key) pairs that changed.
+
+    Raises:
+        ConfigError: If the file is invalid; the current configuration is kept.
+    """
+    global _current
+    new = load_config(path)
+    changed = changed_settings(_current, new)
+    _current = new
+    return changed
+
+class ConfigWatcher:
+    """
+    Reloads the configuration when config.yml changes.
+
+    A background thread checks the file's mtime and size every `interval`
+    seconds. After a successful reload, `on_reload(changed)` is called with
+    the changed settings; when the new file is invalid, `on_error(error)`
+    is called and the previous configuration stays in effect.
+    """
+    def __init__(self, path=CONFIG_FILE, interval=1.0, on_reload=None, on_error=None):
+        self.path = Path(path)
+        self.interval = interval
+        self.on_reload = on_reload
+        self.on_error = on_error
+        self._lock = threading.Lock()
+        self._signature = self._stat()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _stat(self):
+        try:
+            stat = self.path.stat()
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="config-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            if self._stat() != self._signature:
+                try:
+                    self.reload()
+                except ConfigError:
+                    pass # Reported through on_error
+
+    def reload(self):
+        """
+        Reloads the configuration now.
+
+        Returns:
+            set: The changed settings.
+
+        Raises:
+            ConfigError: If the file is invalid.
+        """
+        with self._lock:
+            self._signature = self._stat()
+            try:
+                changed = reload_config(self.path)
+            except ConfigError as e:
+                if self.on_error:
+                    self.on_error(e)
+                raise
+        if self.on_reload:
+            self.on_reload(changed)
+        return changed
+
 if __name__ == '__main__':
     # Example usage
     print("Loading WinRunAI configuration...")
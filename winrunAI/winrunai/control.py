@@ -0,0 +1,109 @@
+import os
+import sys
+import subprocess
+import contextlib
+from pathlib import Path
+
+# Files shared by the service and its clients. This module stays light: the
+# CLI, the TUI and the service all import it.
+PID_FILE = Path(os.environ.get("TMPDIR", "/tmp")) / "winrunai.pid"
+LOG_FILE = Path(os.environ.get("TMPDIR", "/tmp")) / "winrunai_service.log"
+STATUS_FILE = Path(os.environ.get("TMPDIR", "/tmp")) / "winrunai_status.json"
+SOCKET_FILE = Path(os.environ.get("TMPDIR", "/tmp")) / "winrunai.sock"
+METRICS_SOCKET_FILE = Path(os.environ.get("TMPDIR", "/tmp")) / "winrunai-metrics.sock"
+EVENTS_DIR = Path(os.environ.get("TMPDIR", "/tmp")) / "winrunai_events"
+
+@contextlib.contextmanager
+def private_umask():
+    """
+    Creates files (and sockets) inside the block readable and writable by
+    the owner only, from the start. A chmod after bind() would leave a window
+    in which other users could connect.
+    """
+    previous = os.umask(0o177)
+    try:
+        yield
+    finally:
+        os.umask(previous)
+
+def _pid_exists(pid):
+    try:
+        # Reap it first if it is our own child that already exited.
+        if os.waitpid(pid, os.WNOHANG)[0] == pid:
+            return False
+    except ChildProcessError:
+        pass
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def is_service_running():
+    if not PID_FILE.exists():
+        return False
+    try:
+        pid = int(PID_FILE.read_text())
+        return pid > 0 and _pid_exists(pid)
+    except (ValueError, OSError):
+        return False
+
+def start_service(tui_app=None):
+    """
+    Starts the background service, unless it is already running.
+
+    Returns:
+        True if the service was started.
+    """
+    if is_service_running():
+        if tui_app:
+            tui_app.query_one("#status-display").update("Status: AI is already running.")
+        return False
+
+    command = [sys.executable, "-m", "winrunai.main", "--service"]
+    process = subprocess.Popen(command, start_new_session=True)
+    PID_FILE.write_text(str(process.pid))
+
+    if tui_app:
+        tui_app.query_one("#status-display").update("Status: AI Enabled")
+        tui_app.query_one("#log-viewer").write("AI service started...")
+    return True
+
+def stop_service(tui_app=None):
+    """
+    Stops the background service and removes its files.
+
+    Returns:
+        True if the service was running.
+    """
+    if not PID_FILE.exists():
+        if tui_app:
+            tui_app.query_one("#status-display").update("Status: AI is already stopped.")
+        return False
+
+    import psutil # Only needed here
+
+    running = False
+    try:
+        pid = int(PID_FILE.read_text())
+        if psutil.pid_exists(pid):
+            running = True
+            p = psutil.Process(pid)
+            p.terminate()
+            p.wait(timeout=3)
+    except (ValueError, psutil.NoSuchProcess):
+        pass
+    except psutil.TimeoutExpired:
+        p.kill()
+
+    PID_FILE.unlink(missing_ok=True)
+    STATUS_FILE.unlink(missing_ok=True) # Clean up status file on stop
+    SOCKET_FILE.unlink(missing_ok=True)
+    METRICS_SOCKET_FILE.unlink(missing_ok=True)
+
+    if tui_app:
+        tui_app.query_one("#status-display").update("Status: AI Disabled")
+        tui_app.query_one("#log-viewer").write("AI service stopped.")
+    return running
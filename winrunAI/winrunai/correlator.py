@@ -0,0 +1,75 @@
+import time
+from collections import deque
+
+# Patterns this long get half the weight of a perfectly specific one; a bare
+# 'd3d11.dll' counts for less than a full error message.
+SPECIFICITY_HALF_LENGTH = 8
+
+def specificity(pattern: str) -> float:
+    """Weights a rule's pattern by its length, from 0 (empty) towards 1."""
+    length = len(pattern or '')
+    return length / (length + SPECIFICITY_HALF_LENGTH)
+
+class FixCorrelator:
+    """
+    Collects the rules matched by a process's recent error lines and ranks
+    the fixes they point to.
+
+    Every matched rule counts for its confidence times the specificity of its
+    pattern. Rules that lead to the same fix (e.g. 'd3d11.dll' and 'dxgi.dll'
+    both lead to dxvk) add up, so a fix backed by several errors ranks above
+    one backed by a single error. Matches older than `window` seconds, or
+    beyond the last `max_matches`, no longer count.
+    """
+    def __init__(self, window=60.0, max_matches=256):
+        self.window = window
+        self._matches = deque(maxlen=max_matches)  # (time, rule)
+
+    def add(self, rules, now=None):
+        """Registers the rules matched by one error line."""
+        now = time.monotonic() if now is None else now
+        for rule in rules:
+            self._matches.append((now, rule))
+
+    def ranked(self, now=None):
+        """
+        Returns the fixes supported by the matches in the window, best first,
+        as a list of dicts with 'type', 'argument', 'confidence' (of the most
+        confident rule), 'score' and 'patterns'. Ties keep the order in which
+        the fixes were first seen.
+        """
+        now = time.monotonic() if now is None else now
+        while self._matches and now - self._matches[0][0] > self.window:
+            self._matches.popleft()
+
+        fixes = {}
+        for _, rule in self._matches:
+            fix = fixes.get((rule['type'], rule['argument']))
+            if fix is None:
+                fix = fixes[(rule['type'], rule['argument'])] = {
+                    'type': rule['type'],
+                    'argument': rule['argument'],
+                    'confidence': 0.0,
+                    'score': 0.0,
+                    'patterns': [],
+                }
+            fix['confidence'] = max(fix['confidence'], rule['confidence'])
+            fix['score'] += rule['confidence'] * specificity(rule['pattern'])
+            if rule['pattern'] not in fix['patterns']:
+                fix['patterns'].append(rule['pattern'])
+
+        return sorted(fixes.values(), key=lambda fix: fix['score'], reverse=True)
+
+    def __len__(self):
+        return len(self._matches)
+
+if __name__ == '__main__':
+    # Example usage:
+    correlator = FixCorrelator()
+    correlator.add([{'pattern': 'd3d11.dll', 'type': 'winetricks', 'argument': 'dxvk', 'confidence': 0.95}])
+    correlator.add([
+        {'pattern': 'msvcp140.dll', 'type': 'winetricks', 'argument': 'vcrun2019', 'confidence': 0.95},
+        {'pattern': 'dxgi.dll', 'type': 'winetricks', 'argument': 'dxvk', 'confidence': 0.95},
+    ])
+    for fix in correlator.ranked():
+        print(f"{fix['score']:.2f}  {fix['type']} {fix['argument']}  (from {', '.join(fix['patterns'])})")
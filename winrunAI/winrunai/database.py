@@ -1,26 +1,40 @@
+import os
 import sqlite3
+import threading
+import time
 from pathlib import Path
 
+from .config import current_config
+from .matcher import BucketedMatcher, rule_scope
+
 # In a real app, this might be in a user data directory
 DB_FILE = Path(__file__).parent / "knowledge.db"
 
-def initialize_database():
-    """
-    Initializes the SQLite database and creates the rules table if it doesn't exist.
-    Populates the database with some initial rules.
-    """
-    # For this task, we want to re-initialize to add the new rule.
-    # In a real app, you'd use migrations.
-    if DB_FILE.exists():
-        DB_FILE.unlink()
+# Built-in rules shipped with WinRunAI, in priority order.
+BUILTIN_RULES = [
+    ('d3dx9_43.dll', 'winetricks', 'd3dx9_43'),
+    ('d3dcompiler_43.dll', 'winetricks', 'd3dcompiler_43'),
+    ('msvcp140.dll', 'winetricks', 'vcrun2019'),
+    ('vcruntime140.dll', 'winetricks', 'vcrun2019'),
+    ('d3d11.dll', 'winetricks', 'dxvk'),
+    ('dxgi.dll', 'winetricks', 'dxvk'),
+    ('err:mscoree:LoadLibraryShim error reading registry key for installroot', 'winetricks', 'dotnet40'),
+    ('err:ole:CoGetClassObject class', 'winetricks', 'corefonts'),
+    # Registry fix
+    ('fixme:d3d:wined3d_select_feature_level', 'regedit', '[HKEY_CURRENT_USER\\Software\\Wine\\Direct3D]\n"MaxVersionGL"=dword:00030002'),
+]
 
-    print("Initializing new knowledge base...")
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+def _seed_rules(cursor, rules):
+    """Inserts rules that are not in the table yet, keeping user edits intact."""
+    cursor.executemany(
+        'INSERT OR IGNORE INTO rules (error_pattern, fix_type, fix_argument) VALUES (?, ?, ?)',
+        rules
+    )
 
-    # Create table
+def _migration_1(cursor):
+    """Creates the rules table with its generation counter and the built-in rules."""
     cursor.execute('''
-        CREATE TABLE rules (
+        CREATE TABLE IF NOT EXISTS rules (
             id INTEGER PRIMARY KEY,
             error_pattern TEXT NOT NULL UNIQUE,
             fix_type TEXT NOT NULL,
@@ -29,50 +43,341 @@ def initialize_database():
         )
     ''')
 
-    # Insert initial rules
-    initial_rules = [
-        ('d3dx9_43.dll', 'winetricks', 'd3dx9_43'),
-        ('d3dcompiler_43.dll', 'winetricks', 'd3dcompiler_43'),
-        ('msvcp140.dll', 'winetricks', 'vcrun2019'),
-        ('vcruntime140.dll', 'winetricks', 'vcrun2019'),
-        ('d3d11.dll', 'winetricks', 'dxvk'),
-        ('dxgi.dll', 'winetricks', 'dxvk'),
-        ('err:mscoree:LoadLibraryShim error reading registry key for installroot', 'winetricks', 'dotnet40'),
-        ('err:ole:CoGetClassObject class', 'winetricks', 'corefonts'),
-        # New rule for a registry fix
-        ('fixme:d3d:wined3d_select_feature_level', 'regedit', '[HKEY_CURRENT_USER\\Software\\Wine\\Direct3D]\n"MaxVersionGL"=dword:00030002'),
-    ]
-    cursor.executemany('INSERT INTO rules (error_pattern, fix_type, fix_argument) VALUES (?, ?, ?)', initial_rules)
-
-    conn.commit()
-    conn.close()
-    print(f"Database created at {DB_FILE}")
+    # A generation counter bumped by triggers on every change to the rules
+    # table, so the in-memory rule index knows when it has to be rebuilt.
+    cursor.execute('CREATE TABLE IF NOT EXISTS rules_meta (generation INTEGER NOT NULL)')
+    cursor.execute('INSERT INTO rules_meta (generation) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM rules_meta)')
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS rules_{event.lower()}_generation AFTER {event} ON rules
+            BEGIN
+                UPDATE rules_meta SET generation = generation + 1;
+            END
+        ''')
 
-def find_fix_for_error(error_string: str):
+    _seed_rules(cursor, BUILTIN_RULES)
+
+def _migration_2(cursor):
+    """Records the fixes applied to each WINEPREFIX, so they survive restarts."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS applied_fixes (
+            wineprefix TEXT NOT NULL,
+            tool TEXT NOT NULL,
+            argument TEXT NOT NULL,
+            applied_at REAL NOT NULL,
+            PRIMARY KEY (wineprefix, tool, argument)
+        )
+    ''')
+
+def _migration_3(cursor):
+    """
+    Scopes rules to a Wine debug class and channel (NULL for any), so each
+    line is only checked against the rules for its kind of message.
+    """
+    cursor.execute('ALTER TABLE rules ADD COLUMN line_class TEXT')
+    cursor.execute('ALTER TABLE rules ADD COLUMN channel TEXT')
+    rows = cursor.execute('SELECT id, error_pattern FROM rules').fetchall()
+    cursor.executemany(
+        'UPDATE rules SET line_class = ?, channel = ? WHERE id = ?',
+        [(*rule_scope(pattern), rule_id) for rule_id, pattern in rows if rule_scope(pattern) != (None, None)]
+    )
+    # Missing DLLs are reported by the loader, as err:module lines.
+    cursor.executemany(
+        "UPDATE rules SET line_class = 'err', channel = 'module' WHERE error_pattern = ?",
+        [(pattern,) for pattern, _, _ in BUILTIN_RULES if pattern.endswith('.dll')]
+    )
+
+def _migration_4(cursor):
+    """Caches the imports of scanned PE files by content hash (see pescan)."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pe_imports (
+            sha256 TEXT PRIMARY KEY,
+            bits INTEGER NOT NULL,
+            imports TEXT NOT NULL,
+            delay_imports TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pe_files (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            sha256 TEXT NOT NULL
+        )
+    ''')
+
+def _migration_5(cursor):
+    """
+    Records the outcome of every fix run, and keeps decayed success and
+    failure weights on the rules, from which their effective confidence is
+    derived (see outcomes).
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fix_outcomes (
+            id INTEGER PRIMARY KEY,
+            wineprefix TEXT NOT NULL,
+            tool TEXT NOT NULL,
+            argument TEXT NOT NULL,
+            patterns TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            duration REAL NOT NULL,
+            exit_code INTEGER,
+            status TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS fix_outcomes_prefix ON fix_outcomes (wineprefix, status)')
+    cursor.execute('ALTER TABLE rules ADD COLUMN success_weight REAL NOT NULL DEFAULT 0')
+    cursor.execute('ALTER TABLE rules ADD COLUMN failure_weight REAL NOT NULL DEFAULT 0')
+    cursor.execute('ALTER TABLE rules ADD COLUMN outcome_time REAL')
+
+# Schema migrations, applied in order. The database's `user_version` pragma
+# records how many of them have been applied. Never edit a released entry;
+# append a new one instead (including for new built-in rules).
+MIGRATIONS = [
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+    _migration_5,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def connect(db_file=DB_FILE, **kwargs):
     """
-    Queries the database for a fix based on a substring match in the error string.
+    Opens a connection to the knowledge base.
+
+    The database runs in WAL mode, so readers in the TUI and the service never
+    block each other or a writer. Extra keyword arguments are passed on to
+    sqlite3.connect.
+    """
+    return sqlite3.connect(db_file, timeout=10.0, **kwargs)
+
+def initialize_database(db_file=DB_FILE):
     """
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    Brings the knowledge base up to the current schema version.
 
-    cursor.execute("SELECT error_pattern, fix_type, fix_argument, confidence FROM rules")
-    all_rules = cursor.fetchall()
+    Only the migrations that are missing are applied, inside a single write
+    transaction, so several processes starting at the same time are safe.
+    When the database is already current this is a single pragma read.
 
-    conn.close()
+    Returns:
+        The number of migrations that were applied.
+    """
+    conn = connect(db_file, isolation_level=None)
+    try:
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            return 0
 
-    for pattern, fix_type, fix_arg, confidence in all_rules:
-        if pattern.lower() in error_string.lower():
-            return {
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Re-read under the write lock in case another process migrated first.
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            cursor = conn.cursor()
+            for migration in MIGRATIONS[version:]:
+                migration(cursor)
+            if version < SCHEMA_VERSION:
+                conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+    finally:
+        conn.close()
+
+    rule_index.invalidate()
+    return max(SCHEMA_VERSION - version, 0)
+
+def decayed(weight: float, since: float, now: float, half_life: float) -> float:
+    """A weight recorded at `since`, halved for every `half_life` seconds until `now`."""
+    if not weight or since is None or half_life <= 0:
+        return weight
+    return weight * 0.5 ** (max(now - since, 0.0) / half_life)
+
+def effective_confidence(confidence: float, successes: float, failures: float, prior_weight: float) -> float:
+    """
+    A rule's confidence adjusted by the outcomes of its fixes: the stored
+    confidence counts as `prior_weight` observations, and every (decayed)
+    success or failure as one more.
+    """
+    total = prior_weight + successes + failures
+    if total <= 0:
+        return confidence
+    return (prior_weight * confidence + successes) / total
+
+class RuleIndex:
+    """
+    An in-memory index of the rules table.
+
+    The rules are loaded once and compiled into a BucketedMatcher. The index keeps
+    a read connection open and checks, at most once per `check_interval`
+    seconds, whether the rules table has changed (or the database file has been
+    replaced). If so, the matcher is rebuilt before the next lookup.
+
+    A rule's 'confidence' is its effective confidence, adjusted by the recorded
+    outcomes of its fixes when the index is built, so lookups pay nothing for
+    it; the stored value is kept as 'base_confidence'.
+    """
+    def __init__(self, db_file=DB_FILE, check_interval=1.0):
+        self.db_file = Path(db_file)
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._conn = None
+        self._file_id = None
+        self._data_version = None
+        self._generation = None
+        self._next_check = 0.0
+        self._matcher = BucketedMatcher([])
+
+    def _connect(self):
+        if self._conn is not None:
+            self._conn.close()
+        self._conn = connect(self.db_file, check_same_thread=False)
+        stat = os.stat(self.db_file)
+        self._file_id = (stat.st_dev, stat.st_ino)
+        self._data_version = None
+        self._generation = None
+
+    def _refresh(self):
+        """Reloads the rules if the table changed since the last check."""
+        try:
+            stat = os.stat(self.db_file)
+        except FileNotFoundError:
+            return
+        if self._conn is None or (stat.st_dev, stat.st_ino) != self._file_id:
+            self._connect()
+
+        cursor = self._conn.cursor()
+        data_version = cursor.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version:
+            return
+
+        try:
+            generation = cursor.execute('SELECT generation FROM rules_meta').fetchone()[0]
+            if generation == self._generation:
+                self._data_version = data_version
+                return
+            cursor.execute(
+                "SELECT error_pattern, fix_type, fix_argument, confidence, line_class, channel, "
+                "success_weight, failure_weight, outcome_time FROM rules ORDER BY id"
+            )
+        except sqlite3.OperationalError:
+            # The database has not been migrated yet; keep the current rules.
+            return
+        settings = current_config().get('ai_engine', {})
+        half_life = settings.get('outcome_half_life_days', 30) * 86400
+        prior_weight = settings.get('outcome_prior_weight', 20)
+        now = time.time()
+        rules = [
+            {
                 'pattern': pattern,
                 'type': fix_type,
                 'argument': fix_arg,
-                'confidence': confidence
+                'confidence': effective_confidence(
+                    confidence,
+                    decayed(successes, outcome_time, now, half_life),
+                    decayed(failures, outcome_time, now, half_life),
+                    prior_weight
+                ),
+                'base_confidence': confidence,
+                'line_class': line_class,
+                'channel': channel
             }
+            for pattern, fix_type, fix_arg, confidence, line_class, channel, successes, failures, outcome_time in cursor.fetchall()
+        ]
+        self._matcher = BucketedMatcher(rules)
+        self._generation = generation
+        self._data_version = data_version
+
+    def matcher(self):
+        """Returns the current BucketedMatcher, rebuilding it first if it is stale."""
+        now = time.monotonic()
+        if now >= self._next_check:
+            with self._lock:
+                if now >= self._next_check:
+                    self._refresh()
+                    self._next_check = now + self.check_interval
+        return self._matcher
+
+    def invalidate(self):
+        """Forces a change check on the next lookup."""
+        self._next_check = 0.0
+
+# Shared index used by find_fix_for_error.
+rule_index = RuleIndex()
+
+def find_fix_for_error(error_string: str):
+    """
+    Looks up a fix based on a substring match in the error string.
+
+    The first rule (in table order) that applies to the line's debug class and
+    channel and whose pattern occurs in it wins. Matching is done against the
+    cached rule index.
+    """
+    rule = rule_index.matcher().first_match(error_string)
+    if rule is None:
+        return None
+    return dict(rule)
+
+def find_fixes_for_error(error_string: str):
+    """
+    Returns every rule that applies to the line and whose pattern occurs in
+    it, in table order, as a list of dicts.
+    """
+    return [dict(rule) for rule in rule_index.matcher().all_matches(error_string)]
+
+def add_rule(error_pattern: str, fix_type: str, fix_argument: str, confidence: float = 0.95, line_class: str = None, channel: str = None):
+    """
+    Adds a rule to the knowledge base, after the existing ones.
+
+    The rule applies to lines of the given Wine debug class and channel
+    (e.g. 'err' and 'module'); without them, the scope is taken from the
+    pattern when it starts with one, like 'err:ole:CoGetClassObject'.
+
+    Returns:
+        True if the rule was added, False if a rule for the pattern exists.
+    """
+    if line_class is None and channel is None:
+        line_class, channel = rule_scope(error_pattern)
+    conn = connect()
+    try:
+        with conn:
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO rules (error_pattern, fix_type, fix_argument, confidence, line_class, channel) VALUES (?, ?, ?, ?, ?, ?)',
+                (error_pattern, fix_type, fix_argument, confidence, line_class, channel)
+            )
+    finally:
+        conn.close()
+    rule_index.invalidate()
+    return cursor.rowcount == 1
+
+def load_applied_fixes(wineprefix: str):
+    """Returns the set of (tool, argument) fixes already applied to a WINEPREFIX."""
+    conn = connect()
+    try:
+        rows = conn.execute(
+            'SELECT tool, argument FROM applied_fixes WHERE wineprefix = ?', (wineprefix,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return set(rows)
 
-    return None
+def record_applied_fix(wineprefix: str, tool: str, argument: str):
+    """Remembers that a fix was applied successfully to a WINEPREFIX."""
+    conn = connect()
+    try:
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO applied_fixes (wineprefix, tool, argument, applied_at) VALUES (?, ?, ?, ?)',
+                (wineprefix, tool, argument, time.time())
+            )
+    finally:
+        conn.close()
 
 if __name__ == '__main__':
-    initialize_database()
+    applied = initialize_database()
+    print(f"Knowledge base at {DB_FILE} is at schema version {SCHEMA_VERSION} ({applied} migration(s) applied).")
 
     test_error = "002c:fixme:d3d:wined3d_select_feature_level software-rendering is not supported"
     fix = find_fix_for_error(test_error)
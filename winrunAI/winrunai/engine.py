@@ -1,7 +1,57 @@
-from .database import find_fix_for_error, initialize_database
+import threading
+from collections import OrderedDict
 
-# Ensure the database exists and is populated when the engine is first imported.
-initialize_database()
+from .correlator import FixCorrelator
+from .database import add_rule, find_fixes_for_error, initialize_database, load_applied_fixes, record_applied_fix, rule_index
+from .llm import LLMFallback, create_backend
+from .logfilter import normalize_error_line
+from .metrics import LINES_MATCHED
+from .outcomes import OutcomeTracker
+from .prefixstate import prefix_states
+
+class SuggestionCache:
+    """
+    A thread-safe, bounded cache of rule lookups keyed by normalized log line.
+
+    Negative results are cached too, since most lines match no rule. The
+    eviction policy is 'lru' (hits refresh an entry) or 'fifo'.
+    """
+    def __init__(self, max_size=4096, policy='lru'):
+        self.max_size = max_size
+        self.refresh_on_hit = policy == 'lru'
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns (found, value)."""
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return False, None
+            if self.refresh_on_hit:
+                self._entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
 
 class AIEngine:
     """
@@ -21,51 +71,189 @@ class AIEngine:
         self.config = config or {}
         self.rule_based_only = self.config.get('llm_enabled', False) is False
 
-    def get_suggestion(self, error_string: str, wineprefix: str):
+        # Apply any missing knowledge base migrations. This is a no-op when the
+        # database is already current.
+        initialize_database()
+
+        self.suggestion_cache = SuggestionCache(
+            max_size=self.config.get('suggestion_cache_size', 4096),
+            policy=self.config.get('suggestion_cache_policy', 'lru')
+        )
+        self._cache_matcher = None
+
+        # Fixes applied (or in progress) per WINEPREFIX, shared by all analysis
+        # workers. Successful fixes are also stored in the knowledge base.
+        self._applied_fixes = {}
+        self._applied_lock = threading.Lock()
+
+        # The outcomes of applied fixes adjust the confidence of their rules.
+        self.outcomes = OutcomeTracker()
+
+        # Errors that no rule matches are handed to a local model, if enabled.
+        self.llm = None
+        if not self.rule_based_only:
+            self.llm = LLMFallback(
+                create_backend(self.config),
+                SuggestionCache(self.config.get('llm_cache_size', 4096)),
+                batch_window=self.config.get('llm_batch_window', 0.05),
+                max_batch=self.config.get('llm_max_batch', 16),
+                timeout=self.config.get('llm_timeout', 5.0),
+                promote_confidence=self.config.get('llm_promote_confidence', 0.9),
+                promote=self.promote_rule
+            )
+
+    def find_rules(self, error_string: str):
+        """
+        Looks up all rules matching an error line, in priority order, through
+        the suggestion cache. The cache is dropped whenever the rule index is
+        rebuilt.
+        """
+        matcher = rule_index.matcher()
+        if matcher is not self._cache_matcher:
+            self.suggestion_cache.clear()
+            self._cache_matcher = matcher
+
+        key = normalize_error_line(error_string)
+        found, rules = self.suggestion_cache.get(key)
+        if not found:
+            rules = tuple(find_fixes_for_error(error_string))
+            self.suggestion_cache.put(key, rules)
+        return rules
+
+    def find_rule(self, error_string: str):
+        """Returns the highest-priority rule matching an error line, or None."""
+        rules = self.find_rules(error_string)
+        return rules[0] if rules else None
+
+    def _fixes_for(self, wineprefix: str):
+        fixes = self._applied_fixes.get(wineprefix)
+        if fixes is None:
+            fixes = self._applied_fixes[wineprefix] = load_applied_fixes(wineprefix)
+        return fixes
+
+    def is_fix_applied(self, wineprefix: str, fix_id: tuple) -> bool:
+        """Checks whether a fix was already applied (or is being applied) to a WINEPREFIX."""
+        with self._applied_lock:
+            return fix_id in self._fixes_for(wineprefix)
+
+    def claim_fix(self, wineprefix: str, fix_id: tuple) -> bool:
+        """
+        Atomically marks a fix as applied to a WINEPREFIX.
+
+        Returns:
+            True if the caller should apply the fix, False if it was already
+            applied (in this or an earlier service run) or is being applied.
+        """
+        with self._applied_lock:
+            fixes = self._fixes_for(wineprefix)
+            if fix_id in fixes:
+                return False
+            fixes.add(fix_id)
+            return True
+
+    def record_fix(self, wineprefix: str, fix_id: tuple):
+        """Persists a fix that was applied successfully."""
+        record_applied_fix(wineprefix, *fix_id)
+
+    def promote_rule(self, rule: dict) -> bool:
+        """Adds a rule learned from the LLM to the knowledge base."""
+        return add_rule(rule['pattern'], rule['type'], rule['argument'], rule['confidence'],
+                        rule.get('line_class'), rule.get('channel'))
+
+    def cache_stats(self):
+        """Returns the suggestion cache's size and hit/miss counters."""
+        return self.suggestion_cache.stats()
+
+    def get_suggestion(self, error_string: str, wineprefix: str, on_late_suggestion=None, correlator: FixCorrelator = None, use_llm=True):
         """
         Analyzes an error string and returns a suggested action plan.
 
-        This currently uses the rule-based expert system. Future versions
-        could integrate an LLM as a fallback.
+        The rule-based expert system is tried first; all matching rules count.
+        If no rule matches and the LLM is enabled, the line is queued for the
+        model; its answer is used right away if it is cached, and otherwise
+        passed to `on_late_suggestion(action_plan)` once the model replies.
 
         Args:
             error_string: The error line from the Wine log.
             wineprefix: The full path to the WINEPREFIX for the application.
+            on_late_suggestion: Called (from another thread) with an action
+                                plan found by the LLM after this call returned.
+            correlator: The FixCorrelator holding the process's recent
+                        matches. The matches for this line are added to it and
+                        the plan covers all fixes in its window, ranked.
+            use_llm: Whether the line may be sent to the LLM when no rule
+                     matches (only errors are).
 
         Returns:
             A dictionary representing the action plan, or None if no suggestion found.
         """
+        if correlator is None:
+            correlator = FixCorrelator()
 
         # 1. Try the rule-based expert system first.
-        fix_rule = find_fix_for_error(error_string)
-
-        if fix_rule:
-            # A high-confidence fix was found. Formulate the action plan.
-            action_plan = {
-                'source': 'Rule-Based System',
-                'description': f"Detected issue with '{fix_rule['pattern']}'. The recommended fix is to install '{fix_rule['argument']}' using '{fix_rule['type']}'.",
-                'confidence': fix_rule['confidence'],
-                'wineprefix': wineprefix,
-                'actions': [
-                    {
-                        'tool': fix_rule['type'],
-                        'argument': fix_rule['argument']
-                    }
-                ]
-            }
-            return action_plan
+        fix_rules = self.find_rules(error_string)
 
-        # 2. (Future) If no rule found, and LLM is enabled, query the LLM.
-        if not self.rule_based_only:
-            # Placeholder for LLM integration
-            # llm_suggestion = self.query_local_llm(error_string)
-            # if llm_suggestion:
-            #     return llm_suggestion
-            pass
+        if fix_rules:
+            LINES_MATCHED.inc()
+            correlator.add(fix_rules)
+            return self.make_action_plan(correlator.ranked(), wineprefix, 'Rule-Based System')
+
+        # 2. If no rule found, and LLM is enabled, query the LLM.
+        if self.llm is not None and use_llm:
+            def answered(llm_rule):
+                if llm_rule and on_late_suggestion:
+                    late = FixCorrelator()
+                    late.add([llm_rule])
+                    action_plan = self.make_action_plan(late.ranked(), wineprefix, 'Local LLM')
+                    if action_plan:
+                        on_late_suggestion(action_plan)
+
+            found, llm_rule = self.llm.request(error_string, answered)
+            if found and llm_rule:
+                correlator.add([llm_rule])
+                return self.make_action_plan(correlator.ranked(), wineprefix, 'Local LLM')
 
         # 3. No suggestion found.
         return None
 
+    def make_action_plan(self, fixes, wineprefix: str, source: str):
+        """
+        Turns ranked fixes (from FixCorrelator.ranked()) into an action plan
+        for a WINEPREFIX, leaving out fixes that are already in place.
+
+        Returns:
+            The action plan, or None if no fix is left.
+        """
+        actions = [
+            {
+                'tool': fix['type'],
+                'argument': fix['argument'],
+                'confidence': fix['confidence'],
+                'score': fix['score'],
+                'patterns': fix['patterns'],
+            }
+            for fix in fixes
+            if not any(prefix_states.is_installed(wineprefix, fix['type'], fix['argument'], pattern) for pattern in fix['patterns'])
+        ]
+        if not actions:
+            return None
+        return {
+            'source': source,
+            'description': describe_actions(actions),
+            'confidence': actions[0]['confidence'],
+            'wineprefix': wineprefix,
+            'actions': actions
+        }
+
+def describe_actions(actions):
+    """Describes the actions of a plan for the log."""
+    patterns = [pattern for action in actions for pattern in action.get('patterns', ()) if pattern]
+    detected = f"Detected issue{'s' if len(patterns) > 1 else ''} with {', '.join(repr(pattern) for pattern in patterns)}. " if patterns else ""
+    steps = [f"install '{action['argument']}' using '{action['tool']}'" for action in actions]
+    if len(steps) == 1:
+        return f"{detected}The recommended fix is to {steps[0]}."
+    return f"{detected}The recommended fixes, in order: {'; '.join(steps)}."
+
 if __name__ == '__main__':
     # Example usage:
     engine = AIEngine()
@@ -0,0 +1,228 @@
+import os
+import json
+import queue
+import socket
+import selectors
+import threading
+from collections import deque
+
+from .control import private_umask
+
+# Recent log records replayed to a client when it connects.
+BACKLOG_SIZE = 500
+
+# A client that falls this far behind is disconnected instead of buffering forever.
+MAX_CLIENT_BUFFER = 4 * 1024 * 1024
+
+# Longest command line a client may send.
+MAX_COMMAND_SIZE = 64 * 1024
+
+def encode_event(event: dict) -> bytes:
+    """Serializes an event as one line of newline-delimited JSON."""
+    return json.dumps(event, separators=(',', ':'), default=str).encode('utf-8') + b'\n'
+
+class _Client:
+    __slots__ = ('sock', 'outbuf', 'inbuf')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.outbuf = bytearray()
+        self.inbuf = bytearray()
+
+class EventServer:
+    """
+    Streams service events to local clients over a Unix domain socket.
+
+    Every event is a JSON object on its own line with a 'type' field: 'log'
+    records carry a log message, 'status' records carry the monitored
+    processes and service statistics and are only sent when they change. A
+    client that connects first receives the latest status and the recent log
+    backlog. Any number of clients (TUIs, CLI tools) can be attached.
+
+    Clients may send commands, one JSON object per line with a 'command'
+    field, e.g. {"command": "reload"}. Each is passed to
+    `on_command(command)`, on the server thread, and the dict it returns is
+    sent back to that client as a 'reply' event.
+    """
+    def __init__(self, path, backlog_size=BACKLOG_SIZE, on_command=None):
+        self.path = str(path)
+        self.on_command = on_command
+        self._selector = selectors.DefaultSelector()
+        self._clients = {}
+        self._queue = queue.SimpleQueue()
+        self._backlog = deque(maxlen=backlog_size)
+        self._status = None
+        self._closed = False
+
+        try:
+            os.unlink(self.path) # Left over from a previous run
+        except FileNotFoundError:
+            pass
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Clients can send commands (such as add_rule): only the owner may connect.
+        with private_umask():
+            self._listener.bind(self.path)
+        self._listener.listen(8)
+        self._listener.setblocking(False)
+        self._selector.register(self._listener, selectors.EVENT_READ, None)
+
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, 'wakeup')
+
+        self._thread = threading.Thread(target=self._run, name="event-server", daemon=True)
+        self._thread.start()
+
+    def publish(self, event: dict):
+        """Queues an event for all connected clients. Safe to call from any thread."""
+        self._queue.put(event)
+        try:
+            self._wakeup_w.send(b'\0')
+        except BlockingIOError:
+            pass
+
+    def publish_log(self, record):
+        """Publishes a LogWriter record (timestamp, message, fields)."""
+        timestamp, message, fields = record
+        self.publish({'type': 'log', 'time': timestamp, 'message': message, **fields})
+
+    def publish_status(self, status: dict):
+        """Publishes a status snapshot if it differs from the previous one."""
+        if status != self._status:
+            self._status = status
+            self.publish({'type': 'status', **status})
+
+    @property
+    def client_count(self):
+        return len(self._clients)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.publish({'type': 'shutdown'})
+        self._thread.join(timeout=2)
+        for client in list(self._clients.values()):
+            client.sock.close()
+        self._listener.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+        self._selector.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _accept(self):
+        try:
+            sock, _ = self._listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        client = self._clients[sock.fileno()] = _Client(sock)
+        self._selector.register(sock, selectors.EVENT_READ, client)
+
+        if self._status is not None:
+            client.outbuf += encode_event({'type': 'status', **self._status})
+        for line in self._backlog:
+            client.outbuf += line
+        self._flush(client)
+
+    def _drop(self, client):
+        self._clients.pop(client.sock.fileno(), None)
+        self._selector.unregister(client.sock)
+        client.sock.close()
+
+    def _flush(self, client):
+        try:
+            sent = client.sock.send(client.outbuf)
+            del client.outbuf[:sent]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._drop(client)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outbuf else 0)
+        self._selector.modify(client.sock, events, client)
+
+    def _read_commands(self, client):
+        """Answers the complete command lines a client sent. Returns False if it was dropped."""
+        while b'\n' in client.inbuf:
+            line, _, rest = bytes(client.inbuf).partition(b'\n')
+            client.inbuf[:] = rest
+            try:
+                command = json.loads(line)
+                name = command['command']
+            except (ValueError, KeyError, TypeError):
+                reply = {'command': None, 'ok': False, 'error': 'Malformed command'}
+            else:
+                try:
+                    reply = {'command': name, **(self.on_command(command) if self.on_command else
+                                                 {'ok': False, 'error': 'Commands are not supported'})}
+                except Exception as e:
+                    reply = {'command': name, 'ok': False, 'error': str(e)}
+            client.outbuf += encode_event({'type': 'reply', **reply})
+        if len(client.inbuf) > MAX_COMMAND_SIZE:
+            self._drop(client)
+            return False
+        if client.outbuf:
+            self._flush(client)
+        return client.sock.fileno() in self._clients
+
+    def _broadcast(self):
+        data = bytearray()
+        stop = False
+        while True:
+            try:
+                event = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            line = encode_event(event)
+            if event['type'] == 'log':
+                self._backlog.append(line)
+            elif event['type'] == 'shutdown':
+                stop = True
+            data += line
+
+        if data:
+            for client in list(self._clients.values()):
+                if len(client.outbuf) + len(data) > MAX_CLIENT_BUFFER:
+                    self._drop(client) # Too slow to keep up
+                    continue
+                client.outbuf += data
+                self._flush(client)
+        return stop
+
+    def _run(self):
+        while True:
+            for key, mask in self._selector.select():
+                if key.data is None:
+                    self._accept()
+                elif key.data == 'wakeup':
+                    try:
+                        while self._wakeup_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    client = key.data
+                    if mask & selectors.EVENT_READ:
+                        # Commands, or EOF when the client left.
+                        try:
+                            data = client.sock.recv(4096)
+                            if not data:
+                                self._drop(client)
+                                continue
+                            client.inbuf += data
+                        except BlockingIOError:
+                            pass
+                        except OSError:
+                            self._drop(client)
+                            continue
+                        if not self._read_commands(client):
+                            continue
+                    if mask & selectors.EVENT_WRITE:
+                        self._flush(client)
+            if self._broadcast():
+                return
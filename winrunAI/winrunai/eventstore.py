@@ -0,0 +1,527 @@
+import os
+import re
+import json
+import time
+import threading
+from pathlib import Path
+
+from .config import config
+from .control import EVENTS_DIR
+
+# Event types written by the service.
+EVENT_TYPES = ('process', 'error', 'suggestion', 'action_start', 'action_end', 'exit')
+
+# Fields with a per-block index, so queries on them skip unrelated blocks.
+INDEXED_FIELDS = ('type', 'pid', 'wineprefix')
+
+SEGMENT_NAME = re.compile(r'^(\d{12})\.seg$')
+
+def _encode(event: dict) -> bytes:
+    return json.dumps(event, separators=(',', ':'), default=str).encode('utf-8') + b'\n'
+
+class _SegmentIndex:
+    """
+    The index of one segment file: the segment is split into blocks of
+    `block_records` records, and for each block the index keeps its byte
+    offset, its time range and which types, pids and prefixes occur in it.
+    """
+    def __init__(self, block_records):
+        self.block_records = block_records
+        self.size = 0
+        self.count = 0
+        self.blocks = []    # [offset, min time, max time, records]
+        self.fields = {field: {} for field in INDEXED_FIELDS}   # field -> value -> [block numbers]
+
+    def add(self, event, length):
+        if not self.blocks or self.blocks[-1][3] >= self.block_records:
+            self.blocks.append([self.size, event['time'], event['time'], 0])
+        block = self.blocks[-1]
+        block[1] = min(block[1], event['time'])
+        block[2] = max(block[2], event['time'])
+        block[3] += 1
+        number = len(self.blocks) - 1
+        for field in INDEXED_FIELDS:
+            value = event.get(field)
+            if value is None:
+                continue
+            numbers = self.fields[field].setdefault(str(value), [])
+            if not numbers or numbers[-1] != number:
+                numbers.append(number)
+        self.size += length
+        self.count += 1
+
+    @property
+    def min_time(self):
+        return min((block[1] for block in self.blocks), default=None)
+
+    @property
+    def max_time(self):
+        return max((block[2] for block in self.blocks), default=None)
+
+    def select(self, since=None, until=None, **values):
+        """
+        Returns the (start, end) byte ranges of the blocks that may hold
+        matching records. `values` maps indexed fields to a set of accepted
+        values, or None for any value.
+        """
+        candidates = None
+        for field, accepted in values.items():
+            if accepted is None:
+                continue
+            numbers = set()
+            for value in accepted:
+                numbers.update(self.fields[field].get(str(value), ()))
+            candidates = numbers if candidates is None else candidates & numbers
+
+        ranges = []
+        for number, (offset, min_time, max_time, _) in enumerate(self.blocks):
+            if candidates is not None and number not in candidates:
+                continue
+            if (since is not None and max_time < since) or (until is not None and min_time > until):
+                continue
+            end = self.blocks[number + 1][0] if number + 1 < len(self.blocks) else self.size
+            if ranges and ranges[-1][1] == offset:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((offset, end))
+        return ranges
+
+    def to_dict(self):
+        return {'size': self.size, 'count': self.count, 'block_records': self.block_records,
+                'blocks': self.blocks, 'fields': self.fields}
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls(data['block_records'])
+        index.size = data['size']
+        index.count = data['count']
+        index.blocks = data['blocks']
+        index.fields = data['fields']
+        return index
+
+    @classmethod
+    def build(cls, path, block_records):
+        """Indexes a segment file by reading it, ignoring a partial last line."""
+        index = cls(block_records)
+        with open(path, 'rb') as segment:
+            for line in segment:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    event = json.loads(line)
+                    event['time']
+                except (ValueError, KeyError, TypeError):
+                    index.size += len(line) # Skip a damaged record
+                    continue
+                index.add(event, len(line))
+        return index
+
+class EventStore:
+    """
+    An append-only store of typed service events, kept as a directory of
+    segment files with one JSON record per line.
+
+    Every record has a 'time' and a 'type' (see EVENT_TYPES), usually a
+    'pid' and 'wineprefix', and any other fields of its type. Records are
+    appended to the active segment with one write each; once it grows past
+    `segment_bytes` it is sealed, and its index is written next to it
+    (NNN.idx). The index lets a query read only the blocks of a segment that
+    can match its time range, types, pids and prefixes.
+
+    Retention keeps the store under `max_bytes` and drops segments older
+    than `max_age_days`. Compaction merges small sealed segments (each
+    service start begins a new one) and drops 'error' records older than
+    `error_max_age_days`, which make up most of the store. Both run when
+    the store is opened and, on a background thread, after each rotation,
+    so recording never waits for them.
+
+    Readers never take the writer's lock: they open the files themselves and
+    only read complete lines, so other processes (the TUI, the CLI) can query
+    a store the service is writing. Pass read_only=True to open a store
+    without appending to it.
+    """
+    def __init__(self, directory, segment_bytes=1024 * 1024, max_bytes=64 * 1024 * 1024,
+                 max_age_days=30, error_max_age_days=7, block_records=64, read_only=False):
+        self.directory = Path(directory)
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.error_max_age_days = error_max_age_days
+        self.block_records = block_records
+        self.read_only = read_only
+
+        self.written = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._fd = None
+        self._active = None         # (segment id, _SegmentIndex) being written
+        self._compact_lock = threading.Lock()   # held while a compaction runs
+        self._compactor = None      # the background compaction thread
+        self._indexes = {}          # segment id -> (mtime_ns, size, _SegmentIndex) of sealed segments
+
+        if not read_only:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # Seal what a previous run left behind, then start a new segment.
+            for segment_id in self._segment_ids():
+                if not self._index_path(segment_id).exists():
+                    index = _SegmentIndex.build(self._segment_path(segment_id), block_records)
+                    os.truncate(self._segment_path(segment_id), index.size) # Drop a partial last line
+                    self._seal(segment_id, index)
+            self.compact()
+            self._open_segment()
+
+    def _segment_path(self, segment_id):
+        return self.directory / f"{segment_id:012d}.seg"
+
+    def _index_path(self, segment_id):
+        return self.directory / f"{segment_id:012d}.idx"
+
+    def _segment_ids(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(int(match.group(1)) for match in map(SEGMENT_NAME.match, names) if match)
+
+    def _open_segment(self):
+        ids = self._segment_ids()
+        segment_id = (ids[-1] + 1) if ids else 1
+        self._fd = os.open(self._segment_path(segment_id), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self._active = (segment_id, _SegmentIndex(self.block_records))
+
+    def _seal(self, segment_id, index):
+        """Writes a segment's index, which marks it as complete."""
+        temporary = self._index_path(segment_id).with_suffix('.idx.tmp')
+        with open(temporary, 'w') as output:
+            json.dump(index.to_dict(), output, separators=(',', ':'))
+        os.replace(temporary, self._index_path(segment_id))
+
+    def record(self, type, pid=None, wineprefix=None, **fields):
+        """
+        Appends an event. A failed write is only counted, so recording
+        cannot disturb analysis.
+
+        Args:
+            type: The event type, e.g. 'error'.
+            pid, wineprefix: The process and prefix the event is about.
+            **fields: Other fields of the event, e.g. line='...'.
+        """
+        if self.read_only:
+            raise ValueError("The event store was opened read-only")
+        event = {'time': time.time(), 'type': type}
+        if pid is not None:
+            event['pid'] = pid
+        if wineprefix is not None:
+            event['wineprefix'] = wineprefix
+        event.update(fields)
+        line = _encode(event)
+
+        rotated = False
+        with self._lock:
+            if self._fd is None:
+                return
+            segment_id, index = self._active
+            try:
+                if index.count and index.size + len(line) > self.segment_bytes:
+                    self._rotate()
+                    rotated = True
+                    segment_id, index = self._active
+                os.write(self._fd, line)
+            except OSError:
+                self.failed += 1
+                return
+            index.add(event, len(line))
+            self.written += 1
+        if rotated:
+            self._compact_in_background()
+
+    __call__ = record
+
+    def _rotate(self):
+        """Seals the active segment and starts a new one. Called with the lock held."""
+        segment_id, index = self._active
+        os.close(self._fd)
+        self._seal(segment_id, index)
+        self._active = None
+        self._open_segment()
+
+    def _compact_in_background(self):
+        """Compacts on a background thread, unless a compaction is already running."""
+        if not self._compact_lock.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self._compact()
+            except OSError:
+                self.failed += 1
+            finally:
+                self._compact_lock.release()
+
+        self._compactor = threading.Thread(target=run, name="event-compaction", daemon=True)
+        self._compactor.start()
+
+    def close(self):
+        """Waits for a running compaction, and seals the active segment."""
+        if self._compactor is not None:
+            self._compactor.join()
+        with self._lock:
+            if self._fd is None:
+                return
+            segment_id, index = self._active
+            os.close(self._fd)
+            self._fd = None
+            if index.count:
+                self._seal(segment_id, index)
+            else:
+                self._segment_path(segment_id).unlink(missing_ok=True)
+            self._active = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def stats(self):
+        sizes = [self._segment_path(segment_id).stat().st_size for segment_id in self._segment_ids()
+                 if self._segment_path(segment_id).exists()]
+        return {'segments': len(sizes), 'bytes': sum(sizes), 'written': self.written, 'failed': self.failed}
+
+    def _load_index(self, segment_id):
+        """
+        Returns (index, sealed) for a segment: the writer's live index for the active
+        segment, the sealed index if it matches the file, or one built by
+        reading the file (a segment still being written by another process).
+        """
+        if self._active and self._active[0] == segment_id:
+            with self._lock:
+                if self._active and self._active[0] == segment_id:
+                    index = self._active[1]
+                    snapshot = _SegmentIndex(index.block_records)
+                    snapshot.size, snapshot.count = index.size, index.count
+                    snapshot.blocks = [list(block) for block in index.blocks]
+                    snapshot.fields = {field: {value: list(numbers) for value, numbers in values.items()}
+                                       for field, values in index.fields.items()}
+                    return snapshot, False
+        try:
+            stat = self._index_path(segment_id).stat()
+        except FileNotFoundError:
+            return _SegmentIndex.build(self._segment_path(segment_id), self.block_records), False
+        cached = self._indexes.get(segment_id)
+        if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2], True
+        with open(self._index_path(segment_id)) as source:
+            index = _SegmentIndex.from_dict(json.load(source))
+        self._indexes[segment_id] = (stat.st_mtime_ns, stat.st_size, index)
+        return index, True
+
+    def query(self, since=None, until=None, types=None, pid=None, wineprefix=None, limit=None, newest_first=False):
+        """
+        Reads the events matching all the given filters, without loading the
+        whole store.
+
+        Args:
+            since, until: Time range, as Unix timestamps.
+            types: Event types to include, e.g. ('error', 'suggestion').
+            pid: Only events about this process.
+            wineprefix: Only events about this prefix.
+            limit: At most this many events.
+            newest_first: Return the most recent events first.
+
+        Returns:
+            list: The events, as dicts.
+        """
+        if isinstance(types, str):
+            types = (types,)
+        filters = {
+            'type': set(types) if types else None,
+            'pid': {pid} if pid is not None else None,
+            'wineprefix': {wineprefix} if wineprefix is not None else None,
+        }
+        results = []
+        ids = self._segment_ids()
+        for segment_id in (reversed(ids) if newest_first else ids):
+            try:
+                events = list(self._read_segment(segment_id, since, until, filters))
+            except FileNotFoundError:
+                continue # Removed by retention or compaction meanwhile
+            if newest_first:
+                events.reverse()
+            results.extend(events)
+            if limit is not None and len(results) >= limit:
+                return results[:limit]
+        return results
+
+    def _read_segment(self, segment_id, since, until, filters):
+        index, sealed = self._load_index(segment_id)
+        with open(self._segment_path(segment_id), 'rb') as segment:
+            size = os.fstat(segment.fileno()).st_size
+            if size < index.size or (sealed and size != index.size):
+                # Rewritten since the index was read: read all of it.
+                index = _SegmentIndex.build(self._segment_path(segment_id), self.block_records)
+            for start, end in index.select(since, until, **filters):
+                segment.seek(start)
+                data = segment.read(end - start)
+                for line in data.splitlines():
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue
+                    if since is not None and event.get('time', 0) < since:
+                        continue
+                    if until is not None and event.get('time', 0) > until:
+                        continue
+                    if any(accepted is not None and event.get(field) not in accepted
+                           for field, accepted in filters.items()):
+                        continue
+                    yield event
+
+    def compact(self, now=None):
+        """
+        Applies retention to the sealed segments and merges small ones.
+
+        Returns:
+            dict: How many segments were removed, and how many were rewritten.
+        """
+        with self._compact_lock:
+            return self._compact(now)
+
+    def _compact(self, now=None):
+        now = time.time() if now is None else now
+        active = self._active   # read once: the writer may rotate meanwhile
+        active = active[0] if active else None
+        sealed = [segment_id for segment_id in self._segment_ids()
+                  if segment_id != active and self._index_path(segment_id).exists()]
+        removed = rewritten = 0
+
+        # Retention: age first, then total size, oldest segments first.
+        indexes = {segment_id: self._load_index(segment_id)[0] for segment_id in sealed}
+        if self.max_age_days:
+            for segment_id in list(sealed):
+                max_time = indexes[segment_id].max_time
+                if max_time is None or max_time < now - self.max_age_days * 86400:
+                    self._remove(segment_id)
+                    sealed.remove(segment_id)
+                    removed += 1
+        if self.max_bytes:
+            total = sum(indexes[segment_id].size for segment_id in sealed)
+            while sealed and total > self.max_bytes:
+                segment_id = sealed.pop(0)
+                total -= indexes[segment_id].size
+                self._remove(segment_id)
+                removed += 1
+
+        # Merge runs of small segments, and rewrite segments with old error lines.
+        error_cutoff = now - self.error_max_age_days * 86400 if self.error_max_age_days else None
+        half = self.segment_bytes // 2
+        runs, run, run_size = [], [], 0
+        for segment_id in sealed:
+            size = indexes[segment_id].size
+            if run and size < half and indexes[run[-1]].size < half and run_size + size <= self.segment_bytes:
+                run.append(segment_id)
+                run_size += size
+            else:
+                runs.append(run)
+                run, run_size = [segment_id], size
+        runs.append(run)
+        for run in runs:
+            if len(run) > 1 or (run and self._has_old_errors(indexes[run[0]], error_cutoff)):
+                self._merge(run, error_cutoff)
+                rewritten += len(run)
+        return {'removed': removed, 'rewritten': rewritten}
+
+    @staticmethod
+    def _has_old_errors(index, error_cutoff):
+        if not error_cutoff:
+            return False
+        return any(index.blocks[number][1] < error_cutoff for number in index.fields['type'].get('error', ()))
+
+    def _remove(self, segment_id):
+        self._index_path(segment_id).unlink(missing_ok=True)
+        self._segment_path(segment_id).unlink(missing_ok=True)
+        self._indexes.pop(segment_id, None)
+
+    def _merge(self, segment_ids, error_cutoff):
+        """
+        Rewrites segments as one, under the last segment's id, so records
+        keep their order. Queries running meanwhile may miss or repeat a few
+        records.
+        """
+        target = segment_ids[-1]
+        index = _SegmentIndex(self.block_records)
+        temporary = self._segment_path(target).with_suffix('.seg.tmp')
+        with open(temporary, 'wb') as output:
+            for segment_id in segment_ids:
+                with open(self._segment_path(segment_id), 'rb') as segment:
+                    for line in segment:
+                        try:
+                            event = json.loads(line)
+                            event['time']
+                        except (ValueError, KeyError, TypeError):
+                            continue
+                        if error_cutoff and event.get('type') == 'error' and event['time'] < error_cutoff:
+                            continue
+                        output.write(line)
+                        index.add(event, len(line))
+        for segment_id in segment_ids[:-1]:
+            self._remove(segment_id)
+        if not index.count:
+            os.unlink(temporary)
+            self._remove(target)
+            return
+        os.replace(temporary, self._segment_path(target))
+        self._seal(target, index)
+
+def open_event_store(read_only=False):
+    """Opens the service's event history, as configured under `events` in config.yml."""
+    events_config = config.get('events', {})
+    return EventStore(
+        events_config.get('directory') or EVENTS_DIR,
+        segment_bytes=events_config.get('segment_bytes', 1024 * 1024),
+        max_bytes=events_config.get('max_bytes', 64 * 1024 * 1024),
+        max_age_days=events_config.get('max_age_days', 30),
+        error_max_age_days=events_config.get('error_max_age_days', 7),
+        read_only=read_only,
+    )
+
+def parse_since(value: str) -> float:
+    """
+    Parses a time filter: a Unix timestamp, or an age such as '90s', '15m',
+    '1h' or '2d'.
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if value and value[-1] in units:
+        return time.time() - float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+def format_event(event: dict) -> str:
+    """Formats an event as one line of text."""
+    fields = {key: value for key, value in event.items() if key not in ('time', 'type', 'pid', 'wineprefix')}
+    details = ' '.join(f"{key}={value}" for key, value in fields.items())
+    where = ' '.join(filter(None, [f"PID {event['pid']}" if 'pid' in event else '', event.get('wineprefix', '')]))
+    return f"[{time.ctime(event['time'])}] {event['type']:<12} {where}  {details}".rstrip()
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Query the WinRunAI event history.")
+    parser.add_argument('--directory', help="Event store directory (default: from config.yml)")
+    parser.add_argument('--since', help="Start time: Unix timestamp or age such as 1h, 2d")
+    parser.add_argument('--until', help="End time: Unix timestamp or age")
+    parser.add_argument('--type', action='append', choices=EVENT_TYPES, help="Event type (repeatable)")
+    parser.add_argument('--pid', type=int)
+    parser.add_argument('--prefix', help="WINEPREFIX")
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--json', action='store_true', help="Print the events as JSON lines")
+    args = parser.parse_args()
+
+    store = EventStore(args.directory, read_only=True) if args.directory else open_event_store(read_only=True)
+    events = store.query(
+        since=parse_since(args.since) if args.since else None,
+        until=parse_since(args.until) if args.until else None,
+        types=args.type, pid=args.pid, wineprefix=args.prefix,
+        limit=args.limit, newest_first=True,
+    )
+    for event in reversed(events):
+        print(json.dumps(event) if args.json else format_event(event))
@@ -1,16 +1,142 @@
 import subprocess
 import os
 import tempfile
+import threading
+import time
+from collections import deque
 from pathlib import Path
 
-def execute_action_plan(action_plan: dict, callback):
+from .registry import RegistryDocument, unapplied_changes, is_wine_running, can_write_hives, write_hives
+from .prefixstate import prefix_states
+from .metrics import EXECUTOR_QUEUE_WAIT_SECONDS, TOOL_RUN_SECONDS
+
+# winetricks verbs that are always installed on their own instead of being
+# batched with other verbs (the .NET installers are sensitive to what else is
+# installed in the same run).
+SOLO_WINETRICKS_VERBS = ('dotnet',)
+
+def run_tool(tool: str, arguments: list, wineprefix: str, callback, details: dict = None):
     """
-    Executes a given action plan.
+    Runs one tool invocation against a WINEPREFIX.
+
+    Args:
+        tool: 'winetricks' or 'regedit'.
+        arguments: The winetricks verbs to install in one run, or, for regedit,
+                   the contents of the .reg files to import. These are merged
+                   into one document (later values win) and values the prefix
+                   already has are skipped.
+        wineprefix: The WINEPREFIX to run the tool in.
+        callback: Receives the tool's output and status messages.
+        details: If given, receives the 'exit_code' of the tool once it ran
+                 (None when the registry files were written directly). It
+                 is left empty when nothing had to be done or the tool
+                 could not be started.
+
+    Returns:
+        True on success, False on failure, None if the tool is unknown.
+    """
+    details = {} if details is None else details
+    exec_env = os.environ.copy()
+    exec_env['WINEPREFIX'] = wineprefix
+    temp_reg_path = None
+    label = f"{tool} {' '.join(argument.splitlines()[0] for argument in arguments)}"
+
+    if tool == 'winetricks':
+        state = prefix_states.state(wineprefix)
+        installed = [verb for verb in arguments if state.has_verb(verb)]
+        if installed:
+            callback(f"Already installed according to winetricks.log: {' '.join(installed)}. Skipping.")
+            arguments = [verb for verb in arguments if verb not in installed]
+            if not arguments:
+                return True
+            label = f"{tool} {' '.join(arguments)}"
+        command = ['winetricks', '-q', *arguments]
+    elif tool == 'regedit':
+        # For regedit, the argument is the content of the .reg file
+        # e.g., "[HKEY_CURRENT_USER\\Software\\Wine\\Direct3D]\\n\"csmt\"=\"enabled\""
+        changes = unapplied_changes(wineprefix, RegistryDocument.parse(*arguments))
+        if not changes:
+            callback("Registry values are already set. Skipping.")
+            return True
+
+        # Starting regedit means starting Wine; when Wine is not running for
+        # the prefix, the values can go straight into the hive files instead.
+        if (can_write_hives(changes) and not is_wine_running(wineprefix)
+                and (Path(wineprefix) / 'user.reg').exists() and (Path(wineprefix) / 'system.reg').exists()):
+            try:
+                write_hives(wineprefix, changes)
+                details['exit_code'] = None
+                callback(f"Wrote {sum(1 for _ in changes.values())} registry value(s) to the prefix's registry files.")
+                return True
+            except OSError as e:
+                callback(f"Could not write the registry files directly ({e}). Falling back to regedit.")
+
+        try:
+            with tempfile.NamedTemporaryFile(mode='w', suffix='.reg', delete=False) as reg_file:
+                reg_file.write(changes.format())
+                temp_reg_path = reg_file.name
+
+            # The /S switch imports the file silently
+            command = ['regedit', '/S', temp_reg_path]
+        except Exception as e:
+            callback(f"Error creating temporary registry file: {e}")
+            return False
+    else:
+        callback(f"Warning: Unknown tool type '{tool}' in action plan. Skipping.")
+        return None
+
+    started = time.perf_counter()
+    try:
+        process = subprocess.Popen(
+            command,
+            env=exec_env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            encoding='utf-8',
+            errors='replace'
+        )
+
+        for line in iter(process.stdout.readline, ''):
+            callback(f"  [{tool}] {line.strip()}")
+
+        process.stdout.close()
+        return_code = process.wait()
+        details['exit_code'] = return_code
+        TOOL_RUN_SECONDS.observe(time.perf_counter() - started)
+
+        # winetricks.log and the DLL directories have changed.
+        prefix_states.invalidate(wineprefix)
+
+        if return_code == 0:
+            callback(f"Command '{label}' completed successfully.")
+            return True
+        callback(f"Command '{label}' failed with exit code {return_code}.")
+        return False
+
+    except FileNotFoundError:
+        callback(f"Error: '{command[0]}' command not found. Please make sure it is installed and in your PATH.")
+        return False
+    except Exception as e:
+        callback(f"An unexpected error occurred while running {tool}: {e}")
+        return False
+    finally:
+        # Clean up the temp reg file if it exists
+        if temp_reg_path and os.path.exists(temp_reg_path):
+            os.unlink(temp_reg_path)
+
+def execute_action_plan(action_plan: dict, callback, outcomes=None):
+    """
+    Executes a given action plan synchronously. Each applied action is
+    recorded with `outcomes` (an OutcomeTracker), if given.
+
+    Returns:
+        True if every action completed successfully, False otherwise.
     """
     wineprefix = action_plan.get('wineprefix')
     if not wineprefix:
         callback("Execution failed: WINEPREFIX not specified in the action plan.")
-        return
+        return False
 
     callback(f"Executing action for WINEPREFIX: {wineprefix}")
     success = False
@@ -21,67 +147,254 @@ def execute_action_plan(action_plan: dict, callback):
 
         callback(f"Step {i+1}/{len(action_plan['actions'])}: Running '{tool}' with argument '{argument}'...")
 
-        exec_env = os.environ.copy()
-        exec_env['WINEPREFIX'] = wineprefix
+        details = {}
+        started = time.monotonic()
+        result = run_tool(tool, [argument], wineprefix, callback, details)
+        if outcomes is not None and 'exit_code' in details:
+            outcomes.record_run(wineprefix, tool, argument, action.get('patterns'), details['exit_code'],
+                                time.monotonic() - started, result is True)
+        if result is None:
+            continue
+        success = result
+        if not success:
+            break
+
+    if success:
+        callback("[bold green]Action plan completed successfully. Please RESTART the Windows application for changes to take effect.[/bold green]")
+    return success
 
-        if tool == 'winetricks':
-            command = ['winetricks', '-q', argument]
-        elif tool == 'regedit':
-            # For regedit, the argument is the content of the .reg file
-            # e.g., "[HKEY_CURRENT_USER\\Software\\Wine\\Direct3D]\\n\"csmt\"=\"enabled\""
-            try:
-                with tempfile.NamedTemporaryFile(mode='w', suffix='.reg', delete=False) as reg_file:
-                    reg_file.write("REGEDIT4\n\n") # Standard .reg file header
-                    reg_file.write(argument)
-                    temp_reg_path = reg_file.name
+class _Ticket:
+    """A submitted action plan waiting for its actions to finish."""
+    __slots__ = ('plan', 'callback', 'on_done', 'remaining', 'success')
 
-                # The /S switch imports the file silently
-                command = ['regedit', '/S', temp_reg_path]
-            except Exception as e:
-                callback(f"Error creating temporary registry file: {e}")
-                success = False
-                break
+    def __init__(self, plan, callback, on_done, actions):
+        self.plan = plan
+        self.callback = callback
+        self.on_done = on_done
+        self.remaining = set(actions)
+        self.success = None
+
+class _PendingAction:
+    """One queued (tool, argument) action and the plans waiting for it."""
+    __slots__ = ('key', 'tickets', 'queued_at')
+
+    def __init__(self, key):
+        self.key = key
+        self.tickets = []
+        self.queued_at = time.monotonic()
+
+class ActionScheduler:
+    """
+    Executes action plans in the background, one queue per WINEPREFIX.
+
+    Actions for the same prefix run one at a time in submission order, while
+    different prefixes run in parallel (up to `max_parallel` at once). An
+    action that is already queued or running for a prefix is not queued again;
+    the new plan simply waits for the existing one. Consecutive queued
+    winetricks verbs for a prefix are installed with a single
+    `winetricks -q verb1 verb2 ...` run.
+
+    submit() never blocks. Progress is reported through each plan's callback,
+    and `on_done(action_plan, success)` is called once all of a plan's actions
+    have finished. Each tool run is recorded as 'action_start' and
+    'action_end' events with `events(type, pid=..., wineprefix=..., **fields)`,
+    and the outcome of every applied action with `outcomes` (an
+    OutcomeTracker), if given.
+    """
+    def __init__(self, max_parallel=4, batch_winetricks=True, events=None, outcomes=None):
+        self.batch_winetricks = batch_winetricks
+        self.events = events or (lambda type, **fields: None)
+        self.outcomes = outcomes
+        self._slots = threading.Semaphore(max(1, max_parallel))
+        self._lock = threading.Lock()
+        self._queues = {}     # wineprefix -> deque of _PendingAction
+        self._pending = {}    # (wineprefix, tool, argument) -> _PendingAction, queued or running
+        self._workers = {}    # wineprefix -> worker thread
+        self.coalesced = 0
+        self.completed = 0
+
+    def submit(self, action_plan: dict, callback, on_done=None):
+        """
+        Queues an action plan.
+
+        Returns:
+            True if at least one new action was queued, False if every action
+            was already queued or running for the prefix.
+        """
+        wineprefix = action_plan.get('wineprefix')
+        if not wineprefix:
+            callback("Execution failed: WINEPREFIX not specified in the action plan.")
+            if on_done:
+                on_done(action_plan, False)
+            return False
+
+        keys = []
+        for action in action_plan.get('actions', []):
+            key = (wineprefix, action.get('tool'), action.get('argument'))
+            if key not in keys:
+                keys.append(key)
+
+        ticket = _Ticket(action_plan, callback, on_done, keys)
+        queued = False
+        with self._lock:
+            queue = self._queues.setdefault(wineprefix, deque())
+            for key in keys:
+                pending = self._pending.get(key)
+                if pending is None:
+                    pending = self._pending[key] = _PendingAction(key)
+                    queue.append(pending)
+                    queued = True
+                else:
+                    self.coalesced += 1
+                pending.tickets.append(ticket)
+
+            if not keys:
+                ticket.success = True
+            elif wineprefix not in self._workers:
+                worker = self._workers[wineprefix] = threading.Thread(
+                    target=self._run_prefix, args=(wineprefix,), name=f"executor:{wineprefix}", daemon=True
+                )
+                worker.start()
+
+        if queued:
+            callback(f"Queued fix for WINEPREFIX: {wineprefix}")
         else:
-            callback(f"Warning: Unknown tool type '{tool}' in action plan. Skipping.")
-            continue
+            callback(f"Fix is already queued for WINEPREFIX: {wineprefix}")
+        if not keys and on_done:
+            on_done(action_plan, True)
+        return queued
 
-        try:
-            process = subprocess.Popen(
-                command,
-                env=exec_env,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                encoding='utf-8',
-                errors='replace'
-            )
-
-            for line in iter(process.stdout.readline, ''):
-                callback(f"  [{tool}] {line.strip()}")
-
-            process.stdout.close()
-            return_code = process.wait()
-
-            if return_code == 0:
-                callback(f"Command '{tool} {argument.splitlines()[0]}' completed successfully.")
-                success = True
-            else:
-                callback(f"Command '{tool} {argument.splitlines()[0]}' failed with exit code {return_code}.")
-                success = False
+    def stats(self):
+        with self._lock:
+            return {
+                'queued_actions': len(self._pending),
+                'active_prefixes': len(self._workers),
+                'coalesced': self.coalesced,
+                'completed': self.completed,
+            }
+
+    def _next_batch(self, queue):
+        """
+        Pops the next action, plus any winetricks verbs queued right after it,
+        or, for a registry change, all registry changes queued for the prefix.
+        """
+        batch = [queue.popleft()]
+        _, tool, argument = batch[0].key
+        if tool == 'regedit':
+            batch += [pending for pending in queue if pending.key[1] == 'regedit']
+            for pending in batch[1:]:
+                queue.remove(pending)
+            return batch
+        if tool != 'winetricks' or not self.batch_winetricks or argument.startswith(SOLO_WINETRICKS_VERBS):
+            return batch
+        while queue:
+            _, next_tool, next_argument = queue[0].key
+            if next_tool != 'winetricks' or next_argument.startswith(SOLO_WINETRICKS_VERBS):
                 break
+            batch.append(queue.popleft())
+        return batch
 
-        except FileNotFoundError:
-            callback(f"Error: '{command[0]}' command not found. Please make sure it is installed and in your PATH.")
-            success = False
-            break
+    def _run_prefix(self, wineprefix):
+        try:
+            while True:
+                with self._lock:
+                    queue = self._queues.get(wineprefix)
+                    if not queue:
+                        self._queues.pop(wineprefix, None)
+                        del self._workers[wineprefix]
+                        return
+                    batch = self._next_batch(queue)
+                self._run_batch(wineprefix, batch)
+        except BaseException:
+            # Never leave the prefix with a worker entry and no worker: the
+            # next plan for it starts a new one.
+            with self._lock:
+                if self._workers.get(wineprefix) is threading.current_thread():
+                    del self._workers[wineprefix]
+            raise
+
+    def _run_batch(self, wineprefix, batch):
+        tool = batch[0].key[1]
+        arguments = [pending.key[2] for pending in batch]
+        # Report to the callback of the first plan waiting on the batch.
+        callback = batch[0].tickets[0].callback if batch[0].tickets else (lambda message: None)
+
+        pid = batch[0].tickets[0].plan.get('pid') if batch[0].tickets else None
+
+        result = False
+        try:
+            with self._slots:
+                for pending in batch:
+                    EXECUTOR_QUEUE_WAIT_SECONDS.observe(time.monotonic() - pending.queued_at)
+                callback(f"Executing action for WINEPREFIX: {wineprefix}")
+                summary = ' '.join(argument.splitlines()[0] for argument in arguments)
+                callback(f"Running '{tool}' with argument{'s' if len(arguments) > 1 else ''} '{summary}'...")
+                self.events('action_start', pid=pid, wineprefix=wineprefix, tool=tool, arguments=arguments)
+                started = time.monotonic()
+                details = {}
+                result = run_tool(tool, arguments, wineprefix, callback, details)
+                duration = time.monotonic() - started
+                self.events('action_end', pid=pid, wineprefix=wineprefix, tool=tool, arguments=arguments,
+                            result={True: 'success', False: 'failure', None: 'skipped'}[result],
+                            duration=round(duration, 3), exit_code=details.get('exit_code'))
+                if self.outcomes is not None and 'exit_code' in details:
+                    self._record_outcomes(batch, details['exit_code'], duration, result is True)
         except Exception as e:
-            callback(f"An unexpected error occurred while running {tool}: {e}")
-            success = False
-            break
+            # A failing fix must not take the prefix's worker down with it.
+            callback(f"Execution failed: '{tool}' raised an error in {wineprefix}: {e}")
+            result = False
         finally:
-            # Clean up the temp reg file if it exists
-            if tool == 'regedit' and 'temp_reg_path' in locals() and os.path.exists(temp_reg_path):
-                os.unlink(temp_reg_path)
+            self._finish(batch, result is not False)
 
-    if success:
-        callback("[bold green]Action plan completed successfully. Please RESTART the Windows application for changes to take effect.[/bold green]")
+    def _record_outcomes(self, batch, exit_code, duration, success):
+        """Records a run's outcome for each of its actions, with the patterns that led to it."""
+        for pending in batch:
+            wineprefix, tool, argument = pending.key
+            patterns = [
+                pattern
+                for ticket in pending.tickets
+                for action in ticket.plan.get('actions', ())
+                if action.get('tool') == tool and action.get('argument') == argument
+                for pattern in action.get('patterns', ())
+            ]
+            try:
+                self.outcomes.record_run(wineprefix, tool, argument, patterns, exit_code, duration, success)
+            except Exception as e:
+                callback = pending.tickets[0].callback if pending.tickets else None
+                if callback:
+                    callback(f"Could not record the outcome of '{argument.splitlines()[0]}': {e}")
+
+    def _finish(self, batch, success):
+        finished = []
+        with self._lock:
+            for pending in batch:
+                del self._pending[pending.key]
+                for ticket in pending.tickets:
+                    ticket.remaining.discard(pending.key)
+                    if not success:
+                        ticket.success = False
+                        # Abandon the rest of a failed plan, unless other plans need it.
+                        for key in ticket.remaining:
+                            other = self._pending.get(key)
+                            if other is None:
+                                continue
+                            other.tickets.remove(ticket)
+                            queue = self._queues.get(key[0])
+                            if not other.tickets and queue and other in queue:
+                                queue.remove(other)
+                                del self._pending[key]
+                        ticket.remaining.clear()
+                    if not ticket.remaining and ticket not in finished:
+                        if ticket.success is None:
+                            ticket.success = True
+                        finished.append(ticket)
+            self.completed += len(batch)
+
+        for ticket in finished:
+            if ticket.success:
+                ticket.callback("[bold green]Action plan completed successfully. Please RESTART the Windows application for changes to take effect.[/bold green]")
+            if ticket.on_done:
+                try:
+                    ticket.on_done(ticket.plan, ticket.success)
+                except Exception as e:
+                    ticket.callback(f"Could not finish the action plan for {ticket.plan.get('wineprefix')}: {e}")
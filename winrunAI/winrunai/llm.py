@@ -0,0 +1,350 @@
+import re
+import json
+import queue
+import threading
+import time
+import http.client
+import urllib.parse
+
+from .logfilter import VOLATILE_TOKENS, normalize_error_line, parse_wine_line
+from .registry import RegistryDocument
+
+# Tools an answer may use, and what a winetricks verb may look like (a verb
+# starting with '-' would be taken as an option).
+ALLOWED_TOOLS = ('winetricks', 'regedit')
+WINETRICKS_VERB = re.compile(r'^[a-z0-9][a-z0-9_.=-]*$')
+
+# Promoted patterns must be at least this long, so they do not match unrelated lines.
+MIN_PATTERN_LENGTH = 8
+
+# The registry keys a model's answer may change: Wine's own per-user
+# settings. Anything else (HKLM, other software, file associations) is
+# never applied or promoted on a model's word.
+LLM_REGISTRY_KEYS = (
+    'Software\\Wine\\Direct3D',
+    'Software\\Wine\\DllOverrides',
+    'Software\\Wine\\AppDefaults',
+)
+USER_ROOTS = ('HKEY_CURRENT_USER', 'HKCU')
+
+PROMPT = """You are an expert in running Windows applications with Wine on Linux.
+For each numbered Wine error line below, suggest one fix, or null if there is none.
+A fix is either a winetricks verb to install, or the content of a .reg file to import.
+
+Reply with JSON only, in this form:
+{{"answers": [{{"index": 0, "tool": "winetricks" or "regedit", "argument": "<verb or .reg content>",
+"confidence": <0.0 to 1.0>, "pattern": "<short substring of the line that identifies this error>"}} or null, ...]}}
+
+Error lines:
+{errors}
+"""
+
+def check_fix(tool, argument):
+    """Returns why a fix may not be used, or None if it is a valid fix."""
+    if tool not in ALLOWED_TOOLS:
+        return f"The tool must be one of {', '.join(ALLOWED_TOOLS)}"
+    if not isinstance(argument, str):
+        return "The argument must be a string"
+    if tool == 'winetricks' and not WINETRICKS_VERB.match(argument):
+        return f"'{argument}' is not a winetricks verb"
+    if tool == 'regedit' and not RegistryDocument.parse(argument):
+        return "The argument is not a .reg document with any values"
+    return None
+
+def check_llm_registry_keys(argument: str):
+    """
+    Returns why a model's .reg answer may not be used, or None if every key
+    it sets or deletes is under LLM_REGISTRY_KEYS in HKEY_CURRENT_USER.
+    """
+    document = RegistryDocument.parse(argument)
+    keys = [key for key, _ in document.keys.values()] + document.deleted_keys
+    for key in keys:
+        root, _, path = key.partition('\\')
+        path = path.lower()
+        if root.upper() not in USER_ROOTS or not any(
+                path == allowed.lower() or path.startswith(allowed.lower() + '\\') for allowed in LLM_REGISTRY_KEYS):
+            return f"'{key}' is not one of the Wine settings a model may change"
+    return None
+
+def validate_answer(answer, error_line: str):
+    """
+    Checks an answer from a backend and returns it in rule form
+    ({'pattern', 'type', 'argument', 'confidence', 'line_class', 'channel'}),
+    or None if it is not a usable fix. The rule is scoped to the debug class
+    and channel of the error line. Registry answers may only change the Wine
+    settings in LLM_REGISTRY_KEYS.
+    """
+    if not isinstance(answer, dict):
+        return None
+    tool = answer.get('tool')
+    argument = answer.get('argument')
+    try:
+        confidence = min(max(float(answer.get('confidence', 0)), 0.0), 1.0)
+    except (TypeError, ValueError):
+        return None
+    if isinstance(argument, str):
+        argument = argument.strip()
+    if check_fix(tool, argument):
+        return None
+    if tool == 'regedit' and check_llm_registry_keys(argument):
+        return None
+
+    # The pattern must identify the error: a substring of the line without
+    # addresses or counters in it. Otherwise the answer is not promoted.
+    pattern = answer.get('pattern')
+    line = normalize_error_line(error_line)
+    if not isinstance(pattern, str) or pattern.lower() not in line.lower():
+        pattern = line
+    if len(pattern) < MIN_PATTERN_LENGTH or VOLATILE_TOKENS.search(pattern):
+        pattern = None
+
+    parsed = parse_wine_line(line)
+    return {'pattern': pattern, 'type': tool, 'argument': argument, 'confidence': confidence,
+            'line_class': parsed and parsed.line_class, 'channel': parsed and parsed.channel}
+
+class FakeBackend:
+    """
+    A deterministic stand-in for a model, for tests and benchmarks.
+
+    Lines containing a key of `answers` get that answer ((tool, argument,
+    confidence)); lines naming a missing DLL ('foo.dll') get a winetricks
+    verb of the same name at `dll_confidence`. Everything else gets None.
+    """
+    name = 'fake'
+
+    def __init__(self, answers=None, dll_confidence=0.6, latency=0.0):
+        self.answers = answers or {}
+        self.dll_confidence = dll_confidence
+        self.latency = latency
+        self.calls = 0
+
+    def suggest(self, errors, timeout=None):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        results = []
+        for error in errors:
+            result = None
+            for key, (tool, argument, confidence) in self.answers.items():
+                if key in error:
+                    result = {'tool': tool, 'argument': argument, 'confidence': confidence, 'pattern': key}
+                    break
+            if result is None:
+                match = re.search(r'([A-Za-z][\w]*)\.dll', error)
+                if match:
+                    result = {'tool': 'winetricks', 'argument': match.group(1).lower(),
+                              'confidence': self.dll_confidence, 'pattern': match.group(0)}
+            results.append(result)
+        return results
+
+class OllamaBackend:
+    """
+    Queries a model served by a local Ollama instance (or anything speaking
+    its /api/generate protocol) over HTTP. Inference is kept on the CPU.
+    """
+    name = 'ollama'
+
+    def __init__(self, url='http://127.0.0.1:11434', model='llama3', cpu_only=True):
+        self.url = url.rstrip('/') + '/api/generate'
+        self.model = model
+        self.cpu_only = cpu_only
+
+    def suggest(self, errors, timeout=None):
+        """
+        Asks for fixes for a batch of error lines in a single request.
+
+        Returns:
+            A list with one answer dict (or None) per error line.
+
+        Raises:
+            OSError: If the server cannot be reached or the whole request
+                     (connecting, sending and reading the reply) takes more
+                     than `timeout` seconds.
+            ValueError: If the reply is not valid JSON.
+        """
+        request = {
+            'model': self.model,
+            'prompt': PROMPT.format(errors="\n".join(f"{i}: {error}" for i, error in enumerate(errors))),
+            'format': 'json',
+            'stream': False,
+            'options': {'temperature': 0, **({'num_gpu': 0} if self.cpu_only else {})},
+        }
+        reply = json.loads(json.loads(_post(self.url, json.dumps(request).encode('utf-8'), timeout))['response'])
+
+        results = [None] * len(errors)
+        answers = reply.get('answers', []) if isinstance(reply, dict) else []
+        for position, answer in enumerate(answers):
+            if not isinstance(answer, dict):
+                continue
+            index = answer.get('index', position)
+            if isinstance(index, int) and 0 <= index < len(errors):
+                results[index] = answer
+        return results
+
+def _post(url: str, body: bytes, timeout=None) -> bytes:
+    """
+    POSTs a JSON body and returns the reply's body. A socket timeout only
+    bounds each read, so the time left until the deadline is set before
+    every step, and the whole request takes at most `timeout` seconds.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def remaining():
+        if deadline is None:
+            return None
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise TimeoutError(f"No reply from {url} within {timeout}s")
+        return left
+
+    parts = urllib.parse.urlsplit(url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    connection = connection_class(parts.netloc, timeout=remaining())
+    try:
+        connection.request('POST', parts.path or '/', body=body, headers={'Content-Type': 'application/json'})
+        # The connection lets go of the socket once the response is read to
+        # the end, but the response keeps reading from it.
+        sock = connection.sock
+        sock.settimeout(remaining())
+        response = connection.getresponse()
+        if response.status != 200:
+            raise OSError(f"{url} replied {response.status} {response.reason}")
+        chunks = []
+        while not response.isclosed():
+            sock.settimeout(remaining())
+            chunk = response.read1(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks)
+    finally:
+        connection.close()
+
+def create_backend(config: dict):
+    """Creates the backend selected by `llm_provider` in the ai_engine config."""
+    provider = config.get('llm_provider', 'ollama')
+    if provider == 'fake':
+        return FakeBackend()
+    if provider == 'ollama':
+        return OllamaBackend(config.get('llm_url', 'http://127.0.0.1:11434'), config.get('llm_model', 'llama3'))
+    raise ValueError(f"Unknown llm_provider '{provider}'")
+
+class LLMFallback:
+    """
+    Asks a backend about error lines that no rule matches, without ever
+    blocking the caller.
+
+    Requests are queued and a single thread sends them to the backend in
+    batches: it waits up to `batch_window` seconds after the first request
+    for more (at most `max_batch` lines per call), and gives every call
+    `timeout` seconds. Identical lines (ignoring thread ids) are asked about
+    once; answers, including "no fix", are cached in `cache`. Each waiter's
+    `on_answer(rule)` is called on the fallback thread, with None when there
+    is no usable answer. Answers with a confidence of at least
+    `promote_confidence` are passed to `promote(rule)`, to be added to the
+    rules table.
+    """
+    def __init__(self, backend, cache, batch_window=0.05, max_batch=16, timeout=5.0,
+                 max_pending=256, promote_confidence=0.9, promote=None):
+        self.backend = backend
+        self.cache = cache
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.promote_confidence = promote_confidence
+        self.promote = promote
+
+        self.calls = 0
+        self.failures = 0
+        self.dropped = 0
+        self.promoted = 0
+        self._lock = threading.Lock()
+        self._waiters = {}  # normalized line -> [on_answer]
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+
+    def request(self, error_line: str, on_answer):
+        """
+        Queues an error line.
+
+        Returns:
+            tuple: (found, rule). If the answer is cached, found is True and
+            rule is the answer; on_answer will not be called. Otherwise
+            found is False and on_answer is called later. When too many
+            lines are waiting, the line is dropped and (True, None) returned.
+        """
+        key = normalize_error_line(error_line)
+        found, rule = self.cache.get(key)
+        if found:
+            return True, rule
+
+        with self._lock:
+            waiters = self._waiters.get(key)
+            if waiters is not None:
+                waiters.append(on_answer)
+                return False, None
+            if len(self._waiters) >= self.max_pending:
+                self.dropped += 1
+                return True, None
+            self._waiters[key] = [on_answer]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="llm-fallback", daemon=True)
+                self._thread.start()
+        self._queue.put(key)
+        return False, None
+
+    def stats(self):
+        return {
+            'pending': len(self._waiters),
+            'calls': self.calls,
+            'failures': self.failures,
+            'dropped': self.dropped,
+            'promoted': self.promoted,
+        }
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._answer(batch)
+
+    def _answer(self, batch):
+        self.calls += 1
+        try:
+            answers = self.backend.suggest(batch, timeout=self.timeout)
+            if len(answers) != len(batch):
+                raise ValueError(f"expected {len(batch)} answers, got {len(answers)}")
+        except Exception:
+            # Too slow, unreachable or nonsense: no answer, and nothing is
+            # cached, so the lines are asked about again when they recur.
+            self.failures += 1
+            answers = None
+
+        for index, key in enumerate(batch):
+            rule = None
+            if answers is not None:
+                rule = validate_answer(answers[index], key)
+                self.cache.put(key, rule)
+                if rule and rule['pattern'] and rule['confidence'] >= self.promote_confidence and self.promote:
+                    try:
+                        if self.promote(rule):
+                            self.promoted += 1
+                    except Exception:
+                        pass
+
+            with self._lock:
+                waiters = self._waiters.pop(key, [])
+            for on_answer in waiters:
+                try:
+                    on_answer(rule)
+                except Exception:
+                    pass
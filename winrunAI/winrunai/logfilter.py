@@ -0,0 +1,155 @@
+import re
+import time
+import heapq
+import threading
+from collections import OrderedDict, namedtuple
+
+# Wine prefixes each debug line with the thread id (and the process id with
+# WINEDEBUG=+pid), e.g. "002c:" or "0024:002c:", and with WINEDEBUG=+timestamp
+# with the time in seconds, e.g. "3912.345:0024:".
+THREAD_ID_PREFIX = re.compile(r'^(?:\d+\.\d+:)?(?:[0-9a-fA-F]{4,8}:){0,2}')
+
+# Values that differ between repeats of the same error: hex addresses and
+# handles, and standalone numbers (counters, sizes, timestamps). Digits that
+# are part of a name, as in "d3dx9_43.dll" or "msvcp140.dll", are kept.
+VOLATILE_TOKENS = re.compile(r'0x[0-9a-fA-F]+|\b[0-9a-fA-F]{8,}\b|(?<![\w.])\d+(?!\w|\.\w)')
+
+# A Wine debug line: "[timestamp:][pid:]tid:class:channel:function message",
+# e.g. "0024:err:module:import_dll Library d3dx9_43.dll ... not found".
+WINE_DEBUG_LINE = re.compile(r'\s*(?:\d+\.\d+:)?(?:([0-9a-fA-F]{4,8}):)?(?:([0-9a-fA-F]{4,8}):)?(err|fixme|warn|trace):([^:\s]*):(\S*)\s*')
+
+# The debug classes, and the word used for each in the service log.
+LINE_CLASSES = {'err': 'Error', 'fixme': 'Fixme', 'warn': 'Warning', 'trace': 'Trace'}
+
+WineLine = namedtuple('WineLine', 'tid line_class channel function message')
+
+def parse_wine_line(line: str):
+    """
+    Splits a Wine debug line into its parts.
+
+    Returns:
+        WineLine: (tid, line_class, channel, function, message), with tid
+        None when the line has no thread id, or None if the line is not a
+        Wine debug line (e.g. the application's own output).
+    """
+    match = WINE_DEBUG_LINE.match(line)
+    if match is None:
+        return None
+    first_id, second_id, line_class, channel, function = match.groups()
+    return WineLine(second_id or first_id, line_class, channel, function, line[match.end():].rstrip())
+
+def normalize_error_line(error_string: str) -> str:
+    """Strips the thread id prefix and surrounding whitespace from a log line."""
+    return THREAD_ID_PREFIX.sub('', error_string.strip(), count=1)
+
+def canonicalize(error_string: str) -> str:
+    """
+    Reduces a log line to a form that is identical for repeats of the same
+    error, by stripping the thread id and masking addresses and counters.
+    """
+    return VOLATILE_TOKENS.sub('#', normalize_error_line(error_string))
+
+class _Seen:
+    __slots__ = ('last_seen', 'last_report', 'suppressed', 'sample')
+
+    def __init__(self, now, sample):
+        self.last_seen = now
+        self.last_report = now
+        self.suppressed = 0
+        self.sample = sample
+
+class DuplicateFilter:
+    """
+    Collapses repeated log lines.
+
+    The first occurrence of each canonical line is forwarded immediately.
+    Repeats within `window` seconds of the previous occurrence are only
+    counted, and a summary ("×N") is produced at most every
+    `summary_interval` seconds while they keep coming, plus once when they
+    stop. At most `max_entries` distinct lines are tracked.
+
+    Lines with unreported repeats are also kept in a heap ordered by when
+    their summary is due, so flush() only looks at those that are due.
+    Callers should flush() on a timer, so the count of a burst that stopped
+    is still reported, and drain() when the lines' source goes away.
+    """
+    def __init__(self, window=60.0, summary_interval=10.0, max_entries=10000):
+        self.window = window
+        self.summary_interval = summary_interval
+        self.max_entries = max_entries
+        self.forwarded = 0
+        self.suppressed = 0
+        self._seen = OrderedDict()
+        self._due = []      # heap of (due time, sequence, _Seen) with unreported repeats
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def feed(self, line, now=None):
+        """
+        Registers a line.
+
+        Returns:
+            tuple: (forward, summary). `forward` is True if the line is the
+            first occurrence and should be processed. `summary` is a
+            (count, sample line) tuple when repeats are due to be reported,
+            else None.
+        """
+        now = time.monotonic() if now is None else now
+        key = canonicalize(line)
+        with self._lock:
+            return self._feed(key, line, now)
+
+    def _feed(self, key, line, now):
+        seen = self._seen.get(key)
+
+        if seen is None or now - seen.last_seen > self.window:
+            summary = self._summary(seen) if seen is not None else None
+            self._seen[key] = _Seen(now, line)
+            self._seen.move_to_end(key)
+            if len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+            self.forwarded += 1
+            return True, summary
+
+        seen.last_seen = now
+        seen.suppressed += 1
+        self.suppressed += 1
+        self._seen.move_to_end(key)
+        if now - seen.last_report >= self.summary_interval:
+            seen.last_report = now
+            return False, self._summary(seen)
+        if seen.suppressed == 1:
+            self._sequence += 1
+            heapq.heappush(self._due, (seen.last_report + self.summary_interval, self._sequence, seen))
+        return False, None
+
+    def flush(self, now=None):
+        """
+        Returns the summaries of repeats that have not been reported for
+        `summary_interval` seconds, as a list of (count, sample line) tuples.
+        """
+        now = time.monotonic() if now is None else now
+        summaries = []
+        with self._lock:
+            due = self._due
+            while due and due[0][0] <= now:
+                seen = heapq.heappop(due)[2]
+                # Entries reported in the meantime are skipped; one that is
+                # pending again has a newer heap entry.
+                if seen.suppressed and now - seen.last_report >= self.summary_interval:
+                    seen.last_report = now
+                    summaries.append(self._summary(seen))
+        return summaries
+
+    def drain(self):
+        """Returns the summaries of all unreported repeats, regardless of age."""
+        with self._lock:
+            summaries = [self._summary(seen) for _, _, seen in sorted(self._due) if seen.suppressed]
+            self._due.clear()
+        return summaries
+
+    @staticmethod
+    def _summary(seen):
+        count = seen.suppressed
+        seen.suppressed = 0
+        return (count, seen.sample) if count else None
@@ -0,0 +1,152 @@
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+class LogWriter:
+    """
+    A batched, asynchronous writer for the service log.
+
+    Producers (the analyzer workers, the reactor, the monitor loop) only push a
+    record onto a lock-free queue. A single writer thread formats the records,
+    writes them in batches, flushing when `batch_bytes` have accumulated or
+    `flush_interval` seconds have passed, and rotates the file once it grows
+    past `max_bytes`. When more than `max_queue` records are waiting, new
+    records are dropped (and counted), or, with overflow='block', the producer
+    waits for the writer to catch up.
+
+    The writer is callable, so it can be passed anywhere a `callback(message)`
+    is expected. If `on_record` is given, it is also called with every record
+    on the writer thread, for example to stream the log to other processes.
+    """
+    def __init__(self, path, mode='a', max_bytes=10 * 1024 * 1024, backup_count=3,
+                 flush_interval=0.5, batch_bytes=64 * 1024, max_queue=100000, overflow='drop',
+                 on_record=None):
+        self.path = Path(path)
+        self.on_record = on_record
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.batch_bytes = batch_bytes
+        self.max_queue = max_queue
+        self.block_on_overflow = overflow == 'block'
+
+        self.written = 0
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._queue = queue.SimpleQueue()
+        self._file = open(self.path, mode, encoding='utf-8')
+        self._size = self._file.tell()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def log(self, message, **fields):
+        """
+        Queues a log record. Extra keyword fields are kept with the record for
+        structured consumers; the text log only shows the message.
+        """
+        if self._queue.qsize() >= self.max_queue:
+            if not self.block_on_overflow:
+                self.dropped += 1
+                return
+            while self._queue.qsize() >= self.max_queue and not self._closing:
+                time.sleep(0.001)
+        self._queue.put((time.time(), message, fields))
+
+    __call__ = log
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+        }
+
+    def close(self):
+        """Writes out everything queued so far and stops the writer thread."""
+        if self._closing:
+            return
+        self._closing = True
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def format(self, record):
+        timestamp, message, _ = record
+        return f"[{time.ctime(timestamp)}] {message}\n"
+
+    def _run(self):
+        pending = []
+        pending_bytes = 0
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                record = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                record = False
+
+            stop = record is None
+            while record:
+                if self.on_record:
+                    self.on_record(record)
+                text = self.format(record)
+                pending.append(text)
+                pending_bytes += len(text)
+                if pending_bytes >= self.batch_bytes:
+                    break
+                try:
+                    record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+
+            if self.dropped != self._reported_dropped:
+                notice = (time.time(), f"[{self.dropped - self._reported_dropped} log records dropped: log queue full]", {})
+                self._reported_dropped = self.dropped
+                if self.on_record:
+                    self.on_record(notice)
+                text = self.format(notice)
+                pending.append(text)
+                pending_bytes += len(text)
+
+            if pending and deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+
+            if pending and (stop or pending_bytes >= self.batch_bytes or time.monotonic() >= deadline):
+                self._write(pending, pending_bytes)
+                pending = []
+                pending_bytes = 0
+                deadline = None
+
+            if stop:
+                return
+
+    def _write(self, chunks, size):
+        if self.max_bytes and self._size and self._size + size > self.max_bytes:
+            self._rotate()
+        self._file.write(''.join(chunks))
+        self._file.flush()
+        self._size += size
+        self.written += len(chunks)
+
+    def _rotate(self):
+        """Renames log -> log.1 -> log.2 ... and starts a new file."""
+        self._file.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            source = self.path.with_name(f"{self.path.name}.{index}")
+            if source.exists():
+                os.replace(source, self.path.with_name(f"{self.path.name}.{index + 1}"))
+        if self.backup_count > 0:
+            os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+        self._file = open(self.path, 'w', encoding='utf-8')
+        self._size = 0
@@ -1,16 +1,391 @@
+import re
 import sys
-from .tui import WinRunAIApp
-from .service import run_monitor_loop, start_service, stop_service
+import json
+import time
+import argparse
 
-def main():
+# Each command imports what it needs when it runs: the TUI (Textual) and the
+# engine are only loaded on the paths that use them.
+
+MARKUP = re.compile(r'\[/?(?:bold|italic|dim|underline|red|green|yellow|blue|cyan|magenta)(?: [a-z]+)*\]')
+
+def plain(message: str) -> str:
+    """Strips the TUI's color markup from a log message."""
+    return MARKUP.sub('', message)
+
+def run_tui(args):
+    from .tui import WinRunAIApp
+    WinRunAIApp().run()
+
+def run_service(args):
+    from .service import run_monitor_loop
+    run_monitor_loop()
+
+def start(args):
+    from .control import start_service
+    if start_service():
+        print("WinRunAI service started.")
+    else:
+        print("WinRunAI service is already running.")
+
+def stop(args):
+    from .control import stop_service
+    if stop_service():
+        print("WinRunAI service stopped.")
+    else:
+        print("WinRunAI service is not running.")
+
+def status(args):
+    from .control import is_service_running, STATUS_FILE
+    if not is_service_running():
+        print("WinRunAI service is not running.")
+        return 1
+    try:
+        with open(STATUS_FILE) as status_file:
+            status_data = json.load(status_file)
+    except (OSError, ValueError):
+        status_data = {}
+    if args.json:
+        print(json.dumps(status_data, indent=2))
+        return 0
+
+    print("WinRunAI service is running.")
+    processes = status_data.get('processes', [])
+    print(f"Monitored processes: {len(processes)}")
+    for process in processes:
+        print(f"  PID {process['pid']}: {process['cmdline']}")
+    analysis = status_data.get('analysis', {})
+    actions = status_data.get('actions', {})
+    if analysis:
+        print(f"Analysis: {analysis.get('busy', 0)} busy of {analysis.get('threads', 0)} threads, {analysis.get('queue_depth', 0)} batches queued")
+    if actions:
+        print(f"Fixes: {actions.get('queued_actions', 0)} queued, {actions.get('completed', 0)} completed")
+    return 0
+
+def tail(args):
+    """Prints the service's log records as they arrive."""
+    import socket
+    from .control import SOCKET_FILE
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(SOCKET_FILE))
+    except OSError:
+        print("WinRunAI service is not running.", file=sys.stderr)
+        return 1
+    try:
+        # The service starts with its recent backlog.
+        for line in sock.makefile('rb'):
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event.get('type') == 'log':
+                print(f"[{time.ctime(event['time'])}] {plain(event['message'])}", flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+    return 0
+
+def send_command(command: dict):
+    """
+    Sends a command to the running service.
+
+    Returns:
+        dict: The service's reply, or None if the service is not running.
+    """
+    import socket
+    from .control import SOCKET_FILE
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(SOCKET_FILE))
+    except OSError:
+        return None
+    try:
+        sock.sendall(json.dumps(command).encode('utf-8') + b'\n')
+        for line in sock.makefile('rb'):
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event.get('type') == 'reply':
+                return event
+    finally:
+        sock.close()
+    return None
+
+def reload(args):
+    """Makes the service reload config.yml and the rules, or checks config.yml when it is not running."""
+    reply = send_command({'command': 'reload'})
+    if reply is None:
+        from .config import load_config, ConfigError
+        try:
+            load_config()
+        except ConfigError as e:
+            print(f"config.yml is invalid:\n{e}")
+            return 1
+        print("WinRunAI service is not running; config.yml is valid.")
+        return 0
+    if not reply.get('ok'):
+        print(f"Reload failed, the service keeps its current settings:\n{reply.get('error')}")
+        return 1
+    print(f"Reloaded. Rules: {reply['rules']}. Changed: {', '.join(reply['changed']) or 'nothing'}.")
+    if reply['restart_required']:
+        print(f"These settings take effect after a restart: {', '.join(reply['restart_required'])}.")
+    return 0
+
+def add_rule(args):
+    """Adds a rule to the knowledge base, through the service when it is running."""
+    argument = args.argument
+    if args.tool == 'regedit' and argument.startswith('@'):
+        with open(argument[1:], encoding='utf-8-sig') as reg_file:
+            argument = reg_file.read()
+    command = {'command': 'add_rule', 'pattern': args.pattern, 'tool': args.tool,
+               'argument': argument, 'confidence': args.confidence,
+               'line_class': args.line_class, 'channel': args.channel}
+    reply = send_command(command)
+    if reply is None:
+        from .service import add_rule_command
+        reply = add_rule_command(command)
+    if not reply.get('ok'):
+        print(f"Rule not added: {reply.get('error')}")
+        return 1
+    print(f"Rule added. Rules: {reply['rules']}.")
+    return 0
+
+def replay(args):
+    """Analyzes a recorded Wine log without applying any fix."""
+    from .bench import replay as replay_log
+    from .engine import describe_actions
+
+    callback = (lambda message: None) if args.quiet else (lambda message: print(plain(message)))
+    results = replay_log(args.log, rate=args.rate, callback=callback, plans=True)
+    plans = results.pop('plans')
+    print(f"Replayed {results['lines']} lines in {results['seconds']}s: "
+          f"{results['errors_forwarded']} errors analyzed, {len(plans)} fix plans.")
+    for plan in plans:
+        print(describe_actions(plan['actions']))
+    return 0
+
+def analyze(args):
+    """Analyzes recorded Wine logs offline and reports the fixes they call for."""
+    from .bulk import analyze_logs
+
+    report = analyze_logs(args.logs, workers=args.workers, chunk_bytes=args.chunk_mb << 20,
+                          callback=None if args.json else print)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 0
+    print(f"{report['lines']} lines in {report['seconds']}s ({report['lines_per_second']} lines/s): "
+          f"{report['errors']} looked up, {report['unmatched']} without a rule.")
+    for fix in report['fixes']:
+        print(f"{fix['occurrences']:8d}x  {fix['tool']} '{fix['argument'].splitlines()[0]}' "
+              f"({fix['confidence']:.0%}), first at {fix['first_file']}:{fix['first_offset']}: {fix['first_line']}")
+    return 0
+
+def prescan(args):
+    """Finds the DLLs an application will miss before it is first started, and optionally installs them."""
+    import os
+    from .pescan import prescan as scan_application
+    from .engine import AIEngine, describe_actions
+    from .executor import execute_action_plan
+
+    wineprefix = os.path.abspath(os.path.expanduser(args.prefix or os.environ.get('WINEPREFIX', '~/.wine')))
+    engine = AIEngine()
+    try:
+        report = scan_application(args.path, wineprefix, workers=args.workers, use_cache=not args.no_cache,
+                                  engine=engine, callback=print if not args.json else None)
+    except FileNotFoundError as e:
+        print(e, file=sys.stderr)
+        return 1
+    plan = report['plan']
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"Scanned {report['pe_files']} PE files of {report['files']} ({report['cached']} cached) in {report['seconds']}s.")
+        for dll, modules in sorted(report['missing'].items()):
+            needed_by = ', '.join(os.path.basename(module) for module in modules[:3])
+            if len(modules) > 3:
+                needed_by += f" and {len(modules) - 3} more"
+            print(f"  Missing {dll} (needed by {needed_by})")
+        if report['unknown']:
+            print(f"No known fix for: {', '.join(report['unknown'])}")
+        print(describe_actions(plan['actions']) if plan else "Nothing to install.")
+    if plan and args.apply:
+        if not execute_action_plan(plan, lambda message: print(plain(message)), engine.outcomes):
+            return 1
+        for action in plan['actions']:
+            engine.record_fix(wineprefix, (action['tool'], action['argument']))
+    return 0
+
+def template(args):
+    """Lists, captures and clones prefix templates."""
+    import os
+    from .templates import TemplateCache, open_template_cache, wine_version
+
+    templates = open_template_cache() or TemplateCache()
+    if args.action == 'list':
+        for entry in templates.templates():
+            fixes = ', '.join(argument.splitlines()[0] for _, argument in entry['fixes'])
+            print(f"{entry['key']}  {entry['bytes'] >> 20:6d} MB  {entry['wine_version']}  {fixes}")
+        return 0
+
+    prefix = os.path.abspath(os.path.expanduser(args.prefix))
+    if args.action == 'capture':
+        try:
+            entry = templates.capture(prefix)
+        except RuntimeError as e:
+            print(f"{e}; close it (wineserver -k) and try again.", file=sys.stderr)
+            return 1
+        if entry is None:
+            print("Nothing captured: no fixes were applied to the prefix, or it is too large.")
+            return 1
+        print(f"Template {entry['key']} holds {len(entry['fixes'])} fixes ({entry['bytes'] >> 20} MB).")
+        return 0
+
+    # clone
+    wanted = [('winetricks', verb) for verb in args.verbs.split(',') if verb] if args.verbs else []
+    if args.key:
+        entry = next((entry for entry in templates.templates() if entry['key'] == args.key), None)
+    elif wanted:
+        entry = templates.find(wanted)
+    else:
+        # Neither given: the most recently used template for this Wine version.
+        version = wine_version()
+        entry = next((entry for entry in templates.templates() if entry['wine_version'] == version), None)
+    if entry is None:
+        print("No matching template.", file=sys.stderr)
+        return 1
+    if os.path.exists(prefix):
+        if not args.replace:
+            print(f"{prefix} exists; use --replace to move it aside.", file=sys.stderr)
+            return 1
+        backup = f"{prefix}.broken-{int(time.time())}"
+        os.rename(prefix, backup)
+        print(f"Moved the old prefix to {backup}")
+    clone = templates.clone(entry['key'], prefix, args.method)
+    counts = clone['counts']
+    print(f"Cloned template {entry['key']} into {prefix} in {clone['seconds']}s "
+          f"({counts['reflink']} reflinked, {counts['hardlink']} hardlinked, {counts['copy']} copied files).")
+    remaining = [fix for fix in wanted if list(fix) not in entry['fixes']]
+    if remaining:
+        print(f"Not in the template: {', '.join(argument for _, argument in remaining)}")
+        if args.apply:
+            from .executor import execute_action_plan
+            from .database import record_applied_fix
+            from .outcomes import OutcomeTracker
+            plan = {'wineprefix': prefix, 'actions': [{'tool': tool, 'argument': argument} for tool, argument in remaining]}
+            if not execute_action_plan(plan, lambda message: print(plain(message)), OutcomeTracker()):
+                return 1
+            for tool, argument in remaining:
+                record_applied_fix(prefix, tool, argument)
+            templates.capture(prefix)
+    return 0
+
+def outcomes(args):
+    """Shows the recorded outcomes of applied fixes and the confidence they left their rules with."""
+    import os
+    from .outcomes import OutcomeTracker
+
+    tracker = OutcomeTracker()
+    prefix = os.path.abspath(os.path.expanduser(args.prefix)) if args.prefix else None
+    history = tracker.history(prefix, args.limit)
+    rules = tracker.rule_confidences()
+    if args.json:
+        print(json.dumps({'outcomes': history, 'rules': rules}, indent=2))
+        return 0
+    for outcome in history:
+        exit_code = '-' if outcome['exit_code'] is None else outcome['exit_code']
+        print(f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(outcome['started_at']))}  {outcome['status']:9s} "
+              f"{outcome['tool']} '{outcome['argument'].splitlines()[0]}' in {outcome['wineprefix']} "
+              f"(exit code {exit_code}, {outcome['duration']:.1f}s)")
+    if rules:
+        print("Rules adjusted by outcomes:")
+    for rule in rules:
+        print(f"  {rule['pattern']}: {rule['base_confidence']:.0%} -> {rule['confidence']:.0%} "
+              f"({rule['successes']:.1f} successes, {rule['failures']:.1f} failures)")
+    return 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="winrunai", description="AI-powered Wine enhancement layer. Without a command, opens the TUI.")
+    # Used by start_service to run the service process.
+    parser.add_argument('--service', action='store_true', help=argparse.SUPPRESS)
+    commands = parser.add_subparsers(dest='command')
+
+    commands.add_parser('start', help="Start the background service").set_defaults(handler=start)
+    commands.add_parser('stop', help="Stop the background service").set_defaults(handler=stop)
+
+    status_parser = commands.add_parser('status', help="Show the service status")
+    status_parser.add_argument('--json', action='store_true', help="Print the raw status as JSON")
+    status_parser.set_defaults(handler=status)
+
+    commands.add_parser('tail', help="Follow the service log").set_defaults(handler=tail)
+    commands.add_parser('reload', help="Reload config.yml and the rules without restarting").set_defaults(handler=reload)
+
+    rule_parser = commands.add_parser('add-rule', help="Add a rule to the knowledge base")
+    rule_parser.add_argument('pattern', help="Text that identifies the error in a log line")
+    rule_parser.add_argument('tool', choices=('winetricks', 'regedit'))
+    rule_parser.add_argument('argument', help="The winetricks verb, or @file.reg for regedit")
+    rule_parser.add_argument('--confidence', type=float, default=0.95)
+    rule_parser.add_argument('--class', dest='line_class', choices=('err', 'fixme', 'warn', 'trace'),
+                             help="Only match lines of this Wine debug class (default: from the pattern, or any)")
+    rule_parser.add_argument('--channel', help="Only match lines of this Wine debug channel, e.g. module")
+    rule_parser.set_defaults(handler=add_rule)
+
+    replay_parser = commands.add_parser('replay', help="Analyze a recorded Wine log without applying fixes")
+    replay_parser.add_argument('log', help="A Wine stderr log")
+    replay_parser.add_argument('--rate', type=float, default=0, help="Lines per second (default: as fast as possible)")
+    replay_parser.add_argument('--quiet', action='store_true', help="Only print the summary and the fixes")
+    replay_parser.set_defaults(handler=replay)
+
+    analyze_parser = commands.add_parser('analyze', help="Analyze recorded Wine logs offline, on all cores")
+    analyze_parser.add_argument('logs', nargs='+', help="WINEDEBUG logs")
+    analyze_parser.add_argument('--workers', type=int, help="Processes (default: one per core)")
+    analyze_parser.add_argument('--chunk-mb', type=int, default=32, help="Size of the pieces the logs are split into")
+    analyze_parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    analyze_parser.set_defaults(handler=analyze)
+
+    prescan_parser = commands.add_parser('prescan', help="Find and fix missing DLLs before an application's first launch")
+    prescan_parser.add_argument('path', help="The application's .exe or directory")
+    prescan_parser.add_argument('--prefix', help="The WINEPREFIX (default: $WINEPREFIX or ~/.wine)")
+    prescan_parser.add_argument('--apply', action='store_true', help="Install the fixes found")
+    prescan_parser.add_argument('--workers', type=int, help="Processes reading files (default: one per core)")
+    prescan_parser.add_argument('--no-cache', action='store_true', help="Read every file, even if it was scanned before")
+    prescan_parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    prescan_parser.set_defaults(handler=prescan)
+
+    outcomes_parser = commands.add_parser('outcomes', help="Show how applied fixes worked out")
+    outcomes_parser.add_argument('--prefix', help="Only this WINEPREFIX")
+    outcomes_parser.add_argument('--limit', type=int, default=50, help="The number of recent outcomes to show")
+    outcomes_parser.add_argument('--json', action='store_true', help="Print the outcomes and rules as JSON")
+    outcomes_parser.set_defaults(handler=outcomes)
+
+    template_parser = commands.add_parser('template', help="Manage prefix templates")
+    template_actions = template_parser.add_subparsers(dest='action', required=True)
+    template_actions.add_parser('list', help="List the templates, most recently used first")
+    capture_parser = template_actions.add_parser('capture', help="Capture a prefix's applied fixes as a template")
+    capture_parser.add_argument('prefix')
+    clone_parser = template_actions.add_parser('clone', help="Provision a new prefix from a template")
+    clone_parser.add_argument('prefix', help="The new prefix")
+    clone_parser.add_argument('--key', help="The template to clone (see template list); by default the most recently used one")
+    clone_parser.add_argument('--verbs', help="Comma-separated winetricks verbs; the template covering most of them is used")
+    clone_parser.add_argument('--apply', action='store_true', help="Install the verbs the template does not have")
+    clone_parser.add_argument('--replace', action='store_true', help="Move an existing (broken) prefix aside first")
+    clone_parser.add_argument('--method', choices=('auto', 'reflink', 'hardlink', 'copy'), help="Overrides templates.clone_method")
+    template_parser.set_defaults(handler=template)
+    return parser
+
+def main(argv=None):
     """Main entry point for the application."""
-    if len(sys.argv) > 1 and sys.argv[1] == '--service':
+    args = build_parser().parse_args(argv)
+    if args.service:
         # This is the service process
-        run_monitor_loop()
+        handler = run_service
     else:
-        # Launch the TUI
-        app = WinRunAIApp()
-        app.run()
+        handler = getattr(args, 'handler', run_tui)
+    return handler(args) or 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
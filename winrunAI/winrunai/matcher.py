@@ -0,0 +1,189 @@
+from collections import deque
+
+from .logfilter import parse_wine_line
+
+# Sentinel rule index meaning "no rule ends at this state".
+NO_MATCH = float('inf')
+
+class RuleMatcher:
+    """
+    An Aho-Corasick automaton built over the lowercased error patterns of the
+    knowledge base rules.
+
+    Matching a line is a single pass over its characters, so the cost of a
+    lookup does not grow with the number of rules loaded.
+    """
+    def __init__(self, rules):
+        """
+        Builds the automaton.
+
+        Args:
+            rules: A sequence of rule dictionaries (with at least a 'pattern' key)
+                   in priority order. When several patterns occur in the same
+                   line, the rule that comes first in this sequence wins.
+        """
+        self.rules = list(rules)
+        self._goto = [{}]
+        self._fail = [0]
+        # For every state, the lowest rule index whose pattern ends there,
+        # either directly or through the failure chain.
+        self._best = [NO_MATCH]
+        # The rule indexes whose pattern ends exactly at each state, and the
+        # nearest state on the failure chain that has any (0 if none).
+        self._ends = [[]]
+        self._output_link = [0]
+
+        for index, rule in enumerate(self.rules):
+            self._add_pattern(rule['pattern'].lower(), index)
+        self._link()
+
+    def _add_pattern(self, pattern, index):
+        state = 0
+        for ch in pattern:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][ch] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._best.append(NO_MATCH)
+                self._ends.append([])
+                self._output_link.append(0)
+            state = next_state
+        self._best[state] = min(self._best[state], index)
+        self._ends[state].append(index)
+
+    def _link(self):
+        """Computes failure links breadth-first and folds outputs along them."""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, child in self._goto[state].items():
+                queue.append(child)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(ch, 0)
+                self._fail[child] = target if target != child else 0
+                self._best[child] = min(self._best[child], self._best[self._fail[child]])
+                link = self._fail[child]
+                self._output_link[child] = link if self._ends[link] else self._output_link[link]
+
+    def first_match(self, text: str):
+        """
+        Returns the highest-priority rule whose pattern is a case-insensitive
+        substring of `text`, or None if no rule matches.
+        """
+        goto, fail, best = self._goto, self._fail, self._best
+        state = 0
+        found = best[0]  # An empty pattern matches every line.
+        for ch in text.lower():
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if best[state] < found:
+                found = best[state]
+                if found == 0:
+                    break
+
+        if found == NO_MATCH:
+            return None
+        return self.rules[found]
+
+    def all_matches(self, text: str):
+        """
+        Returns every rule whose pattern is a case-insensitive substring of
+        `text`, in priority order.
+        """
+        goto, fail, ends, output_link = self._goto, self._fail, self._ends, self._output_link
+        state = 0
+        found = set(ends[0])
+        for ch in text.lower():
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            output = state if ends[state] else output_link[state]
+            while output:
+                found.update(ends[output])
+                output = output_link[output]
+        return [self.rules[index] for index in sorted(found)]
+
+    def __len__(self):
+        return len(self.rules)
+
+def rule_scope(pattern: str):
+    """
+    Derives a rule's (line_class, channel) scope from its pattern: a pattern
+    like 'err:ole:CoGetClassObject' only occurs in err:ole lines. Either part
+    is None when the pattern does not name it.
+    """
+    line = parse_wine_line(pattern)
+    if line is None:
+        return None, None
+    return line.line_class, line.channel or None
+
+class BucketedMatcher:
+    """
+    Matches Wine debug lines only against the rules for their debug class and
+    channel, so an err:module line is checked against the module rules and a
+    fixme:d3d line against the d3d ones.
+
+    A rule's 'line_class' and 'channel' restrict it to those lines; a missing
+    or None value matches any. Lines that are not Wine debug lines are checked
+    against the unscoped rules. Each (class, channel) bucket gets its own
+    RuleMatcher, built the first time a line of that kind is seen.
+    """
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._buckets = {}
+
+    def bucket(self, line_class=None, channel=None) -> RuleMatcher:
+        """Returns the RuleMatcher over the rules that apply to a class and channel."""
+        key = (line_class, channel)
+        matcher = self._buckets.get(key)
+        if matcher is None:
+            matcher = RuleMatcher([
+                rule for rule in self.rules
+                if rule.get('line_class') in (None, line_class) and rule.get('channel') in (None, channel)
+            ])
+            # Another thread may build the same bucket; either copy will do.
+            self._buckets[key] = matcher
+        return matcher
+
+    def bucket_for(self, text: str) -> RuleMatcher:
+        line = parse_wine_line(text.lstrip())
+        if line is None:
+            return self.bucket()
+        return self.bucket(line.line_class, line.channel)
+
+    def first_match(self, text: str):
+        """Returns the highest-priority rule that applies to and occurs in `text`, or None."""
+        matcher = self.bucket_for(text)
+        return matcher.first_match(text) if matcher.rules else None
+
+    def all_matches(self, text: str):
+        """Returns every rule that applies to and occurs in `text`, in priority order."""
+        matcher = self.bucket_for(text)
+        return matcher.all_matches(text) if matcher.rules else []
+
+    def __len__(self):
+        return len(self.rules)
+
+if __name__ == '__main__':
+    # Example usage:
+    matcher = RuleMatcher([
+        {'pattern': 'msvcp140.dll'},
+        {'pattern': 'err:module'},
+        {'pattern': 'd3d11.dll'},
+    ])
+
+    test_error = "002c:err:module:import_dll Library MSVCP140.dll not found."
+    print(f"Best match for '{test_error}': {matcher.first_match(test_error)}")
+    print(f"All matches: {matcher.all_matches(test_error)}")
+
+    bucketed = BucketedMatcher([
+        {'pattern': 'msvcp140.dll', 'line_class': 'err', 'channel': 'module'},
+        {'pattern': 'fixme:d3d:wined3d_select_feature_level', 'line_class': 'fixme', 'channel': 'd3d'},
+    ])
+    print(f"Bucketed match: {bucketed.first_match(test_error)}")
+    print(f"Rules checked for a fixme:d3d line: {len(bucketed.bucket('fixme', 'd3d'))}")
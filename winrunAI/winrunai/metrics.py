@@ -0,0 +1,293 @@
+import os
+import sys
+import json
+import time
+import bisect
+import threading
+import socketserver
+from pathlib import Path
+from collections import Counter as _Tally
+from http.server import BaseHTTPRequestHandler
+
+from .control import private_umask
+
+# Histogram bucket upper bounds, in seconds.
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+DURATION_BUCKETS = (0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+
+class Counter:
+    """A value that only goes up."""
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+class Gauge:
+    """A value that is set, or read from a function when collected."""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, function=None):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return 0
+        return self.value
+
+class Histogram:
+    """Counts observations in buckets, with their count and sum."""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        """A context manager that observes the duration of its block."""
+        return _Timer(self)
+
+    def snapshot(self):
+        with self._lock:
+            cumulative, total = [], 0
+            for count in self.counts:
+                total += count
+                cumulative.append(total)
+            return {
+                'count': self.count,
+                'sum': self.sum,
+                'buckets': dict(zip([*map(str, self.buckets), '+Inf'], cumulative)),
+            }
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+class MetricsRegistry:
+    """The service's metrics, collected as JSON or Prometheus text."""
+    def __init__(self, prefix='winrunai_'):
+        self.prefix = prefix
+        self._metrics = {}
+
+    def _register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text):
+        return self._metrics.get(name) or self._register(Counter(name, help_text))
+
+    def gauge(self, name, help_text, function=None):
+        gauge = self._metrics.get(name) or self._register(Gauge(name, help_text))
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self._metrics.get(name) or self._register(Histogram(name, help_text, buckets))
+
+    def snapshot(self):
+        """Returns all metrics as a dict of name -> value (or histogram dict)."""
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def prometheus(self):
+        """Renders all metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, metric in self._metrics.items():
+            full_name = self.prefix + name
+            lines.append(f"# HELP {full_name} {metric.help}")
+            lines.append(f"# TYPE {full_name} {metric.kind}")
+            value = metric.snapshot()
+            if metric.kind == 'histogram':
+                for bound, count in value['buckets'].items():
+                    lines.append(f'{full_name}_bucket{{le="{bound}"}} {count}')
+                lines.append(f"{full_name}_sum {value['sum']}")
+                lines.append(f"{full_name}_count {value['count']}")
+            else:
+                lines.append(f"{full_name} {value}")
+        return "\n".join(lines) + "\n"
+
+# The service's metrics, updated from the hot paths.
+metrics = MetricsRegistry()
+LINES_READ = metrics.counter('lines_read_total', "Log lines read from monitored processes.")
+LINES_MATCHED = metrics.counter('lines_matched_total', "Error lines that matched at least one rule.")
+ENGINE_LOOKUP_SECONDS = metrics.histogram('engine_lookup_seconds', "Time to get a suggestion for an error line.")
+EXECUTOR_QUEUE_WAIT_SECONDS = metrics.histogram('executor_queue_wait_seconds', "Time fixes waited in the action queue.", DURATION_BUCKETS)
+TOOL_RUN_SECONDS = metrics.histogram('tool_run_seconds', "Run time of winetricks and regedit.", DURATION_BUCKETS)
+SCAN_SECONDS = metrics.histogram('scan_seconds', "Duration of /proc scans for Wine processes.")
+LOG_RECORDS_DROPPED = metrics.gauge('log_records_dropped', "Log records dropped because the log queue was full.")
+ANALYZER_THREADS_ACTIVE = metrics.gauge('analyzer_threads_active', "Analysis worker threads currently analyzing lines.")
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path in ('/', '/metrics'):
+            body = self.server.registry.prometheus().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body = json.dumps(self.server.registry.snapshot()).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return 'local'
+
+    def log_message(self, format, *args):
+        pass
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+class MetricsServer:
+    """
+    Serves the metrics over HTTP on a Unix domain socket:
+    GET /metrics for Prometheus text, GET /metrics.json for JSON, e.g.
+    `curl --unix-socket $TMPDIR/winrunai-metrics.sock http://localhost/metrics`.
+    """
+    def __init__(self, path, registry: MetricsRegistry = metrics):
+        self.path = str(path)
+        try:
+            os.unlink(self.path) # Left over from a previous run
+        except FileNotFoundError:
+            pass
+        with private_umask():
+            self._server = _UnixHTTPServer(self.path, _MetricsHandler)
+        self._server.registry = registry
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+class SamplingProfiler:
+    """
+    A low-overhead statistical profiler. A background thread records the
+    stack of every other thread each `interval` seconds; the report lists,
+    per function, how often it was running (self) or on the stack (total),
+    and the estimated time from that.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self._self = _Tally()
+        self._total = _Tally()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._started = None
+
+    def start(self):
+        self._started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                self.samples += 1
+                seen = set()
+                leaf = True
+                while frame is not None:
+                    code = frame.f_code
+                    key = (code.co_filename, code.co_firstlineno, code.co_name)
+                    if leaf:
+                        self._self[key] += 1
+                        leaf = False
+                    if key not in seen:
+                        seen.add(key)
+                        self._total[key] += 1
+                    frame = frame.f_back
+
+    def report(self, top=40):
+        """Returns the per-function timings as text, busiest functions first."""
+        elapsed = (time.monotonic() - self._started) if self._started else 0.0
+        lines = [
+            f"Sampling profile: {self.samples} samples every {self.interval * 1000:.1f}ms over {elapsed:.1f}s",
+            f"{'self':>8} {'total':>8} {'self s':>8} {'total s':>8}  function",
+        ]
+        for key, total in self._total.most_common(top):
+            filename, line, name = key
+            own = self._self.get(key, 0)
+            lines.append(
+                f"{own:8d} {total:8d} {own * self.interval:8.2f} {total * self.interval:8.2f}  "
+                f"{name} ({os.path.basename(filename)}:{line})"
+            )
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path, top=40):
+        with open(path, 'w') as output:
+            output.write(self.report(top))
+
+def profile_path(name):
+    """Where the sampling profile of `name` (e.g. 'service') is written."""
+    return Path(os.environ.get("TMPDIR", "/tmp")) / f"winrunai_profile_{name}.txt"
+
+if __name__ == '__main__':
+    # Example usage:
+    LINES_READ.inc(42)
+    with ENGINE_LOOKUP_SECONDS.time():
+        time.sleep(0.002)
+    print(metrics.prometheus())
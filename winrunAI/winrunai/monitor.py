@@ -1,46 +1,194 @@
-import psutil
 import os
 
+PROC_DIR = "/proc"
+
 def get_wine_prefix_from_environ(environ):
     """Extracts the WINEPREFIX from a process's environment variables."""
     return environ.get("WINEPREFIX", os.path.expanduser("~/.wine"))
 
+def is_wine_process_name(name):
+    """Checks whether a process name belongs to Wine (wine, wineserver, winedevice.exe...)."""
+    return 'wine' in name.lower()
+
+def _read(pid, name, proc_dir=PROC_DIR):
+    with open(f"{proc_dir}/{pid}/{name}", "rb") as f:
+        return f.read()
+
+def read_comm(pid, proc_dir=PROC_DIR):
+    """Reads a process's name from /proc/<pid>/comm."""
+    return _read(pid, "comm", proc_dir).rstrip(b"\n").decode("utf-8", errors="replace")
+
+def read_start_time(pid, proc_dir=PROC_DIR):
+    """
+    Reads a process's start time (in clock ticks since boot) from /proc/<pid>/stat.
+    Together with the pid it identifies a process even if the pid is reused.
+    """
+    stat = _read(pid, "stat", proc_dir)
+    # The name field may contain spaces and parentheses; the remaining fields
+    # start after the last ')'. starttime is field 22, i.e. the 20th after it.
+    return int(stat[stat.rindex(b")") + 2:].split()[19])
+
+def read_identity(pid, proc_dir=PROC_DIR):
+    """
+    Reads a process's name and start time with a single read of
+    /proc/<pid>/stat. The name is the same as in /proc/<pid>/comm, and
+    changes when the process execs another program.
+
+    Returns:
+        tuple: (comm, start_time)
+    """
+    stat = _read(pid, "stat", proc_dir)
+    end = stat.rindex(b")")
+    comm = stat[stat.index(b"(") + 1:end].decode("utf-8", errors="replace")
+    return comm, int(stat[end + 2:].split()[19])
+
+def read_cmdline(pid, proc_dir=PROC_DIR):
+    data = _read(pid, "cmdline", proc_dir)
+    return [arg.decode("utf-8", errors="replace") for arg in data.split(b"\0") if arg]
+
+def read_environ(pid, proc_dir=PROC_DIR):
+    data = _read(pid, "environ", proc_dir)
+    environ = {}
+    for entry in data.split(b"\0"):
+        key, sep, value = entry.partition(b"=")
+        if sep:
+            environ[key.decode("utf-8", errors="replace")] = value.decode("utf-8", errors="replace")
+    return environ
+
+class _Entry:
+    """The cached classification of one pid, valid for its name and start time."""
+    __slots__ = ('is_wine', 'start_time', 'comm')
+
+    def __init__(self, is_wine, start_time, comm):
+        self.is_wine = is_wine
+        self.start_time = start_time
+        self.comm = comm
+
+class ProcessScanner:
+    """
+    An incremental scanner for running Wine processes.
+
+    Each scan lists /proc and reads `/proc/<pid>/stat` of each pid, which
+    gives its name and start time in one read. The classification is cached
+    per pid and is only redone when either changes: a reused pid has a new
+    start time, and a launcher script that `exec`s wine gets a new name. The
+    command line and environment are only read for Wine processes, once,
+    when they are found.
+    """
+    def __init__(self, proc_dir=PROC_DIR):
+        self.proc_dir = proc_dir
+        self._entries = {}
+        self.wine_processes = {}  # {pid: proc_info} for the Wine processes currently running
+
+    def _classify(self, pid, start_time):
+        """Returns the proc_info of a Wine process."""
+        try:
+            cmdline = read_cmdline(pid, self.proc_dir)
+        except PermissionError:
+            cmdline = []
+        try:
+            proc_environ = read_environ(pid, self.proc_dir)
+        except PermissionError:
+            proc_environ = {} # Could not get environment
+
+        return {
+            'pid': pid,
+            'cmdline': cmdline,
+            'environ': proc_environ,
+            'wineprefix': get_wine_prefix_from_environ(proc_environ),
+            'start_time': start_time,
+        }
+
+    def _update(self, pid, added, removed):
+        """Re-classifies a pid if its name or start time changed since it was last seen."""
+        entry = self._entries.get(pid)
+        try:
+            comm, start_time = read_identity(pid, self.proc_dir)
+        except (OSError, ValueError, IndexError):
+            # Terminated, or its entry is not readable.
+            removed += self.discard([pid])
+            return
+        if entry is not None and entry.start_time == start_time and entry.comm == comm:
+            return
+
+        is_wine = is_wine_process_name(comm)
+        if entry is not None and entry.start_time == start_time and entry.is_wine == is_wine:
+            entry.comm = comm   # exec'd another program of the same kind
+            return
+        if entry is not None and entry.is_wine:
+            del self.wine_processes[pid]
+            removed.append(pid)
+        entry = self._entries[pid] = _Entry(False, start_time, comm)
+        if not is_wine:
+            return
+        try:
+            proc_info = self._classify(pid, start_time)
+        except (FileNotFoundError, ProcessLookupError):
+            return
+        entry.is_wine = True
+        self.wine_processes[pid] = proc_info
+        added.append(proc_info)
+
+    def scan(self):
+        """
+        Updates the set of known Wine processes.
+
+        Returns:
+            tuple: (added, removed) where `added` is a list of proc_info dicts
+            ('pid', 'cmdline', 'environ', 'wineprefix', 'start_time') for Wine
+            processes that appeared since the last scan and `removed` is a list
+            of pids that went away.
+        """
+        pids = {int(name) for name in os.listdir(self.proc_dir) if name.isdigit()}
+        added, removed = [], []
+
+        for pid in self._entries.keys() - pids:
+            if self._entries.pop(pid).is_wine:
+                del self.wine_processes[pid]
+                removed.append(pid)
+
+        for pid in pids:
+            self._update(pid, added, removed)
+
+        return added, removed
+
+    def refresh(self, pids):
+        """
+        Re-classifies specific pids right away, for example after an event
+        reported that they exec'd or changed their name.
+
+        Returns:
+            tuple: (added, removed), as for scan().
+        """
+        added, removed = [], []
+        for pid in pids:
+            self._update(pid, added, removed)
+        return added, removed
+
+    def discard(self, pids):
+        """
+        Forgets pids that are known to have exited.
+
+        Returns:
+            list: The pids among them that were Wine processes.
+        """
+        removed = []
+        for pid in pids:
+            entry = self._entries.pop(pid, None)
+            if entry is not None and entry.is_wine:
+                del self.wine_processes[pid]
+                removed.append(pid)
+        return removed
+
 def find_wine_processes_iter():
     """
     A generator that yields information about running Wine processes.
 
     Yields:
-        dict: A dictionary containing 'pid', 'cmdline', 'environ', and 'wineprefix'.
+        dict: A dictionary containing 'pid', 'cmdline', 'environ', 'wineprefix' and 'start_time'.
     """
-    # Look for 'wineserver' as it's the parent process for a Wine session.
-    # This is more reliable than looking for 'wine' which might be a short-lived process.
-    for proc in psutil.process_iter(['pid', 'name', 'cmdline', 'environ']):
-        try:
-            # Check if process name is 'wineserver' or a 'wine' related process
-            if proc.info['name'] and ('wine' in proc.info['name'].lower() or 'wineserver' in proc.info['name'].lower()):
-
-                # We need the environment to determine the WINEPREFIX
-                proc_environ = proc.info.get('environ')
-                if not proc_environ:
-                    # Fallback for processes where we can't get environ directly
-                    try:
-                        # On Linux, /proc/{pid}/environ can be read
-                        with open(f"/proc/{proc.pid}/environ", "r") as f:
-                            proc_environ = dict(line.strip().split('=', 1) for line in f if '=' in line)
-                    except (IOError, FileNotFoundError):
-                        proc_environ = {} # Could not get environment
-
-                wine_prefix = get_wine_prefix_from_environ(proc_environ)
-
-                yield {
-                    'pid': proc.info['pid'],
-                    'cmdline': proc.info['cmdline'],
-                    'environ': proc_environ,
-                    'wineprefix': wine_prefix,
-                }
-        except (psutil.NoSuchProcess, psutil.AccessDenied):
-            # Process might have terminated or we don't have permission to access it
-            continue
+    added, _ = ProcessScanner().scan()
+    yield from added
 
 if __name__ == '__main__':
     # Example usage:
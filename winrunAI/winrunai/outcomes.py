@@ -0,0 +1,231 @@
+import json
+import time
+import threading
+
+from .config import current_config
+from .database import DB_FILE, connect, decayed, effective_confidence, initialize_database, rule_index
+
+# Outcome statuses: a run that failed; a fix that succeeded and waits for the
+# next run of the prefix; and, after that run, whether its error came back.
+OUTCOME_STATUSES = ('failed', 'pending', 'verified', 'recurred')
+
+class OutcomeTracker:
+    """
+    Records the outcome of every fix run per WINEPREFIX and feeds it back into
+    the confidence of the rules that suggested the fix.
+
+    A run that fails counts against its rules right away. A successful run is
+    pending until the prefix runs again: if one of the errors that triggered
+    it shows up in that run the fix did not help, otherwise it did. Outcomes
+    are kept as success and failure weights on the rules that decay with a
+    half-life of `ai_engine.outcome_half_life_days`; the rule index turns them
+    into the effective confidence when it is rebuilt (see
+    database.effective_confidence), so lookups do not pay for it.
+    """
+    def __init__(self, db_file=DB_FILE):
+        self.db_file = db_file
+        initialize_database(db_file)
+        self._lock = threading.Lock()
+        self._pending = {}    # wineprefix -> [pending outcome dicts], loaded on first use
+
+    def _connect(self):
+        return connect(self.db_file, isolation_level=None)
+
+    def _pending_for(self, wineprefix: str):
+        pending = self._pending.get(wineprefix)
+        if pending is None:
+            conn = self._connect()
+            try:
+                rows = conn.execute(
+                    "SELECT id, tool, argument, patterns, started_at + duration FROM fix_outcomes "
+                    "WHERE wineprefix = ? AND status = 'pending'", (wineprefix,)
+                ).fetchall()
+            finally:
+                conn.close()
+            pending = self._pending[wineprefix] = [
+                {'id': id, 'tool': tool, 'argument': argument, 'patterns': json.loads(patterns), 'finished': finished}
+                for id, tool, argument, patterns, finished in rows
+            ]
+        return pending
+
+    def has_pending(self, wineprefix: str) -> bool:
+        """Whether fixes applied to a prefix still wait for their outcome. Cheap after the first call."""
+        with self._lock:
+            return bool(self._pending_for(wineprefix))
+
+    def record_run(self, wineprefix: str, tool: str, argument: str, patterns, exit_code, duration: float, success: bool):
+        """
+        Records one applied fix: its exit code (None if no tool had to run,
+        e.g. registry values written to the hive files), how long it took,
+        and the patterns of the rules that suggested it.
+        """
+        patterns = sorted(set(pattern for pattern in patterns or () if pattern))
+        now = time.time()
+        status = 'pending' if success else 'failed'
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                cursor = conn.execute(
+                    'INSERT INTO fix_outcomes (wineprefix, tool, argument, patterns, started_at, duration, exit_code, status) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (wineprefix, tool, argument, json.dumps(patterns), now - duration, duration, exit_code, status)
+                )
+                if not success:
+                    self._adjust(conn, tool, argument, patterns, success=False, now=now)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+        if success:
+            with self._lock:
+                # A prefix not loaded yet gets the new outcome with the others when it is.
+                pending = self._pending.get(wineprefix)
+                if pending is not None:
+                    pending.append(
+                        {'id': cursor.lastrowid, 'tool': tool, 'argument': argument, 'patterns': patterns, 'finished': now}
+                    )
+        else:
+            rule_index.invalidate()
+
+    def observe(self, wineprefix: str, rules, run_started: float):
+        """
+        Checks the rules matching an error of a run of the prefix that started
+        at `run_started` against its pending fixes. A fix applied before the
+        run whose error (a pattern or the fix itself) shows up again recurred.
+
+        Returns:
+            The fixes that recurred, as (tool, argument) tuples.
+        """
+        patterns = {rule['pattern'] for rule in rules}
+        fixes = {(rule['type'], rule['argument']) for rule in rules}
+        with self._lock:
+            pending = self._pending_for(wineprefix)
+            recurred = [
+                outcome for outcome in pending
+                if outcome['finished'] < run_started
+                and ((outcome['tool'], outcome['argument']) in fixes or patterns.intersection(outcome['patterns']))
+            ]
+            if not recurred:
+                return []
+            for outcome in recurred:
+                pending.remove(outcome)
+        self._resolve(recurred, 'recurred')
+        return [(outcome['tool'], outcome['argument']) for outcome in recurred]
+
+    def run_ended(self, wineprefix: str, run_started: float):
+        """
+        Called when every process of a prefix has exited. The fixes applied
+        before that run whose errors did not come back in it are verified.
+        """
+        with self._lock:
+            pending = self._pending.get(wineprefix)
+            if not pending:
+                return []
+            verified = [outcome for outcome in pending if outcome['finished'] < run_started]
+            for outcome in verified:
+                pending.remove(outcome)
+        if verified:
+            self._resolve(verified, 'verified')
+        return [(outcome['tool'], outcome['argument']) for outcome in verified]
+
+    def _resolve(self, outcomes, status):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for outcome in outcomes:
+                    conn.execute('UPDATE fix_outcomes SET status = ? WHERE id = ?', (status, outcome['id']))
+                    self._adjust(conn, outcome['tool'], outcome['argument'], outcome['patterns'],
+                                 success=status == 'verified', now=now)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+        rule_index.invalidate()
+
+    def _adjust(self, conn, tool, argument, patterns, success, now):
+        """
+        Adds one success or failure to the rules behind a fix: those with one
+        of its patterns, or every rule for the fix when it has none. The
+        existing weights are decayed to `now` first.
+        """
+        half_life = current_config().get('ai_engine', {}).get('outcome_half_life_days', 30) * 86400
+        query = 'SELECT id, success_weight, failure_weight, outcome_time FROM rules WHERE fix_type = ? AND fix_argument = ?'
+        parameters = [tool, argument]
+        if patterns:
+            query += f" AND error_pattern IN ({', '.join('?' * len(patterns))})"
+            parameters += patterns
+        for id, successes, failures, outcome_time in conn.execute(query, parameters).fetchall():
+            successes = decayed(successes, outcome_time, now, half_life) + (1 if success else 0)
+            failures = decayed(failures, outcome_time, now, half_life) + (0 if success else 1)
+            conn.execute(
+                'UPDATE rules SET success_weight = ?, failure_weight = ?, outcome_time = ? WHERE id = ?',
+                (successes, failures, now, id)
+            )
+
+    def history(self, wineprefix: str = None, limit: int = 50):
+        """Returns the most recent outcomes (of one prefix, or all), newest first, as dicts."""
+        query = 'SELECT wineprefix, tool, argument, patterns, started_at, duration, exit_code, status FROM fix_outcomes'
+        parameters = []
+        if wineprefix:
+            query += ' WHERE wineprefix = ?'
+            parameters.append(wineprefix)
+        query += ' ORDER BY id DESC LIMIT ?'
+        parameters.append(limit)
+        conn = self._connect()
+        try:
+            rows = conn.execute(query, parameters).fetchall()
+        finally:
+            conn.close()
+        return [
+            {
+                'wineprefix': prefix, 'tool': tool, 'argument': argument, 'patterns': json.loads(patterns),
+                'started_at': started_at, 'duration': duration, 'exit_code': exit_code, 'status': status,
+            }
+            for prefix, tool, argument, patterns, started_at, duration, exit_code, status in rows
+        ]
+
+    def rule_confidences(self):
+        """
+        Returns the rules with recorded outcomes, as dicts with 'pattern',
+        'type', 'argument', 'base_confidence', 'successes' and 'failures'
+        (decayed to now) and 'confidence', the effective confidence.
+        """
+        settings = current_config().get('ai_engine', {})
+        half_life = settings.get('outcome_half_life_days', 30) * 86400
+        prior_weight = settings.get('outcome_prior_weight', 20)
+        now = time.time()
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                'SELECT error_pattern, fix_type, fix_argument, confidence, success_weight, failure_weight, outcome_time '
+                'FROM rules WHERE outcome_time IS NOT NULL ORDER BY id'
+            ).fetchall()
+        finally:
+            conn.close()
+        rules = []
+        for pattern, tool, argument, confidence, successes, failures, outcome_time in rows:
+            successes = decayed(successes, outcome_time, now, half_life)
+            failures = decayed(failures, outcome_time, now, half_life)
+            rules.append({
+                'pattern': pattern, 'type': tool, 'argument': argument, 'base_confidence': confidence,
+                'successes': successes, 'failures': failures,
+                'confidence': effective_confidence(confidence, successes, failures, prior_weight),
+            })
+        return rules
+
+if __name__ == '__main__':
+    # Example usage: show the recorded outcomes and the rules they adjusted.
+    tracker = OutcomeTracker()
+    for outcome in tracker.history():
+        print(f"{outcome['status']:9s} {outcome['tool']} {outcome['argument'].splitlines()[0]} in {outcome['wineprefix']} "
+              f"(exit code {outcome['exit_code']}, {outcome['duration']:.1f}s)")
+    for rule in tracker.rule_confidences():
+        print(f"{rule['pattern']}: {rule['base_confidence']:.0%} -> {rule['confidence']:.0%} "
+              f"({rule['successes']:.1f} successes, {rule['failures']:.1f} failures)")
@@ -0,0 +1,351 @@
+import os
+import mmap
+import time
+import struct
+import hashlib
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from .correlator import FixCorrelator
+from .database import DB_FILE, connect, initialize_database
+from .prefixstate import DLL_DIRECTORIES, prefix_states
+
+# Files that are scanned in a directory.
+PE_EXTENSIONS = ('.exe', '.dll')
+
+# The PE data directories holding the import and delay-load import tables.
+IMPORT_DIRECTORY = 1
+DELAY_IMPORT_DIRECTORY = 13
+MAX_DESCRIPTORS = 4096
+MAX_NAME_LENGTH = 256
+
+# How Wine reports a missing DLL, so the knowledge base rules for it apply.
+IMPORT_ERROR = 'err:module:import_dll Library {dll} (which is needed by L"{module}") not found'
+
+# Fewer files than this are read in this process; starting workers costs more.
+PARALLEL_THRESHOLD = 32
+
+PEImports = namedtuple('PEImports', 'bits imports delay_imports')
+
+class PEFormatError(ValueError):
+    """The file is not a PE executable or DLL, or its headers are damaged."""
+
+def _rva_to_offset(sections, rva):
+    for virtual_address, virtual_size, raw_size, raw_offset in sections:
+        if virtual_address <= rva < virtual_address + max(virtual_size, raw_size):
+            return rva - virtual_address + raw_offset
+    # Before the first section: the headers, mapped as they are in the file.
+    if not sections or rva < sections[0][0]:
+        return rva
+    raise PEFormatError(f"RVA {rva:#x} is outside every section")
+
+def _read_name(data, offset):
+    end = data.find(b'\0', offset, offset + MAX_NAME_LENGTH)
+    if end < 0:
+        raise PEFormatError(f"Unterminated DLL name at {offset:#x}")
+    return data[offset:end].decode('ascii', 'replace').lower()
+
+def parse_imports(data) -> PEImports:
+    """
+    Reads the imported DLL names from the headers of a PE file, without
+    copying it: `data` can be an mmap, and parsing only touches the pages
+    holding the headers and the import tables. (read_imports still reads
+    the whole file, to hash it.)
+
+    Returns:
+        PEImports: (bits, imports, delay_imports), with bits 32 or 64 and
+        the lowercase DLL names in table order.
+
+    Raises:
+        PEFormatError: If the data is not a well-formed PE file.
+    """
+    try:
+        if data[:2] != b'MZ':
+            raise PEFormatError("No MZ header")
+        pe_offset, = struct.unpack_from('<I', data, 0x3C)
+        if data[pe_offset:pe_offset + 4] != b'PE\0\0':
+            raise PEFormatError("No PE signature")
+        section_count, = struct.unpack_from('<H', data, pe_offset + 6)
+        optional_size, = struct.unpack_from('<H', data, pe_offset + 20)
+        optional = pe_offset + 24
+        magic, = struct.unpack_from('<H', data, optional)
+        if magic == 0x10B:
+            bits = 32
+            image_base, = struct.unpack_from('<I', data, optional + 28)
+            directory_count, = struct.unpack_from('<I', data, optional + 92)
+            directories = optional + 96
+        elif magic == 0x20B:
+            bits = 64
+            image_base, = struct.unpack_from('<Q', data, optional + 24)
+            directory_count, = struct.unpack_from('<I', data, optional + 108)
+            directories = optional + 112
+        else:
+            raise PEFormatError(f"Unknown optional header magic {magic:#x}")
+
+        table = optional + optional_size
+        # (virtual address, virtual size, raw size, raw offset), by address.
+        sections = []
+        for index in range(section_count):
+            virtual_size, virtual_address, raw_size, raw_offset = struct.unpack_from('<IIII', data, table + 40 * index + 8)
+            sections.append((virtual_address, virtual_size, raw_size, raw_offset))
+        sections.sort()
+
+        def directory(index):
+            if index >= directory_count:
+                return 0
+            return struct.unpack_from('<I', data, directories + 8 * index)[0]
+
+        imports = []
+        rva = directory(IMPORT_DIRECTORY)
+        if rva:
+            offset = _rva_to_offset(sections, rva)
+            for index in range(MAX_DESCRIPTORS):
+                name_rva, = struct.unpack_from('<I', data, offset + 20 * index + 12)
+                if not name_rva:
+                    break
+                imports.append(_read_name(data, _rva_to_offset(sections, name_rva)))
+
+        delay_imports = []
+        rva = directory(DELAY_IMPORT_DIRECTORY)
+        if rva:
+            offset = _rva_to_offset(sections, rva)
+            for index in range(MAX_DESCRIPTORS):
+                attributes, name_rva = struct.unpack_from('<II', data, offset + 32 * index)
+                if not name_rva:
+                    break
+                if not attributes & 1:
+                    # Old-style descriptors hold virtual addresses.
+                    name_rva -= image_base
+                delay_imports.append(_read_name(data, _rva_to_offset(sections, name_rva)))
+    except struct.error as e:
+        raise PEFormatError(f"Truncated headers: {e}") from None
+    return PEImports(bits, tuple(imports), tuple(delay_imports))
+
+def read_imports(path):
+    """
+    Maps a file and reads its imports. Hashing reads every page of the
+    file; the import cache makes this happen once per new or changed file.
+
+    Returns:
+        tuple: (sha256 hex digest of the file, PEImports or None if it is not a PE file).
+    """
+    with open(path, 'rb') as pe_file:
+        try:
+            data = mmap.mmap(pe_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return hashlib.sha256().hexdigest(), None
+    with data:
+        digest = hashlib.sha256(data).hexdigest()
+        try:
+            return digest, parse_imports(data)
+        except PEFormatError:
+            return digest, None
+
+class ImportCache:
+    """
+    The imports of scanned files, kept in the knowledge base by content hash.
+    A file whose size and mtime have not changed since it was scanned is not
+    read again; a changed or new file is hashed, and files with the same
+    contents (a runtime DLL bundled with many games) share one entry.
+    """
+    def __init__(self, db_file=DB_FILE):
+        initialize_database(db_file)
+        self._conn = connect(db_file)
+
+    def lookup(self, path, stat):
+        """Returns the cached (digest, PEImports or None) of an unchanged file, or None."""
+        row = self._conn.execute(
+            'SELECT f.sha256, i.bits, i.imports, i.delay_imports FROM pe_files f JOIN pe_imports i USING (sha256) '
+            'WHERE f.path = ? AND f.size = ? AND f.mtime_ns = ?',
+            (path, stat.st_size, stat.st_mtime_ns)
+        ).fetchone()
+        if row is None:
+            return None
+        digest, bits, imports, delay_imports = row
+        if not bits:
+            return digest, None
+        return digest, PEImports(bits, tuple(imports.split()), tuple(delay_imports.split()))
+
+    def store(self, entries):
+        """Stores (path, stat, digest, PEImports or None) entries."""
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO pe_imports (sha256, bits, imports, delay_imports) VALUES (?, ?, ?, ?)',
+                [(digest, imports.bits, ' '.join(imports.imports), ' '.join(imports.delay_imports)) if imports
+                 else (digest, 0, '', '') for _, _, digest, imports in entries]
+            )
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO pe_files (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)',
+                [(path, stat.st_size, stat.st_mtime_ns, digest) for path, stat, digest, _ in entries]
+            )
+
+    def close(self):
+        self._conn.close()
+
+def find_pe_files(path):
+    """Returns the .exe and .dll files under a directory (or the file itself), sorted."""
+    if not os.path.isdir(path):
+        return [os.path.abspath(path)]
+    found = []
+    for directory, _, names in os.walk(path):
+        found.extend(os.path.join(directory, name) for name in names if name.lower().endswith(PE_EXTENSIONS))
+    return sorted(os.path.abspath(name) for name in found)
+
+def scan_files(paths, workers=None, cache: ImportCache = None):
+    """
+    Reads the imports of PE files, on a pool of `workers` processes (by
+    default one per core) when there are many to read.
+
+    Returns:
+        tuple: ({path: PEImports} for the PE files, the number taken from the cache).
+    """
+    results = {}
+    pending = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        cached = cache.lookup(path, stat) if cache else None
+        if cached is not None:
+            results[path] = cached[1]
+        else:
+            pending.append((path, stat))
+    from_cache = len(results)
+
+    workers = workers or os.cpu_count() or 1
+    names = [path for path, _ in pending]
+    if workers > 1 and len(pending) >= PARALLEL_THRESHOLD:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            read = list(pool.map(read_imports, names, chunksize=max(1, len(names) // (workers * 4))))
+    else:
+        read = [read_imports(path) for path in names]
+
+    if cache:
+        cache.store([(path, stat, digest, imports) for (path, stat), (digest, imports) in zip(pending, read)])
+    for path, (_, imports) in zip(names, read):
+        results[path] = imports
+    return {path: imports for path, imports in results.items() if imports is not None}, from_cache
+
+def _prefix_dlls(wineprefix, bits):
+    """The DLL names the prefix provides to programs of the given bitness."""
+    state = prefix_states.state(wineprefix)
+    system32, syswow64 = (state.dlls.get(directory, set()) for directory in DLL_DIRECTORIES)
+    if not system32:
+        raise FileNotFoundError(f"{wineprefix} is not an initialized WINEPREFIX (run wineboot first)")
+    # In a 64-bit prefix, 32-bit programs load from syswow64.
+    return syswow64 if bits == 32 and syswow64 else system32
+
+def missing_imports(modules: dict, wineprefix: str):
+    """
+    Resolves the imports of scanned modules as the Wine loader would: a DLL
+    is found next to the importing module, next to any scanned .exe, or in
+    the prefix's system32 (syswow64 for 32-bit programs in a 64-bit prefix),
+    which holds Wine's builtin DLLs too.
+
+    Returns:
+        dict: {missing DLL name: [modules that import it]}.
+    """
+    bundled = {}
+    for path in modules:
+        bundled.setdefault(os.path.dirname(path), set()).add(os.path.basename(path).lower())
+    application_dlls = set()
+    for path in modules:
+        if path.lower().endswith('.exe'):
+            application_dlls |= bundled[os.path.dirname(path)]
+
+    missing = {}
+    for path, imports in modules.items():
+        available = _prefix_dlls(wineprefix, imports.bits)
+        for dll in imports.imports + imports.delay_imports:
+            if dll not in available and dll not in application_dlls and dll not in bundled[os.path.dirname(path)]:
+                missing.setdefault(dll, []).append(path)
+    return missing
+
+def plan_fixes(missing: dict, wineprefix: str, engine=None):
+    """
+    Looks up the knowledge base rules for the missing DLLs, as if Wine had
+    reported each of them, and combines them into one ranked action plan.
+
+    Returns:
+        tuple: (the action plan or None, the missing DLLs no rule knows).
+    """
+    if engine is None:
+        from .engine import AIEngine
+        engine = AIEngine()
+    correlator = FixCorrelator(window=float('inf'))
+    unknown = []
+    for dll, importers in sorted(missing.items()):
+        rules = engine.find_rules(IMPORT_ERROR.format(dll=dll, module=os.path.basename(importers[0])))
+        if rules:
+            correlator.add(rules)
+        else:
+            unknown.append(dll)
+    plan = engine.make_action_plan(correlator.ranked(), wineprefix, 'Import Scan')
+    if plan:
+        plan['actions'] = [
+            action for action in plan['actions']
+            if not engine.is_fix_applied(wineprefix, (action['tool'], action['argument']))
+        ]
+        if not plan['actions']:
+            plan = None
+    return plan, unknown
+
+def prescan(path, wineprefix, workers=None, use_cache=True, engine=None, callback=None):
+    """
+    Scans an application before its first launch: reads the imports of its
+    .exe and bundled DLLs, resolves them against the WINEPREFIX, and plans
+    the fixes for the missing ones.
+
+    Args:
+        path: The application's .exe, or its directory.
+        wineprefix: The WINEPREFIX it will run in.
+        workers: Processes used to read the files (default: one per core).
+        use_cache: Whether to reuse and store imports in the knowledge base.
+        engine: The AIEngine to plan with (default: a rule-based one).
+        callback: Called with progress messages.
+
+    Returns:
+        dict: 'files', 'pe_files', 'cached', 'seconds', 'missing'
+        ({dll: [modules]}), 'unknown' (missing DLLs without a rule) and
+        'plan' (an action plan for execute_action_plan, or None).
+
+    Raises:
+        FileNotFoundError: If the prefix has not been initialized.
+    """
+    callback = callback or (lambda message: None)
+    start = time.perf_counter()
+    _prefix_dlls(wineprefix, 64)
+    files = find_pe_files(path)
+    callback(f"Scanning {len(files)} files in {path}...")
+    cache = ImportCache() if use_cache else None
+    try:
+        modules, cached = scan_files(files, workers, cache)
+    finally:
+        if cache:
+            cache.close()
+    missing = missing_imports(modules, wineprefix)
+    plan, unknown = plan_fixes(missing, wineprefix, engine)
+    return {
+        'files': len(files),
+        'pe_files': len(modules),
+        'cached': cached,
+        'seconds': round(time.perf_counter() - start, 4),
+        'missing': missing,
+        'unknown': unknown,
+        'plan': plan,
+    }
+
+if __name__ == '__main__':
+    import sys
+
+    # Example usage: python -m winrunai.pescan app.exe
+    for name in sys.argv[1:]:
+        digest, imports = read_imports(name)
+        if imports is None:
+            print(f"{name}: not a PE file")
+            continue
+        print(f"{name} ({imports.bits}-bit, sha256 {digest[:16]}...)")
+        print(f"  imports: {', '.join(imports.imports) or 'none'}")
+        print(f"  delay-loaded: {', '.join(imports.delay_imports) or 'none'}")
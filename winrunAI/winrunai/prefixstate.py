@@ -0,0 +1,229 @@
+import os
+import threading
+import time
+from pathlib import Path
+
+from .registry import RegistryDocument, hive_cache, locate_key, unapplied_changes
+
+# Wine's own DLLs in system32/syswow64 are builtin or placeholder PE files
+# that carry one of these signatures right after the DOS header.
+WINE_DLL_SIGNATURE_OFFSET = 0x40
+WINE_DLL_SIGNATURES = (b"Wine builtin DLL", b"Wine placeholder DLL")
+
+DLL_DIRECTORIES = ('drive_c/windows/system32', 'drive_c/windows/syswow64')
+DLL_OVERRIDES_KEY = 'software\\wine\\dlloverrides'
+
+# Parsed regedit fixes kept by PrefixStateIndex; the cache starts over when full.
+MAX_DOCUMENTS = 512
+
+def _signature(path):
+    """Returns (mtime_ns, size) of a file, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+class PrefixState:
+    """
+    What is installed in one WINEPREFIX: the winetricks verbs listed in
+    winetricks.log, the DLL files in system32 and syswow64, and the DLL
+    overrides in user.reg.
+
+    refresh() only re-reads what changed: a directory is re-listed when its
+    mtime changes, and new lines are read from the end of winetricks.log.
+    `lock` serializes refreshes of this prefix only. `version` is replaced on
+    every refresh, and `checks` holds fix checks with the state they saw.
+    """
+    def __init__(self, wineprefix):
+        self.wineprefix = Path(wineprefix)
+        self.lock = threading.Lock()
+        self.next_check = 0.0   # monotonic time of the next change check
+        self.refreshed = False
+        self.version = object()
+        self.checks = {}        # (tool, argument, pattern) -> (signature, installed)
+        self.verbs = set()
+        self.dlls = {}          # DLL directory -> set of lowercase file names
+        self._signatures = {}   # path -> signature at the last read
+        self._log_offset = 0
+        self._native = {}       # dll path -> (signature, is native)
+        self._overrides = (None, {})
+
+    def refresh(self):
+        log_path = self.wineprefix / 'winetricks.log'
+        signature = _signature(log_path)
+        if signature != self._signatures.get(log_path):
+            if signature is None or signature[1] < self._log_offset:
+                # Removed or rewritten: start over.
+                self.verbs.clear()
+                self._log_offset = 0
+            if signature is not None:
+                with open(log_path, 'rb') as log:
+                    log.seek(self._log_offset)
+                    data = log.read()
+                # Only consume complete lines; a partial one is read next time.
+                complete = data[:data.rfind(b'\n') + 1]
+                self._log_offset += len(complete)
+                self.verbs.update(line.strip() for line in complete.decode('utf-8', 'replace').splitlines() if line.strip())
+            self._signatures[log_path] = signature
+
+        for directory in DLL_DIRECTORIES:
+            path = self.wineprefix / directory
+            signature = _signature(path)
+            if signature != self._signatures.get(path):
+                try:
+                    self.dlls[directory] = {entry.name.lower() for entry in os.scandir(path)}
+                except OSError:
+                    self.dlls[directory] = set()
+                self._signatures[path] = signature
+        self.version = object()
+        self.refreshed = True
+
+    def overrides(self):
+        """Returns the DLL overrides from user.reg, as {dll name: 'native,builtin'}."""
+        values = hive_cache.read(self.wineprefix / 'user.reg').get(DLL_OVERRIDES_KEY, {})
+        if values is not self._overrides[0]:
+            self._overrides = (values, {name.lstrip('*'): data.strip('"') for name, data in values.items()})
+        return self._overrides[1]
+
+    def has_verb(self, verb: str) -> bool:
+        """True if winetricks has recorded installing the verb in this prefix."""
+        return verb in self.verbs
+
+    def has_native_dll(self, dll: str) -> bool:
+        """
+        True if a native (not Wine builtin) copy of the DLL is installed in
+        system32 or syswow64 and Wine is set to prefer it.
+        """
+        dll = dll.lower()
+        name = dll[:-4] if dll.endswith('.dll') else dll
+        filename = name + '.dll'
+        if not self.overrides().get(name, '').startswith('native'):
+            return False
+        for directory in DLL_DIRECTORIES:
+            if filename in self.dlls.get(directory, ()) and self._is_native(self.wineprefix / directory / filename):
+                return True
+        return False
+
+    def _is_native(self, path):
+        signature = _signature(path)
+        cached = self._native.get(path)
+        if cached and cached[0] == signature:
+            return cached[1]
+        try:
+            with open(path, 'rb') as dll:
+                dll.seek(WINE_DLL_SIGNATURE_OFFSET)
+                native = not dll.read(32).startswith(WINE_DLL_SIGNATURES)
+        except OSError:
+            native = False
+        self._native[path] = (signature, native)
+        return native
+
+class PrefixStateIndex:
+    """
+    The PrefixState of every WINEPREFIX seen so far, kept in a dict. A
+    prefix's files are checked for changes at most once per `check_interval`
+    seconds, so lookups cost the same however many prefixes are tracked.
+
+    The index lock only guards the dict. A prefix is refreshed under its own
+    lock, so a slow prefix (a cold system32 listing) never holds up lookups
+    in others; lookups in the same prefix meanwhile use its previous state.
+    """
+    def __init__(self, check_interval=1.0):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._states = {}   # wineprefix -> PrefixState
+        self._documents = {}  # regedit argument -> (RegistryDocument, hive file names)
+
+    def state(self, wineprefix: str) -> PrefixState:
+        with self._lock:
+            state = self._states.get(wineprefix)
+            if state is None:
+                state = self._states[wineprefix] = PrefixState(wineprefix)
+        if state.refreshed and time.monotonic() < state.next_check:
+            return state
+        # Only the first lookup of a prefix has to wait for another thread's refresh.
+        if not state.lock.acquire(blocking=not state.refreshed):
+            return state
+        try:
+            now = time.monotonic()
+            if not state.refreshed or now >= state.next_check:
+                # Set first, so an invalidate() during the refresh is kept.
+                state.next_check = now + self.check_interval
+                state.refresh()
+        finally:
+            state.lock.release()
+        return state
+
+    def invalidate(self, wineprefix: str = None):
+        """Forces a change check on the next lookup."""
+        with self._lock:
+            states = list(self._states.values()) if wineprefix is None else [self._states.get(wineprefix)]
+        for state in states:
+            if state is not None:
+                state.next_check = 0.0
+
+    def is_installed(self, wineprefix: str, tool: str, argument: str, pattern: str = None) -> bool:
+        """
+        Checks whether a fix is already in place in a WINEPREFIX.
+
+        Args:
+            wineprefix: The prefix to check.
+            tool, argument: The fix, e.g. ('winetricks', 'vcrun2019').
+            pattern: The error pattern of the rule. If it names a DLL, the
+                     fix also counts as installed when that DLL is natively
+                     installed and overridden.
+
+        Returns:
+            True if running the fix would change nothing.
+
+        A result is reused until what it depends on changes: the hive files
+        a regedit fix writes to, or, for winetricks, the prefix's state.
+        """
+        if tool == 'regedit':
+            document, hives = self._document(argument)
+            state = self.state(wineprefix)
+            signature = tuple(hive_cache.read(state.wineprefix / hive) for hive in hives)
+            check = (tool, argument, None)
+        elif tool == 'winetricks':
+            state = self.state(wineprefix)
+            signature = (state.version,)
+            check = (tool, argument, pattern)
+        else:
+            return False
+        cached = state.checks.get(check)
+        if cached and all(old is new for old, new in zip(cached[0], signature)):
+            return cached[1]
+
+        if tool == 'regedit':
+            installed = not unapplied_changes(wineprefix, document)
+        else:
+            installed = state.has_verb(argument) or (
+                bool(pattern) and pattern.lower().endswith('.dll') and state.has_native_dll(pattern)
+            )
+        state.checks[check] = (signature, installed)
+        return installed
+
+    def _document(self, argument):
+        """Returns a regedit fix parsed, with the hive files its keys are in."""
+        cached = self._documents.get(argument)
+        if cached is None:
+            document = RegistryDocument.parse(argument)
+            hives = sorted({location[0] for key, _, _ in document.values() if (location := locate_key(key))})
+            if len(self._documents) >= MAX_DOCUMENTS:
+                self._documents.clear()
+            cached = self._documents[argument] = (document, hives)
+        return cached
+
+# Shared index used by the engine and the executor.
+prefix_states = PrefixStateIndex()
+
+if __name__ == '__main__':
+    import sys
+
+    wineprefix = sys.argv[1] if len(sys.argv) > 1 else os.path.expanduser('~/.wine')
+    state = prefix_states.state(wineprefix)
+    print(f"winetricks verbs: {', '.join(sorted(state.verbs)) or 'none'}")
+    for directory, names in state.dlls.items():
+        print(f"{directory}: {len(names)} files")
+    print(f"DLL overrides: {state.overrides()}")
@@ -0,0 +1,271 @@
+import os
+import errno
+import select
+import socket
+import struct
+import time
+
+from .monitor import ProcessScanner
+from .metrics import SCAN_SECONDS
+
+# Netlink proc connector constants (linux/netlink.h, linux/connector.h, linux/cn_proc.h).
+NETLINK_CONNECTOR = 11
+NLMSG_DONE = 3
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+PROC_CN_MCAST_LISTEN = 1
+PROC_CN_MCAST_IGNORE = 2
+
+PROC_EVENT_FORK = 0x00000001
+PROC_EVENT_EXEC = 0x00000002
+PROC_EVENT_COMM = 0x00000200
+PROC_EVENT_EXIT = 0x80000000
+
+NLMSGHDR = struct.Struct('=IHHII')        # len, type, flags, seq, pid
+CN_MSG = struct.Struct('=IIIIHH')         # idx, val, seq, ack, len, flags
+PROC_EVENT_HEADER = struct.Struct('=IIQ') # what, cpu, timestamp_ns
+TWO_PIDS = struct.Struct('=ii')
+FOUR_PIDS = struct.Struct('=iiii')
+
+# With netlink events, a full /proc scan is still run this often (in seconds)
+# to recover from any missed event.
+RESYNC_INTERVAL = 300
+
+def encode_proc_event(what, pid, tgid=None, parent_pid=0, parent_tgid=0, exit_code=0):
+    """
+    Builds a netlink proc connector message, as the kernel would send it.
+    Used by FakeEventSocket to feed events to NetlinkProcessSource.
+    """
+    tgid = pid if tgid is None else tgid
+    if what == PROC_EVENT_FORK:
+        body = FOUR_PIDS.pack(parent_pid, parent_tgid, pid, tgid)
+    elif what == PROC_EVENT_EXIT:
+        body = FOUR_PIDS.pack(pid, tgid, exit_code, 0)
+    elif what == PROC_EVENT_COMM:
+        body = TWO_PIDS.pack(pid, tgid) + bytes(16)
+    else:
+        body = TWO_PIDS.pack(pid, tgid)
+    payload = PROC_EVENT_HEADER.pack(what, 0, time.monotonic_ns()) + body
+    message = CN_MSG.pack(CN_IDX_PROC, CN_VAL_PROC, 0, 0, len(payload), 0) + payload
+    return NLMSGHDR.pack(NLMSGHDR.size + len(message), NLMSG_DONE, 0, 0, 0) + message
+
+def decode_proc_events(data):
+    """
+    Parses a datagram from the proc connector.
+
+    Yields:
+        tuple: (what, pid, tgid, exit_code) for each process event in the
+        datagram. exit_code is the wait status of exit events, else None.
+    """
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        length, msg_type, _, _, _ = NLMSGHDR.unpack_from(data, offset)
+        if length < NLMSGHDR.size:
+            break
+        start = offset + NLMSGHDR.size
+        offset += (length + 3) & ~3
+
+        if msg_type != NLMSG_DONE or start + CN_MSG.size > len(data):
+            continue
+        idx, val, _, _, payload_len, _ = CN_MSG.unpack_from(data, start)
+        start += CN_MSG.size
+        if idx != CN_IDX_PROC or val != CN_VAL_PROC or payload_len < PROC_EVENT_HEADER.size + TWO_PIDS.size:
+            continue
+
+        what = PROC_EVENT_HEADER.unpack_from(data, start)[0]
+        start += PROC_EVENT_HEADER.size
+        exit_code = None
+        if what == PROC_EVENT_FORK:
+            _, _, pid, tgid = FOUR_PIDS.unpack_from(data, start)
+        elif what == PROC_EVENT_EXIT and payload_len >= PROC_EVENT_HEADER.size + FOUR_PIDS.size:
+            pid, tgid, exit_code, _ = FOUR_PIDS.unpack_from(data, start)
+        else:
+            pid, tgid = TWO_PIDS.unpack_from(data, start)
+        yield what, pid, tgid, exit_code
+
+def exit_status(wait_status):
+    """Converts a wait status to an exit code, negative for a signal (as subprocess does)."""
+    if wait_status & 0x7f:
+        return -(wait_status & 0x7f)
+    return wait_status >> 8
+
+class PollingProcessSource:
+    """
+    Process discovery by periodic incremental /proc scans. Used when the
+    netlink proc connector is not available (it needs CAP_NET_ADMIN).
+    """
+    name = 'polling'
+
+    def __init__(self, scanner: ProcessScanner, interval=5):
+        self.scanner = scanner
+        self.exit_codes = {} # Not known when polling
+        self.interval = interval
+        self._next_scan = 0.0
+
+    def poll(self, timeout=None):
+        """
+        Waits until the next scan is due (at most `timeout` seconds) and runs it.
+
+        Returns:
+            tuple: (added, removed), as for ProcessScanner.scan().
+        """
+        delay = self._next_scan - time.monotonic()
+        if timeout is not None:
+            delay = min(delay, timeout)
+        if delay > 0:
+            time.sleep(delay)
+        if time.monotonic() < self._next_scan:
+            return [], []
+        self._next_scan = time.monotonic() + self.interval
+        with SCAN_SECONDS.time():
+            return self.scanner.scan()
+
+    def close(self):
+        pass
+
+class NetlinkProcessSource:
+    """
+    Event-driven process discovery through the Linux netlink proc connector.
+
+    The kernel reports every exec, name change and exit; only the pids named in
+    those events are re-classified, so a new Wine process is found within
+    milliseconds and no periodic sweep is needed apart from a rare resync.
+    """
+    name = 'netlink'
+
+    def __init__(self, scanner: ProcessScanner, sock=None, resync_interval=RESYNC_INTERVAL):
+        """
+        Args:
+            scanner: The ProcessScanner that classifies pids.
+            sock: A connected event socket. If omitted, a netlink socket is
+                  opened and subscribed, which raises PermissionError without
+                  CAP_NET_ADMIN.
+            resync_interval: Seconds between safety full scans.
+        """
+        self.scanner = scanner
+        self.resync_interval = resync_interval
+        self.sock = sock if sock is not None else self._subscribe()
+        self._next_resync = 0.0
+        # Exit codes of removed Wine processes, until the caller pops them.
+        self.exit_codes = {}
+
+    @staticmethod
+    def _subscribe():
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_CONNECTOR)
+        try:
+            sock.bind((os.getpid(), CN_IDX_PROC))
+            op = struct.pack('=I', PROC_CN_MCAST_LISTEN)
+            message = CN_MSG.pack(CN_IDX_PROC, CN_VAL_PROC, 0, 0, len(op), 0) + op
+            sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(message), NLMSG_DONE, 0, 0, os.getpid()) + message)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _drain(self):
+        """
+        Reads all queued datagrams. Returns (pids to check, {pid that exited:
+        exit code}).
+        """
+        changed, exited = set(), {}
+        while True:
+            try:
+                data = self.sock.recv(65536, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    # The kernel dropped events; fall back to a full scan.
+                    self._next_resync = 0.0
+                    continue
+                raise
+            for what, pid, tgid, exit_code in decode_proc_events(data):
+                if pid != tgid:
+                    continue # Thread events
+                if what == PROC_EVENT_EXIT:
+                    exited[pid] = exit_status(exit_code or 0)
+                    changed.discard(pid)
+                elif what in (PROC_EVENT_EXEC, PROC_EVENT_COMM, PROC_EVENT_FORK):
+                    changed.add(pid)
+                    exited.pop(pid, None)
+        return changed, exited
+
+    def poll(self, timeout=None):
+        """
+        Waits up to `timeout` seconds for Wine processes to start or exit.
+
+        Events for other processes (a busy host forks and execs constantly)
+        are applied and waited past, so the call only returns early when
+        there is something for the caller to do.
+
+        Returns:
+            tuple: (added, removed), as for ProcessScanner.scan().
+        """
+        deadline = self._next_resync if timeout is None else min(self._next_resync, time.monotonic() + timeout)
+        while True:
+            if time.monotonic() >= self._next_resync:
+                self._next_resync = time.monotonic() + self.resync_interval
+                self._drain()
+                with SCAN_SECONDS.time():
+                    return self.scanner.scan()
+
+            readable, _, _ = select.select([self.sock], [], [], max(deadline - time.monotonic(), 0))
+            if not readable:
+                return [], []
+
+            changed, exited = self._drain()
+            removed = self.scanner.discard(exited)
+            for pid in removed:
+                self.exit_codes[pid] = exited[pid]
+            added, replaced = self.scanner.refresh(changed)
+            if added or removed or replaced:
+                return added, removed + replaced
+            if time.monotonic() >= deadline:
+                return [], []
+
+    def close(self):
+        self.sock.close()
+
+class FakeEventSocket:
+    """
+    Stands in for the netlink socket so NetlinkProcessSource can be exercised
+    without root: events pushed with emit() are delivered as real datagrams.
+    """
+    def __init__(self):
+        self._reader, self._writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def emit(self, what, pid, tgid=None, exit_code=0):
+        self._writer.send(encode_proc_event(what, pid, tgid, exit_code=exit_code))
+
+    def fileno(self):
+        return self._reader.fileno()
+
+    def recv(self, size, flags=0):
+        return self._reader.recv(size, flags)
+
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+
+def open_process_source(scanner: ProcessScanner, service_config: dict, callback=None):
+    """
+    Opens the process discovery backend selected by `service.process_events`:
+    'netlink', 'polling' or 'auto' (netlink when permitted, else polling).
+    When 'netlink' was asked for explicitly and cannot be used, that is
+    reported as an error before falling back to polling.
+    """
+    mode = service_config.get('process_events', 'auto')
+    scan_interval = service_config.get('scan_interval', 5)
+
+    if mode in ('auto', 'netlink'):
+        try:
+            return NetlinkProcessSource(scanner, resync_interval=service_config.get('resync_interval', RESYNC_INTERVAL))
+        except OSError as e:
+            if callback and mode == 'netlink':
+                callback(f"[bold red]Error: process_events is 'netlink', but the proc connector cannot be used ({e}). "
+                         f"Run the service with CAP_NET_ADMIN, or set process_events to 'auto' or 'polling'. "
+                         f"Scanning every {scan_interval}s meanwhile.[/bold red]")
+            elif callback:
+                callback(f"Netlink process events unavailable ({e}). Falling back to scanning every {scan_interval}s.")
+
+    return PollingProcessSource(scanner, scan_interval)
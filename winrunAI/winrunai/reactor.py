@@ -0,0 +1,269 @@
+import os
+import errno
+import selectors
+from collections import deque
+
+# How much to read from a log stream per readiness event.
+READ_SIZE = 64 * 1024
+
+# Streams that cannot be watched with epoll (regular files) and processes
+# without a pidfd are checked on this interval instead.
+POLL_INTERVAL = 0.25
+
+def make_non_blocking(fd):
+    """Make a file descriptor non-blocking."""
+    os.set_blocking(fd, False)
+
+def open_pidfd(pid):
+    """
+    Returns a pidfd for `pid` that becomes readable when the process exits,
+    or None if pidfds are not supported on this system.
+    """
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError) as e:
+        if isinstance(e, OSError) and e.errno == errno.ESRCH:
+            raise ProcessLookupError(pid) from e
+        return None
+
+def pid_alive(pid):
+    """Checks whether a process exists without needing psutil."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class _Stream:
+    """A monitored process: its stderr descriptor, pidfd and line buffer."""
+    __slots__ = ('pid', 'file', 'pidfd', 'on_lines', 'on_exit', 'pending', 'polled', 'closed')
+
+    def __init__(self, pid, file, pidfd, on_lines, on_exit):
+        self.pid = pid
+        self.file = file
+        self.pidfd = pidfd
+        self.on_lines = on_lines
+        self.on_exit = on_exit
+        self.pending = bytearray()  # Bytes after the last complete line.
+        self.polled = False
+        self.closed = False
+
+class LogReactor:
+    """
+    A single event loop that captures the stderr output of many processes.
+
+    Every monitored process contributes two descriptors to one selector (epoll
+    on Linux): its `/proc/<pid>/fd/2` stream and a pidfd that becomes readable
+    when the process exits. Output is read in large chunks into a reusable
+    buffer, split into complete lines, and handed to the process's `on_lines`
+    handler one batch per read. Handlers run on the reactor thread and should
+    return quickly.
+    """
+    def __init__(self, read_size=READ_SIZE, poll_interval=POLL_INTERVAL):
+        self.read_size = read_size
+        self.poll_interval = poll_interval
+        self._selector = selectors.DefaultSelector()
+        self._buffer = bytearray(read_size)
+        self._view = memoryview(self._buffer)
+        self._streams = {}
+        self._commands = deque()
+        self._stopped = False
+        self._closed = False
+
+        # Self-pipe used to wake the loop up when streams are added or removed
+        # from other threads.
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        make_non_blocking(self._wakeup_r)
+        make_non_blocking(self._wakeup_w)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+
+    def add(self, pid, stderr_path, on_lines, on_exit=None):
+        """
+        Starts capturing the output of `pid`. Safe to call from any thread.
+
+        Args:
+            pid: The process to monitor.
+            stderr_path: The path to open, usually `/proc/<pid>/fd/2`.
+            on_lines: Called as on_lines(pid, lines) with a list of complete lines.
+            on_exit: Called as on_exit(pid) once the process has terminated
+                     and its remaining output has been dispatched.
+
+        Raises:
+            OSError: If the stream cannot be opened (for example FileNotFoundError
+                     if the process is already gone, or PermissionError).
+        """
+        file = open(stderr_path, 'rb', buffering=0)
+        try:
+            make_non_blocking(file.fileno())
+            pidfd = open_pidfd(pid)
+        except BaseException:
+            file.close()
+            raise
+
+        self._commands.append(('add', _Stream(pid, file, pidfd, on_lines, on_exit)))
+        self._wakeup()
+
+    def remove(self, pid):
+        """Stops capturing the output of `pid` without waiting for it to exit."""
+        self._commands.append(('remove', pid))
+        self._wakeup()
+
+    def stop(self):
+        """Asks the loop to exit. Safe to call from any thread."""
+        self._stopped = True
+        self._wakeup()
+
+    def __len__(self):
+        return len(self._streams)
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            pass  # A wakeup is already pending.
+
+    def _run_commands(self):
+        while self._commands:
+            command, arg = self._commands.popleft()
+            if command == 'add':
+                self._register(arg)
+            elif command == 'remove' and arg in self._streams:
+                self._close(self._streams[arg], notify=False)
+
+    def _register(self, stream):
+        if stream.pid in self._streams:
+            self._close(self._streams[stream.pid], notify=False)
+        self._streams[stream.pid] = stream
+        try:
+            self._selector.register(stream.file, selectors.EVENT_READ, stream)
+        except PermissionError:
+            # epoll refuses regular files; they are always readable, so they
+            # are drained on every poll tick instead.
+            stream.polled = True
+        if stream.pidfd is not None:
+            self._selector.register(stream.pidfd, selectors.EVENT_READ, stream)
+
+    def _read(self, stream):
+        """
+        Reads whatever is currently available from the stream and dispatches
+        the complete lines. Returns False once the stream has reached EOF.
+        """
+        lines = []
+        while True:
+            try:
+                count = stream.file.readinto(self._view)
+            except OSError:
+                count = 0
+            if count is None or (count == 0 and stream.polled):
+                break  # Nothing more for now. Regular files never signal EOF.
+            if count == 0:
+                self._dispatch(stream, lines)
+                return False
+
+            stream.pending += self._view[:count]
+            end = stream.pending.rfind(b'\n')
+            if end != -1:
+                text = stream.pending[:end].decode('utf-8', errors='replace')
+                del stream.pending[:end + 1]
+                lines.extend(text.split('\n'))
+            if count < self.read_size or stream.polled:
+                break
+
+        self._dispatch(stream, lines)
+        return True
+
+    def _dispatch(self, stream, lines):
+        if lines:
+            stream.on_lines(stream.pid, lines)
+
+    def _close(self, stream, notify=True):
+        if stream.closed:
+            return
+        stream.closed = True
+        self._streams.pop(stream.pid, None)
+
+        if not stream.polled and stream.file is not None:
+            self._selector.unregister(stream.file)
+        if stream.pidfd is not None:
+            self._selector.unregister(stream.pidfd)
+            os.close(stream.pidfd)
+        if stream.file is not None:
+            stream.file.close()
+
+        if notify:
+            if stream.pending:
+                self._dispatch(stream, [stream.pending.decode('utf-8', errors='replace')])
+                stream.pending.clear()
+            if stream.on_exit:
+                stream.on_exit(stream.pid)
+
+    def _finish(self, stream):
+        """The process exited: drain the rest of its output and notify."""
+        if stream.file is not None:
+            self._read(stream)
+        self._close(stream)
+
+    def _eof(self, stream):
+        """The stream hit EOF but the process may still be running."""
+        if not stream.polled:
+            self._selector.unregister(stream.file)
+        stream.file.close()
+        stream.file = None
+        stream.polled = False
+        if stream.pidfd is None:
+            # Without a pidfd, EOF is the best exit signal we have.
+            self._close(stream)
+
+    def _tick(self):
+        """Services streams that epoll cannot watch for us."""
+        for stream in list(self._streams.values()):
+            if stream.polled and not self._read(stream):
+                self._eof(stream)
+            if stream.pidfd is None and not stream.closed and not pid_alive(stream.pid):
+                self._finish(stream)
+
+    def run(self, until_idle=False):
+        """
+        Runs the loop until stop() is called, or, if `until_idle` is set,
+        until no streams are left. The reactor is closed when this returns.
+        """
+        try:
+            self._run_commands()
+            while not self._stopped and not (until_idle and not self._streams and not self._commands):
+                needs_tick = any(s.polled or s.pidfd is None for s in self._streams.values())
+                events = self._selector.select(self.poll_interval if needs_tick else None)
+
+                for key, _ in events:
+                    stream = key.data
+                    if stream is None:
+                        try:
+                            while os.read(self._wakeup_r, 4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                        continue
+                    if stream.closed:
+                        continue
+                    if key.fileobj is stream.pidfd:
+                        self._finish(stream)
+                    elif not self._read(stream):
+                        self._eof(stream)
+
+                self._run_commands()
+                if needs_tick:
+                    self._tick()
+        finally:
+            self.close()
+
+    def close(self):
+        """Releases all descriptors. Streams are dropped without notification."""
+        if self._closed:
+            return
+        self._closed = True
+        for stream in list(self._streams.values()):
+            self._close(stream, notify=False)
+        self._selector.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
@@ -0,0 +1,293 @@
+import errno
+import os
+import re
+import socket
+import threading
+import time
+from pathlib import Path
+
+# Where each root key of a .reg file is stored in a WINEPREFIX, as
+# (hive file, prefix of the key path inside that file).
+ROOT_KEYS = {
+    'HKEY_CURRENT_USER': ('user.reg', ''),
+    'HKCU': ('user.reg', ''),
+    'HKEY_LOCAL_MACHINE': ('system.reg', ''),
+    'HKLM': ('system.reg', ''),
+    'HKEY_CLASSES_ROOT': ('system.reg', 'Software\\Classes\\'),
+    'HKCR': ('system.reg', 'Software\\Classes\\'),
+}
+
+KEY_LINE = re.compile(r'^\[(-?)([^\]]+)\]')
+VALUE_LINE = re.compile(r'^(?:"((?:[^"\\]|\\.)*)"|(@))\s*=\s*(.*)$')
+
+# Seconds between 1601-01-01 (the Windows epoch) and 1970-01-01.
+WINDOWS_EPOCH_OFFSET = 11644473600
+
+class RegistryDocument:
+    """
+    The content of one or more .reg files, merged.
+
+    Keys are stored as '<ROOT>\\path' strings and values as raw .reg data
+    ('"text"', 'dword:00000001', 'hex:...' or '-' for a deletion). Keys and
+    value names are compared case-insensitively, as Windows does; when the
+    same value is set more than once, the last assignment wins.
+    """
+    def __init__(self):
+        self.keys = {}          # key.lower() -> [key, {name.lower(): (name, data)}]
+        self.deleted_keys = []  # keys removed with [-KEY]
+
+    @classmethod
+    def parse(cls, *texts):
+        document = cls()
+        for text in texts:
+            document.update(text)
+        return document
+
+    def update(self, text: str):
+        """Merges the content of a .reg file into the document."""
+        values = None
+        for line in _logical_lines(text):
+            match = KEY_LINE.match(line)
+            if match:
+                key = match.group(2).strip()
+                if match.group(1):
+                    self.deleted_keys.append(key)
+                    self.keys.pop(key.lower(), None)
+                    values = None
+                else:
+                    values = self.keys.setdefault(key.lower(), [key, {}])[1]
+                continue
+            match = VALUE_LINE.match(line)
+            if match and values is not None:
+                name = '@' if match.group(2) else match.group(1)
+                values[name.lower()] = (name, match.group(3).strip())
+
+    def values(self):
+        """Yields (key, value name, data) for every value in the document."""
+        for key, values in self.keys.values():
+            for name, data in values.values():
+                yield key, name, data
+
+    def __bool__(self):
+        return bool(self.keys or self.deleted_keys)
+
+    def format(self) -> str:
+        """Renders the document as a single REGEDIT4 file."""
+        lines = ["REGEDIT4", ""]
+        for key in self.deleted_keys:
+            lines += [f"[-{key}]", ""]
+        for key, values in self.keys.values():
+            lines.append(f"[{key}]")
+            for name, data in values.values():
+                lines.append(f"{_quote(name)}={data}")
+            lines.append("")
+        return "\n".join(lines) + "\n"
+
+def _logical_lines(text):
+    """Splits .reg or hive text into lines, joining '\\'-continued hex data."""
+    pending = ''
+    for line in text.splitlines():
+        line = line.strip()
+        if line.endswith('\\') and VALUE_LINE.match(pending + line) and ':' in line:
+            pending += line[:-1]
+            continue
+        yield pending + line
+        pending = ''
+    if pending:
+        yield pending
+
+def _quote(name):
+    return '@' if name == '@' else f'"{name}"'
+
+def _normalize_data(data):
+    """Makes equal values compare equal, whatever their hex digit case or spacing."""
+    if data.startswith('"'):
+        return data
+    return re.sub(r'\s+', '', data).lower()
+
+def locate_key(key: str):
+    """
+    Maps a .reg key path to the hive file that holds it.
+
+    Returns:
+        tuple: (hive file name, key path inside the hive), or None if the key
+        is not stored in user.reg or system.reg.
+    """
+    root, _, path = key.partition('\\')
+    location = ROOT_KEYS.get(root.upper())
+    if location is None:
+        return None
+    hive, prefix = location
+    return hive, prefix + path
+
+def _hive_key(line_key):
+    """Unescapes a key name as written in a hive file ('Software\\\\Wine')."""
+    return line_key.replace('\\\\', '\\')
+
+class HiveCache:
+    """
+    Parsed registry hives (user.reg, system.reg) of WINEPREFIXes, re-read
+    only when a file's size or modification time changes.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hives = {}    # path -> ((mtime_ns, size), {key.lower(): {name.lower(): data}})
+
+    def read(self, path):
+        path = Path(path)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return {}
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._hives.get(path)
+            if cached and cached[0] == signature:
+                return cached[1]
+
+        keys = {}
+        values = None
+        with open(path, encoding='utf-8', errors='replace') as hive:
+            for line in _logical_lines(hive.read()):
+                match = KEY_LINE.match(line)
+                if match:
+                    values = keys.setdefault(_hive_key(match.group(2)).lower(), {})
+                    continue
+                match = VALUE_LINE.match(line)
+                if match and values is not None:
+                    name = '@' if match.group(2) else match.group(1)
+                    values[name.lower()] = _normalize_data(match.group(3).strip())
+
+        with self._lock:
+            self._hives[path] = (signature, keys)
+        return keys
+
+    def invalidate(self, path=None):
+        with self._lock:
+            if path is None:
+                self._hives.clear()
+            else:
+                self._hives.pop(Path(path), None)
+
+hive_cache = HiveCache()
+
+def unapplied_changes(wineprefix: str, document: RegistryDocument, cache: HiveCache = hive_cache) -> RegistryDocument:
+    """
+    Returns the part of `document` that is not already in the prefix's
+    registry: values that are set to the same data, and deletions of values
+    that do not exist, are left out. Key deletions are always kept.
+    """
+    changes = RegistryDocument()
+    changes.deleted_keys = list(document.deleted_keys)
+    for key, name, data in document.values():
+        location = locate_key(key)
+        if location is not None:
+            hive, path = location
+            current = cache.read(Path(wineprefix) / hive).get(path.lower(), {}).get(name.lower())
+            if current == _normalize_data(data) or (data == '-' and current is None):
+                continue
+        changes.keys.setdefault(key.lower(), [key, {}])[1][name.lower()] = (name, data)
+    return changes
+
+def is_wine_running(wineprefix: str) -> bool:
+    """
+    Checks whether a wineserver is running for the prefix, by looking for its
+    socket in /tmp/.wine-<uid>/server-<device>-<inode>/ as Wine itself does.
+    A socket left behind by a killed wineserver refuses connections, so the
+    socket is connected to rather than only checked for.
+    """
+    try:
+        stat = os.stat(wineprefix)
+    except OSError:
+        return False
+    server_dir = Path(f"/tmp/.wine-{os.getuid()}") / f"server-{stat.st_dev:x}-{stat.st_ino:x}"
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(1.0)
+        try:
+            client.connect(str(server_dir / "socket"))
+        except OSError as e:
+            # Anything but a missing or dead socket counts as running, to be safe.
+            return e.errno not in (errno.ENOENT, errno.ECONNREFUSED, errno.ENOTDIR)
+    return True
+
+def can_write_hives(document: RegistryDocument) -> bool:
+    """True if every change in the document can be written into the hive files."""
+    return not document.deleted_keys and all(locate_key(key) for key, _ in document.keys.values())
+
+def write_hives(wineprefix: str, document: RegistryDocument, cache: HiveCache = hive_cache):
+    """
+    Writes the values of `document` directly into the prefix's user.reg and
+    system.reg. Only safe while no wineserver is running for the prefix, since
+    wineserver keeps the registry in memory and rewrites the files on exit.
+    """
+    by_hive = {}
+    for key, name, data in document.values():
+        hive, path = locate_key(key)
+        by_hive.setdefault(hive, {}).setdefault(path.lower(), [path, {}])[1][name.lower()] = (name, data)
+
+    for hive, changes in by_hive.items():
+        hive_path = Path(wineprefix) / hive
+        _update_hive_file(hive_path, changes)
+        cache.invalidate(hive_path)
+
+def _update_hive_file(hive_path, changes):
+    with open(hive_path, encoding='utf-8', errors='surrogateescape') as hive:
+        lines = hive.read().splitlines()
+
+    now = time.time()
+    stamp = f"{int(now)}"
+    filetime = f"#time={int((now + WINDOWS_EPOCH_OFFSET) * 10**7):x}"
+
+    # Index the sections: key.lower() -> (first line, end line)
+    sections = {}
+    current = None
+    for index, line in enumerate(lines):
+        match = KEY_LINE.match(line)
+        if match:
+            if current is not None:
+                sections[current] = (sections[current][0], index)
+            current = _hive_key(match.group(2)).lower()
+            sections[current] = (index, len(lines))
+    # Process from the end of the file so earlier line numbers stay valid.
+    edits = sorted(changes.items(), key=lambda item: sections.get(item[0], (len(lines),))[0], reverse=True)
+
+    for key_lower, (path, values) in edits:
+        if key_lower not in sections:
+            new_lines = ["", f"[{path.replace(chr(92), chr(92) * 2)}] {stamp}", filetime]
+            new_lines += [f"{_quote(name)}={data}" for name, data in values.values() if data != '-']
+            lines += new_lines
+            continue
+
+        start, end = sections[key_lower]
+        body = lines[start + 1:end]
+        remaining = dict(values)
+        new_body = []
+        skip_continuation = False
+        for line in body:
+            if skip_continuation:
+                skip_continuation = line.rstrip().endswith('\\')
+                continue
+            match = VALUE_LINE.match(line.strip())
+            name = match and ('@' if match.group(2) else match.group(1)).lower()
+            if name in remaining:
+                skip_continuation = line.rstrip().endswith('\\')
+                original_name, data = remaining.pop(name)
+                if data != '-':
+                    new_body.append(f"{_quote(original_name)}={data}")
+                continue
+            if line.startswith('#time='):
+                line = filetime
+            new_body.append(line)
+
+        # Keep the blank line that separates sections at the end.
+        insert_at = len(new_body)
+        while insert_at and not new_body[insert_at - 1].strip():
+            insert_at -= 1
+        new_body[insert_at:insert_at] = [f"{_quote(name)}={data}" for name, data in remaining.values() if data != '-']
+        header = KEY_LINE.match(lines[start]).group(0)
+        lines[start:end] = [f"{header} {stamp}"] + new_body
+
+    temp_path = hive_path.with_name(hive_path.name + ".winrunai")
+    with open(temp_path, 'w', encoding='utf-8', errors='surrogateescape') as hive:
+        hive.write("\n".join(lines) + "\n")
+    os.replace(temp_path, hive_path)
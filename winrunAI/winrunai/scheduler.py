@@ -0,0 +1,207 @@
+import threading
+from collections import deque
+
+class AnalysisScheduler:
+    """
+    Runs analysis tasks on a bounded pool of worker threads.
+
+    Tasks are grouped by a key (the WINEPREFIX): tasks with the same key run one
+    at a time and in submission order, so all processes of a Wine session share
+    one analysis context without extra locking, while different prefixes are
+    analyzed in parallel.
+
+    submit() never blocks: it is called from the log reactor, and waiting there
+    would stall log capture for every process. Back-pressure is applied per
+    process instead. A pid may have at most `max_pending_per_pid` queued tasks
+    (a quarter of `max_pending` by default) and the whole queue at most
+    `max_pending`; past either bound a new task is merged into the pid's last
+    queued task when the caller passes `merge`, and dropped otherwise.
+
+    When a process exits, finish() queues its last task behind the batches it
+    still has queued, so its output is analyzed up to EOF. cancel() is for
+    forced removal only.
+    """
+    def __init__(self, max_workers=4, max_pending=1024, max_pending_per_pid=None, error_callback=None):
+        self.max_workers = max(1, max_workers)
+        self.max_pending = max(1, max_pending)
+        self.max_pending_per_pid = max(1, max_pending_per_pid or self.max_pending // 4)
+        self.error_callback = error_callback
+
+        self._lock = threading.Lock()
+        self._work_ready = threading.Condition(self._lock)
+        self._groups = {}          # key -> deque of [pid, fn, args]
+        self._queued = {}          # pid -> number of queued tasks
+        self._ready = deque()      # keys with queued tasks and no running worker
+        self._running = {}         # key a worker is busy with -> pid of its task
+        self._cancelled = set()    # pids whose running task was cancelled
+        self._threads = []
+        self._idle = 0
+        self._pending = 0
+        self._dropped = 0
+        self._shutdown = False
+
+    def submit(self, pid, key, fn, *args, merge=None):
+        """
+        Queues fn(*args) for process `pid` in group `key`.
+
+        Args:
+            merge: Optional merge(queued_args, args) used when the pid or the
+                queue is at its bound. It returns the arguments of a single
+                task doing the work of both, or None if they cannot be merged.
+
+        Returns:
+            True if the task was queued or merged, False if it was dropped
+            because of back-pressure, the pid was cancelled or the pool is
+            shut down.
+        """
+        with self._lock:
+            if self._shutdown:
+                return False
+            if self._pending >= self.max_pending or self._queued.get(pid, 0) >= self.max_pending_per_pid:
+                if merge and self._merge(self._groups.get(key), pid, fn, args, merge):
+                    return True
+                self._dropped += 1
+                return False
+            self._enqueue(pid, key, fn, args)
+        return True
+
+    def finish(self, pid, key, fn, *args):
+        """
+        Queues fn(*args) as the last task of a process that exited, after the
+        tasks it still has queued. It is queued whatever the bounds, so the
+        process's last output is analyzed and its exit handled in order.
+
+        Returns:
+            False if the pool is shut down, True otherwise.
+        """
+        with self._lock:
+            if self._shutdown:
+                return False
+            self._enqueue(pid, key, fn, args)
+        return True
+
+    def _enqueue(self, pid, key, fn, args):
+        """Appends a task to its group and wakes a worker. Called with the lock held."""
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = deque()
+        group.append([pid, fn, args])
+        self._pending += 1
+        self._queued[pid] = self._queued.get(pid, 0) + 1
+        if key not in self._running and len(group) == 1:
+            self._ready.append(key)
+
+        if self._idle == 0 and len(self._threads) < self.max_workers:
+            self._spawn_worker()
+        else:
+            self._work_ready.notify()
+
+    def _merge(self, group, pid, fn, args, merge):
+        """Merges args into the pid's last queued task. Called with the lock held."""
+        for task in reversed(group or ()):
+            if task[0] == pid:
+                if task[1] != fn:
+                    return False
+                merged = merge(task[2], args)
+                if merged is None:
+                    return False
+                task[2] = merged
+                return True
+        return False
+
+    def cancel(self, pid):
+        """
+        Cancels the tasks of a process that is forcibly removed: queued tasks
+        are discarded and a running task sees is_cancelled() turn true until
+        it returns. Later tasks for the pid (a process reusing the number)
+        are not affected.
+        """
+        with self._lock:
+            if pid in self._running.values():
+                self._cancelled.add(pid)
+            if not self._queued.pop(pid, 0):
+                return
+            for key, group in list(self._groups.items()):
+                kept = deque(task for task in group if task[0] != pid)
+                removed = len(group) - len(kept)
+                if not removed:
+                    continue
+                self._pending -= removed
+                if kept:
+                    self._groups[key] = kept
+                    continue
+                if key in self._ready:
+                    self._ready.remove(key)
+                if key in self._running:
+                    # The worker deletes the group when its task finishes.
+                    self._groups[key] = kept
+                else:
+                    del self._groups[key]
+
+    def is_cancelled(self, pid):
+        return pid in self._cancelled
+
+    def stats(self):
+        """Returns the pool's thread count, queue depth and dropped task count."""
+        with self._lock:
+            return {
+                'threads': len(self._threads),
+                'busy': len(self._threads) - self._idle,
+                'queue_depth': self._pending,
+                'dropped': self._dropped,
+            }
+
+    def shutdown(self, wait=True):
+        """Stops accepting tasks and lets the workers exit once the queue is empty."""
+        with self._lock:
+            self._shutdown = True
+            self._work_ready.notify_all()
+            threads = list(self._threads)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _spawn_worker(self):
+        thread = threading.Thread(
+            target=self._worker,
+            name=f"analysis-worker-{len(self._threads) + 1}",
+            daemon=True
+        )
+        self._threads.append(thread)
+        thread.start()
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                self._idle += 1
+                self._work_ready.wait_for(lambda: self._ready or self._shutdown)
+                self._idle -= 1
+                if not self._ready:
+                    self._threads.remove(threading.current_thread())
+                    return
+
+                key = self._ready.popleft()
+                group = self._groups[key]
+                pid, fn, args = group.popleft()
+                self._pending -= 1
+                if self._queued[pid] > 1:
+                    self._queued[pid] -= 1
+                else:
+                    del self._queued[pid]
+                self._running[key] = pid
+
+            try:
+                fn(*args)
+            except Exception as e:
+                # A failing task must not take the worker down with it.
+                if self.error_callback:
+                    self.error_callback(f"Analysis task for PID {pid} failed: {e}")
+            finally:
+                with self._lock:
+                    del self._running[key]
+                    self._cancelled.discard(pid)
+                    if self._groups.get(key):
+                        self._ready.append(key)
+                        self._work_ready.notify()
+                    elif key in self._groups and not self._groups[key]:
+                        del self._groups[key]
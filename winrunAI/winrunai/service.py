@@ -1,112 +1,248 @@
-import os
 import sys
 import time
-import subprocess
-import psutil
+import signal
+import contextlib
 import threading
 import json
 from pathlib import Path
 
-from .monitor import find_wine_processes_iter
+from .monitor import ProcessScanner
+from .procevents import open_process_source, PollingProcessSource
 from .engine import AIEngine
-from .analyzer import analyze_process
-from .config import config
-
-PID_FILE = Path(os.environ.get("TMPDIR", "/tmp")) / "winrunai.pid"
-LOG_FILE = Path(os.environ.get("TMPDIR", "/tmp")) / "winrunai_service.log"
-STATUS_FILE = Path(os.environ.get("TMPDIR", "/tmp")) / "winrunai_status.json"
-
-def is_service_running():
-    if not PID_FILE.exists():
-        return False
-    try:
-        pid = int(PID_FILE.read_text())
-        return psutil.pid_exists(pid)
-    except (ValueError, psutil.NoSuchProcess):
-        return False
-
-def start_service(tui_app=None):
-    if is_service_running():
-        if tui_app:
-            tui_app.query_one("#status-display").update("Status: AI is already running.")
-        return
-
-    command = [sys.executable, "-m", "winrunai.main", "--service"]
-    process = subprocess.Popen(command, start_new_session=True)
-    PID_FILE.write_text(str(process.pid))
-
-    if tui_app:
-        tui_app.query_one("#status-display").update("Status: AI Enabled")
-        tui_app.query_one("#log-viewer").write("AI service started...")
-
-def stop_service(tui_app=None):
-    if not PID_FILE.exists():
-        if tui_app:
-            tui_app.query_one("#status-display").update("Status: AI is already stopped.")
-        return
-
-    try:
-        pid = int(PID_FILE.read_text())
-        if psutil.pid_exists(pid):
-            p = psutil.Process(pid)
-            p.terminate()
-            p.wait(timeout=3)
-    except (ValueError, psutil.NoSuchProcess):
-        pass
-    except psutil.TimeoutExpired:
-        p.kill()
-
-    PID_FILE.unlink(missing_ok=True)
-    STATUS_FILE.unlink(missing_ok=True) # Clean up status file on stop
-
-    if tui_app:
-        tui_app.query_one("#status-display").update("Status: AI Disabled")
-        tui_app.query_one("#log-viewer").write("AI service stopped.")
+from .analyzer import attach_process, PrefixContext
+from .scheduler import AnalysisScheduler
+from .executor import ActionScheduler
+from .reactor import LogReactor
+from .config import config, current_config, ConfigError, ConfigWatcher, LIVE_SETTINGS
+from .database import add_rule, rule_index
+from .llm import check_fix
+from .logfilter import LINE_CLASSES
+from .logwriter import LogWriter
+from .eventserver import EventServer
+from .eventstore import open_event_store
+from .templates import open_template_cache
+from .control import LOG_FILE, STATUS_FILE, SOCKET_FILE, METRICS_SOCKET_FILE
+from .metrics import metrics, MetricsServer, SamplingProfiler, profile_path, LOG_RECORDS_DROPPED, ANALYZER_THREADS_ACTIVE
+
+def add_rule_command(command: dict):
+    """
+    Adds a rule from a command ({'pattern', 'tool', 'argument', 'confidence'},
+    optionally 'line_class' and 'channel'). Lookups use it from the next line on.
+    """
+    pattern = command.get('pattern')
+    tool, argument = command.get('tool'), command.get('argument')
+    confidence = command.get('confidence', 0.95)
+    line_class, channel = command.get('line_class'), command.get('channel')
+    if not isinstance(pattern, str) or not pattern.strip():
+        return {'ok': False, 'error': "The pattern must not be empty"}
+    if isinstance(confidence, bool) or not isinstance(confidence, (int, float)) or not 0 <= confidence <= 1:
+        return {'ok': False, 'error': "The confidence must be between 0 and 1"}
+    if line_class is not None and line_class not in LINE_CLASSES:
+        return {'ok': False, 'error': f"The class must be one of {', '.join(LINE_CLASSES)}"}
+    if channel is not None and (not isinstance(channel, str) or not channel.isidentifier()):
+        return {'ok': False, 'error': "The channel must be a Wine debug channel name, like 'module'"}
+    error = check_fix(tool, argument)
+    if error:
+        return {'ok': False, 'error': error}
+    if not add_rule(pattern, tool, argument, confidence, line_class, channel):
+        return {'ok': False, 'error': f"There is already a rule for '{pattern}'"}
+    return {'ok': True, 'rules': len(rule_index.matcher().rules)}
+
+def _setting_names(settings):
+    return sorted(section if key is None else f"{section}.{key}" for section, key in settings)
 
 def run_monitor_loop():
     """The main loop for the background service."""
-    engine = AIEngine()
+    engine = AIEngine(config.get('ai_engine', {}))
     analyzed_procs = {} # Using a dict to store full process info {pid: proc_info}
-    scan_interval = config.get('service', {}).get('scan_interval', 5)
-
-    with open(LOG_FILE, "w") as f:
-        def log_callback(message):
-            f.write(f"[{time.ctime()}] {message}\n")
-            f.flush()
+    prefix_contexts = {} # {wineprefix: PrefixContext}, shared by a prefix's processes
+    service_config = config.get('service', {})
+    scan_interval = service_config.get('scan_interval', 5)
+
+    logging_config = config.get('logging', {})
+    last_status = None
+    last_counters = {}
+    metrics_interval = service_config.get('metrics_interval', 2)
+    next_metrics = 0.0
+
+    # Exit through the finally blocks on `stop`, so logs and the profile are written out.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Opt-in sampling profiler for the whole service.
+    profiler = None
+    if service_config.get('profile', False):
+        profiler = SamplingProfiler(service_config.get('profile_interval', 0.005)).start()
+
+    # Log records and status changes are pushed to the TUI and other clients,
+    # metrics are served on their own socket.
+    events = EventServer(SOCKET_FILE)
+    metrics_server = MetricsServer(METRICS_SOCKET_FILE)
+
+    # Typed events (processes, errors, fixes, exits) are kept across restarts.
+    history = open_event_store()
+
+    # Prefixes that fixes were applied to are captured as templates for cloning.
+    templates = open_template_cache()
+
+    # Producers only enqueue; a single writer thread batches records to disk.
+    with LogWriter(
+        LOG_FILE,
+        mode='a',
+        max_bytes=logging_config.get('max_bytes', 10 * 1024 * 1024),
+        backup_count=logging_config.get('backup_count', 3),
+        flush_interval=logging_config.get('flush_interval', 0.5),
+        max_queue=logging_config.get('queue_size', 100000),
+        overflow=logging_config.get('overflow', 'drop'),
+        on_record=events.publish_log,
+    ) as log_callback, contextlib.ExitStack() as cleanup:
+        cleanup.callback(events.close)
+        cleanup.callback(metrics_server.close)
+        cleanup.callback(history.close)
+        if templates:
+            cleanup.callback(templates.close)
+        if profiler:
+            # Runs first: stop sampling, then write the report.
+            cleanup.callback(profiler.dump, profile_path('service'))
+            cleanup.callback(profiler.stop)
 
         log_callback(f"WinRunAI Service Log Initialized. Scan interval: {scan_interval}s.")
 
-        while True:
-            found_processes = list(find_wine_processes_iter())
-            current_pids = {p['pid'] for p in found_processes}
+        # config.yml is reloaded when it changes, or on a 'reload' command,
+        # without detaching from the monitored processes.
+        def report_reload(changed):
+            if not changed:
+                log_callback("Configuration reloaded: no changes.")
+                return
+            log_callback(f"Configuration reloaded. Changed: {', '.join(_setting_names(changed))}.")
+            later = changed - LIVE_SETTINGS
+            if later:
+                log_callback(f"These settings take effect after a restart: {', '.join(_setting_names(later))}.")
+
+        watcher = ConfigWatcher(
+            interval=service_config.get('config_check_interval', 1.0),
+            on_reload=report_reload,
+            on_error=lambda error: log_callback(f"[bold red]config.yml was not reloaded, the current settings are kept:[/bold red] {error}"),
+        ).start()
+        cleanup.callback(watcher.stop)
+
+        def handle_command(command):
+            if command['command'] == 'add_rule':
+                return add_rule_command(command)
+            if command['command'] != 'reload':
+                return {'ok': False, 'error': f"Unknown command '{command['command']}'"}
+            try:
+                changed = watcher.reload()
+            except ConfigError as e:
+                return {'ok': False, 'error': str(e)}
+            # Rebuild the rule index now rather than at the next check.
+            rule_index.invalidate()
+            return {
+                'ok': True,
+                'changed': _setting_names(changed),
+                'restart_required': _setting_names(changed - LIVE_SETTINGS),
+                'rules': len(rule_index.matcher().rules),
+            }
+        events.on_command = handle_command
+
+        # One event loop captures the logs of every monitored process.
+        reactor = LogReactor()
+        threading.Thread(target=reactor.run, name="log-reactor", daemon=True).start()
+
+        # Analysis of the captured lines runs on a bounded worker pool.
+        scheduler = AnalysisScheduler(
+            max_workers=service_config.get('analysis_workers', 4),
+            max_pending=service_config.get('analysis_queue_size', 1024),
+            error_callback=log_callback
+        )
+
+        LOG_RECORDS_DROPPED.function = lambda: log_callback.dropped
+        ANALYZER_THREADS_ACTIVE.function = lambda: scheduler.stats()['busy']
+
+        # Fixes run in the background, serialized per WINEPREFIX.
+        actions = ActionScheduler(max_parallel=service_config.get('max_parallel_fixes', 4), events=history, outcomes=engine.outcomes)
+
+        # Netlink process events when permitted, periodic /proc scans otherwise.
+        source = open_process_source(ProcessScanner(), service_config, log_callback)
+        log_callback(f"Process discovery backend: {source.name}.")
 
-            for proc_info in found_processes:
-                pid = proc_info['pid']
-                if pid not in analyzed_procs:
-                    proc_name = Path(proc_info.get('cmdline', ['unknown'])[0]).name
-                    log_callback(f"[bold green]New application detected: {proc_name} (PID: {pid}). AI monitoring is now active.[/bold green]")
-                    analyzed_procs[pid] = proc_info
+        while True:
+            # Settings that apply live are read from the current snapshot.
+            service_config = current_config().get('service', {})
+            scan_interval = service_config.get('scan_interval', 5)
+            metrics_interval = service_config.get('metrics_interval', 2)
+            if isinstance(source, PollingProcessSource):
+                source.interval = scan_interval
 
-                    analysis_thread = threading.Thread(
-                        target=analyze_process,
-                        args=(proc_info, engine, log_callback)
-                    )
-                    analysis_thread.start()
+            added, removed = source.poll(scan_interval)
 
             # Clean up terminated processes from our dict
-            terminated_pids = set(analyzed_procs.keys()) - current_pids
-            for pid in terminated_pids:
-                del analyzed_procs[pid]
-
-            # Update the status file
-            try:
-                status_data = [
-                    {"pid": p['pid'], "cmdline": " ".join(p.get('cmdline', []))}
+            for pid in removed:
+                proc_info = analyzed_procs.pop(pid, None)
+                if proc_info:
+                    history.record('exit', pid=pid, wineprefix=proc_info['wineprefix'], exit_code=source.exit_codes.pop(pid, None))
+                context = proc_info and prefix_contexts.get(proc_info['wineprefix'])
+                if context:
+                    context.pids.discard(pid)
+                    if not context.pids:
+                        del prefix_contexts[proc_info['wineprefix']]
+                        context.flush_repeats(log_callback, final=True)
+                        # Fixes applied before this run whose errors stayed away worked.
+                        for tool, argument in engine.outcomes.run_ended(context.wineprefix, context.started):
+                            log_callback(f"The fix '{argument.splitlines()[0]}' ({tool}) for {context.wineprefix} held up.")
+
+            for proc_info in added:
+                pid = proc_info['pid']
+                proc_name = Path((proc_info.get('cmdline') or ['unknown'])[0]).name
+                log_callback(f"[bold green]New application detected: {proc_name} (PID: {pid}). AI monitoring is now active.[/bold green]")
+                analyzed_procs[pid] = proc_info
+
+                wineprefix = proc_info['wineprefix']
+                history.record('process', pid=pid, wineprefix=wineprefix, cmdline=' '.join(proc_info.get('cmdline') or []))
+                context = prefix_contexts.get(wineprefix)
+                if context is None:
+                    context = prefix_contexts[wineprefix] = PrefixContext(wineprefix, templates)
+                context.pids.add(pid)
+                attach_process(proc_info, engine, reactor, log_callback, scheduler, context, actions, history)
+
+            # Repeat counts of errors that stopped coming are reported too.
+            for context in prefix_contexts.values():
+                context.flush_repeats(log_callback)
+
+            # Only the process list is compared on every pass: it changes
+            # rarely, and clients are told right away. The counters change all
+            # the time; they go out with the metrics, every metrics_interval.
+            status_data = {
+                "processes": [
+                    {"pid": p['pid'], "cmdline": " ".join(p.get('cmdline') or [])}
                     for p in analyzed_procs.values()
-                ]
-                with open(STATUS_FILE, 'w') as sf:
-                    json.dump(status_data, sf)
-            except Exception as e:
-                log_callback(f"Error writing status file: {e}")
-
-            time.sleep(scan_interval)
+                ],
+            }
+            events.publish_status(status_data)
+
+            counters_changed = False
+            if time.monotonic() >= next_metrics:
+                next_metrics = time.monotonic() + metrics_interval
+                counters = {
+                    "analysis": scheduler.stats(),
+                    "actions": actions.stats(),
+                    "log": log_callback.stats(),
+                    "history": {'written': history.written, 'failed': history.failed},
+                    "suggestion_cache": engine.cache_stats(),
+                }
+                if engine.llm is not None:
+                    counters["llm"] = engine.llm.stats()
+                events.publish({'type': 'metrics', **metrics.snapshot(), 'counters': counters})
+                counters_changed = counters != last_counters
+                last_counters = counters
+
+            # The status file is rewritten when the processes change, and
+            # for changed counters at most every metrics_interval.
+            if status_data != last_status or counters_changed:
+                try:
+                    with open(STATUS_FILE, 'w') as sf:
+                        json.dump({**status_data, **last_counters}, sf)
+                    last_status = status_data
+                except Exception as e:
+                    log_callback(f"Error writing status file: {e}")
+                if profiler:
+                    profiler.dump(profile_path('service'))
@@ -0,0 +1,341 @@
+import os
+import json
+import stat
+import time
+import errno
+import fcntl
+import shutil
+import hashlib
+import threading
+import subprocess
+from pathlib import Path
+
+from .config import config
+from .database import load_applied_fixes, record_applied_fix
+from .registry import is_wine_running
+
+TEMPLATES_DIR = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "winrunai" / "templates"
+
+# The FICLONE ioctl: make `target` share the extents of `source` (btrfs, XFS, ...).
+FICLONE = 0x40049409
+# Errors meaning the filesystem cannot reflink (or hardlink) these files.
+UNSUPPORTED = (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.EPERM, errno.EMLINK)
+
+CLONE_METHODS = ('auto', 'reflink', 'hardlink', 'copy')
+# Left out of captures: user profiles (saves, credentials, browser profiles)
+# and installed applications, which a template's key does not describe.
+# Wine recreates the profile directories when the clone first starts.
+CAPTURE_EXCLUDES = ('drive_c/users', 'drive_c/Program Files', 'drive_c/Program Files (x86)')
+METADATA_FILE = "template.json"
+
+_wine_version = None
+
+def wine_version() -> str:
+    """Returns the output of `wine --version` (cached), or 'unknown'."""
+    global _wine_version
+    if _wine_version is None:
+        try:
+            result = subprocess.run(['wine', '--version'], capture_output=True, text=True, timeout=10)
+            _wine_version = result.stdout.strip() or 'unknown'
+        except (OSError, subprocess.SubprocessError):
+            _wine_version = 'unknown'
+    return _wine_version
+
+def template_key(fixes, version: str) -> str:
+    """The key of the template for a set of (tool, argument) fixes and a Wine version."""
+    identity = json.dumps({'wine': version, 'fixes': sorted(map(list, fixes))}, separators=(',', ':'))
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()[:16]
+
+def _reflink(source, target):
+    with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+        fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+    shutil.copystat(source, target)
+
+def clone_tree(source, target, method='auto', exclude=()):
+    """
+    Recreates the directory tree `source` at `target` (which must not exist),
+    without the paths (relative to `source`, compared case-insensitively) in
+    `exclude`.
+
+    Symlinks (like the prefix's dosdevices) are copied as links. Files are
+    reflinked (sharing their data until either copy is written), hardlinked
+    or copied, as `method` says; 'auto' reflinks where the filesystem can
+    and copies otherwise. Registry files (*.reg) are never hardlinked, since
+    Wine rewrites them.
+
+    Returns:
+        dict: The number of files per method used, and 'bytes' copied or shared.
+    """
+    counts = {'reflink': 0, 'hardlink': 0, 'copy': 0, 'bytes': 0}
+    reflink = method in ('auto', 'reflink')
+    source = str(source)
+    excluded = {os.path.normpath(path).lower() for path in exclude}
+    os.makedirs(target)
+    for directory, dirnames, filenames in os.walk(source):
+        relative = os.path.relpath(directory, source)
+        target_directory = os.path.normpath(os.path.join(target, relative))
+        if excluded:
+            dirnames[:] = [name for name in dirnames if _kept(relative, name, excluded)]
+            filenames = [name for name in filenames if _kept(relative, name, excluded)]
+        for name in dirnames + filenames:
+            path = os.path.join(directory, name)
+            destination = os.path.join(target_directory, name)
+            info = os.lstat(path)
+            if stat.S_ISLNK(info.st_mode):
+                os.symlink(os.readlink(path), destination)
+            elif stat.S_ISDIR(info.st_mode):
+                os.mkdir(destination)
+                shutil.copymode(path, destination)
+            elif stat.S_ISREG(info.st_mode):
+                counts['bytes'] += info.st_size
+                if method == 'hardlink' and not name.lower().endswith('.reg'):
+                    try:
+                        os.link(path, destination)
+                        counts['hardlink'] += 1
+                        continue
+                    except OSError as e:
+                        if e.errno not in UNSUPPORTED:
+                            raise
+                if reflink:
+                    try:
+                        _reflink(path, destination)
+                        counts['reflink'] += 1
+                        continue
+                    except OSError as e:
+                        if e.errno not in UNSUPPORTED or method == 'reflink':
+                            raise
+                        # Not supported here; copy the rest.
+                        reflink = False
+                shutil.copy2(path, destination)
+                counts['copy'] += 1
+            # Sockets and FIFOs are left out.
+    shutil.copystat(source, target)
+    return counts
+
+def _kept(relative, name, excluded):
+    return os.path.normpath(os.path.join(relative, name)).lower() not in excluded
+
+def tree_size(path, exclude=()) -> int:
+    """The total size of the regular files under `path`, leaving out `exclude`, in bytes."""
+    total = 0
+    excluded = {os.path.normpath(excluded_path).lower() for excluded_path in exclude}
+    for directory, dirnames, filenames in os.walk(path):
+        relative = os.path.relpath(directory, path)
+        if excluded:
+            dirnames[:] = [name for name in dirnames if _kept(relative, name, excluded)]
+        for name in filenames:
+            try:
+                info = os.lstat(os.path.join(directory, name))
+            except OSError:
+                continue
+            if stat.S_ISREG(info.st_mode):
+                total += info.st_size
+    return total
+
+class TemplateCache:
+    """
+    Snapshots of WINEPREFIXes with fixes applied, so the same fixes can be
+    provisioned into other prefixes by cloning instead of reinstalling.
+
+    A template is keyed by the sorted set of fixes WinRunAI applied to the
+    prefix and the Wine version. Each lives in `directory/<key>/prefix`, with
+    its fixes, size and last use in `template.json`. User profiles and
+    installed applications (CAPTURE_EXCLUDES) are left out, so a template
+    holds only what its fixes put in the prefix. When the templates take
+    more than `max_bytes`, the least recently used are removed; prefixes
+    larger than `max_template_bytes` (usually with applications installed
+    in them) are not captured.
+    """
+    def __init__(self, directory=TEMPLATES_DIR, max_bytes=8 << 30, max_template_bytes=2 << 30, clone_method='auto'):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.max_template_bytes = max_template_bytes
+        self.clone_method = clone_method
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._waiting = set()       # prefixes with a capture waiting for Wine to exit
+        self._stopped = threading.Event()
+
+    def templates(self):
+        """Returns the metadata of every template, most recently used first."""
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                with open(os.path.join(entry.path, METADATA_FILE)) as metadata:
+                    found.append(json.load(metadata))
+            except (OSError, ValueError):
+                continue
+        return sorted(found, key=lambda template: template['last_used'], reverse=True)
+
+    def _write_metadata(self, path, template):
+        temporary = os.path.join(path, METADATA_FILE + '.tmp')
+        with open(temporary, 'w') as metadata:
+            json.dump(template, metadata, indent=2)
+        os.replace(temporary, os.path.join(path, METADATA_FILE))
+
+    def find(self, fixes, version: str = None):
+        """
+        Returns the template that covers the most of `fixes` without adding
+        others, for the same Wine version, or None.
+        """
+        version = version or wine_version()
+        wanted = {tuple(fix) for fix in fixes}
+        best = None
+        for template in self.templates():
+            have = {tuple(fix) for fix in template['fixes']}
+            if template['wine_version'] == version and have <= wanted and (best is None or len(have) > len(best['fixes'])):
+                best = template
+        return best
+
+    def capture(self, wineprefix: str, fixes=None, version: str = None):
+        """
+        Captures a prefix as the template for its applied fixes (by default,
+        those recorded in the knowledge base). Wine must not be running in it.
+
+        Returns:
+            dict: The template's metadata, or None if the prefix has no fixes
+            or is larger than `max_template_bytes`.
+
+        Raises:
+            RuntimeError: If Wine is running in the prefix.
+        """
+        if is_wine_running(wineprefix):
+            raise RuntimeError(f"Wine is running in {wineprefix}")
+        fixes = sorted(map(list, load_applied_fixes(wineprefix) if fixes is None else fixes))
+        if not fixes:
+            return None
+        version = version or wine_version()
+        key = template_key(fixes, version)
+        path = self.directory / key
+        if path.exists():
+            return self.touch(key)
+        size = tree_size(wineprefix, CAPTURE_EXCLUDES)
+        if size > self.max_template_bytes:
+            return None
+
+        started = time.monotonic()
+        staging = self.directory / f".{key}.{os.getpid()}.{threading.get_ident()}"
+        # The template owns its files: never hardlinked to the live prefix.
+        counts = clone_tree(wineprefix, staging / 'prefix', 'copy' if self.clone_method == 'copy' else 'auto', CAPTURE_EXCLUDES)
+        now = time.time()
+        template = {
+            'key': key,
+            'fixes': fixes,
+            'wine_version': version,
+            'bytes': counts['bytes'],
+            'source': str(wineprefix),
+            'created': now,
+            'last_used': now,
+            'capture_seconds': round(time.monotonic() - started, 3),
+        }
+        self._write_metadata(staging, template)
+        try:
+            os.rename(staging, path)
+        except OSError:
+            # Captured by someone else meanwhile.
+            shutil.rmtree(staging, ignore_errors=True)
+            return self.touch(key)
+        self.evict(keep=key)
+        return template
+
+    def touch(self, key: str):
+        """Marks a template as used now, and returns its metadata."""
+        path = self.directory / key
+        with self._lock:
+            with open(path / METADATA_FILE) as metadata:
+                template = json.load(metadata)
+            template['last_used'] = time.time()
+            self._write_metadata(path, template)
+        return template
+
+    def clone(self, key: str, target: str, method: str = None, record=True):
+        """
+        Provisions a new prefix at `target` (which must not exist) from a
+        template, and (with `record`) records the template's fixes as applied
+        to it.
+
+        Returns:
+            dict: The template's metadata, with the clone's 'counts' and 'seconds'.
+        """
+        template = self.touch(key)
+        started = time.monotonic()
+        counts = clone_tree(self.directory / key / 'prefix', target, method or self.clone_method)
+        for tool, argument in template['fixes'] if record else ():
+            record_applied_fix(str(target), tool, argument)
+        return {**template, 'counts': counts, 'seconds': round(time.monotonic() - started, 3)}
+
+    def remove(self, key: str):
+        path = self.directory / key
+        # Renamed first, so a half-removed template is never used.
+        doomed = self.directory / f".removing.{key}.{os.getpid()}"
+        try:
+            os.rename(path, doomed)
+        except FileNotFoundError:
+            return
+        shutil.rmtree(doomed, ignore_errors=True)
+
+    def evict(self, keep: str = None):
+        """Removes the least recently used templates until they fit in `max_bytes`."""
+        templates = self.templates()
+        total = sum(template['bytes'] for template in templates)
+        removed = []
+        for template in reversed(templates):
+            if total <= self.max_bytes:
+                break
+            if template['key'] == keep:
+                continue
+            self.remove(template['key'])
+            total -= template['bytes']
+            removed.append(template['key'])
+        return removed
+
+    def capture_later(self, wineprefix: str, callback, interval=2.0):
+        """
+        Captures a prefix in the background once Wine has exited in it (a
+        fixed application is usually still running). Only one capture waits
+        per prefix; it captures the fixes applied by then.
+        """
+        with self._lock:
+            if wineprefix in self._waiting:
+                return
+            self._waiting.add(wineprefix)
+
+        def run():
+            try:
+                while is_wine_running(wineprefix):
+                    if self._stopped.wait(interval):
+                        return
+                template = self.capture(wineprefix)
+                if template:
+                    callback(f"Captured a template of {wineprefix} with {len(template['fixes'])} fixes ({template['bytes'] >> 20} MB).")
+            except Exception as e:
+                callback(f"Could not capture a template of {wineprefix}: {e}")
+            finally:
+                with self._lock:
+                    self._waiting.discard(wineprefix)
+
+        threading.Thread(target=run, name=f"template:{wineprefix}", daemon=True).start()
+
+    def close(self):
+        self._stopped.set()
+
+def open_template_cache():
+    """Opens the prefix template cache, as configured under `templates` in config.yml, or None if disabled."""
+    templates_config = config.get('templates', {})
+    if not templates_config.get('enabled', False):
+        return None
+    return TemplateCache(
+        os.path.expanduser(templates_config.get('directory') or TEMPLATES_DIR),
+        max_bytes=templates_config.get('max_bytes', 8 << 30),
+        max_template_bytes=templates_config.get('max_template_bytes', 2 << 30),
+        clone_method=templates_config.get('clone_method', 'auto'),
+    )
+
+if __name__ == '__main__':
+    # Example usage: list the templates.
+    cache = TemplateCache()
+    for template in cache.templates():
+        fixes = ', '.join(argument.splitlines()[0] for _, argument in template['fixes'])
+        print(f"{template['key']}  {template['bytes'] >> 20:6d} MB  {template['wine_version']}  {fixes}")
@@ -4,8 +4,11 @@ from textual.containers import Container
 from textual.events import Mount
 import os
 import json
+import time
+import asyncio
 
-from .service import start_service, stop_service, is_service_running, LOG_FILE, STATUS_FILE
+from .control import start_service, stop_service, is_service_running, SOCKET_FILE
+from .eventstore import open_event_store, format_event
 
 class WinRunAIApp(App):
     """A Textual app to manage WinRunAI."""
@@ -14,13 +17,10 @@ class WinRunAIApp(App):
 
     BINDINGS = [
         ("d", "toggle_dark", "Toggle dark mode"),
+        ("h", "show_history", "Recent history"),
         ("q", "quit", "Quit"),
     ]
 
-    def __init__(self):
-        super().__init__()
-        self.log_file_position = 0
-
     def compose(self) -> ComposeResult:
         yield Header()
         yield Footer()
@@ -34,6 +34,7 @@ class WinRunAIApp(App):
             with Container(id="right-pane"):
                 yield Static("Status: Unknown", id="status-display")
                 yield Static("Monitored Processes: None", id="proc-display") # New widget
+                yield Static("Stats: waiting for the service...", id="stats-display")
                 yield RichLog(id="log-viewer", wrap=True, highlight=True, markup=True)
 
     def on_mount(self) -> None:
@@ -43,43 +44,71 @@ class WinRunAIApp(App):
         log_viewer.write("[bold cyan]Welcome to WinRunAI![/bold cyan]")
         log_viewer.write("Enable the AI to begin monitoring Wine processes.")
 
-        # Start timers to update logs and process list
-        self.set_interval(1.0, self.tail_log_file)
-        self.set_interval(2.0, self.update_monitored_processes)
-
-    def update_monitored_processes(self) -> None:
-        """Reads the status file and updates the process display widget."""
+        # Follow the service's event stream for logs and process updates
+        self.run_worker(self.follow_service_events(), exclusive=True, group="service-events")
+
+    async def follow_service_events(self) -> None:
+        """
+        Subscribes to the service's event socket and applies updates as they
+        arrive. Reconnects when the service is (re)started.
+        """
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(str(SOCKET_FILE), limit=1024 * 1024)
+            except OSError:
+                # Service not running (yet)
+                await asyncio.sleep(1.0)
+                continue
+
+            try:
+                while line := await reader.readline():
+                    try:
+                        event = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.handle_service_event(event)
+            except (OSError, ValueError):
+                pass
+            finally:
+                writer.close()
+
+            self.show_monitored_processes([])
+            self.update_status_display()
+            await asyncio.sleep(1.0)
+
+    def handle_service_event(self, event: dict) -> None:
+        """Applies one event from the service's event stream."""
+        if event.get('type') == 'log':
+            self.query_one("#log-viewer").write(f"[{time.ctime(event['time'])}] {event['message']}")
+        elif event.get('type') == 'status':
+            self.show_monitored_processes(event.get('processes', []))
+        elif event.get('type') == 'metrics':
+            self.show_metrics(event)
+
+    def show_metrics(self, metrics: dict) -> None:
+        """Updates the stats panel from a metrics snapshot."""
+        def mean(name):
+            histogram = metrics.get(name) or {}
+            return histogram.get('sum', 0.0) / histogram['count'] if histogram.get('count') else 0.0
+
+        tool_runs = (metrics.get('tool_run_seconds') or {}).get('count', 0)
+        self.query_one("#stats-display").update(
+            f"Lines: {metrics.get('lines_read_total', 0)} read, {metrics.get('lines_matched_total', 0)} matched"
+            f" | Lookup: {mean('engine_lookup_seconds') * 1e6:.0f}µs"
+            f" | Busy analyzers: {metrics.get('analyzer_threads_active', 0)}"
+            f" | Fixes: {tool_runs} run ({mean('tool_run_seconds'):.1f}s), waited {mean('executor_queue_wait_seconds'):.1f}s"
+            f" | Scan: {mean('scan_seconds') * 1000:.1f}ms"
+            f" | Dropped logs: {metrics.get('log_records_dropped', 0)}"
+        )
+
+    def show_monitored_processes(self, procs) -> None:
+        """Updates the process display widget."""
         proc_widget = self.query_one("#proc-display")
-        if not is_service_running():
-            proc_widget.update("Monitored Processes: None")
-            return
-
-        try:
-            with open(STATUS_FILE, 'r') as f:
-                procs = json.load(f)
-
-            if not procs:
-                proc_widget.update("Monitored Processes: None")
-            else:
-                proc_names = [f"{os.path.basename(p['cmdline'].split()[0])} (PID: {p['pid']})" for p in procs]
-                proc_widget.update(f"Monitored Processes: [bold yellow]{', '.join(proc_names)}[/bold yellow]")
-
-        except (FileNotFoundError, json.JSONDecodeError):
+        if not procs:
             proc_widget.update("Monitored Processes: None")
-
-    def tail_log_file(self) -> None:
-        """Read new lines from the service log file and display them."""
-        log_viewer = self.query_one("#log-viewer")
-        try:
-            with open(LOG_FILE, "r") as f:
-                f.seek(self.log_file_position)
-                new_lines = f.readlines()
-                if new_lines:
-                    for line in new_lines:
-                        log_viewer.write(line.strip())
-                    self.log_file_position = f.tell()
-        except FileNotFoundError:
-            pass
+        else:
+            proc_names = [f"{os.path.basename(p['cmdline'].split()[0]) if p['cmdline'] else 'unknown'} (PID: {p['pid']})" for p in procs]
+            proc_widget.update(f"Monitored Processes: [bold yellow]{', '.join(proc_names)}[/bold yellow]")
 
     def update_status_display(self) -> None:
         status_widget = self.query_one("#status-display")
@@ -104,5 +133,18 @@ class WinRunAIApp(App):
 
         self.update_status_display()
 
+    async def action_show_history(self) -> None:
+        """Shows the most recent errors, suggestions, fixes and process events."""
+        log_viewer = self.query_one("#log-viewer")
+        try:
+            store = open_event_store(read_only=True)
+            events = await asyncio.to_thread(store.query, limit=50, newest_first=True)
+        except OSError as e:
+            log_viewer.write(f"Could not read the event history: {e}")
+            return
+        log_viewer.write(f"[bold cyan]Last {len(events)} events:[/bold cyan]")
+        for event in reversed(events):
+            log_viewer.write(format_event(event))
+
     def action_toggle_dark(self) -> None:
         self.dark = not self.dark